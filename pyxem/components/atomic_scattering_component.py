@@ -19,6 +19,7 @@
 
 from hyperspy.component import Component
 from pyxem.utils.atomic_scattering_params import ATOMIC_SCATTERING_PARAMS
+from pyxem.utils.sim_utils import get_scattering_factors
 import numpy as np
 
 
@@ -60,18 +61,16 @@ class AtomicScatteringFunction(Component):
 
         N = self.N.value
         C = self.C.value
-        params = self.params
         fracs = self.fracs
+        s2 = x ** 2
 
         # gq is sum(f**2*frac) and is used for the fitting
         gq = np.zeros(x.size)
         # fq is sum(f*frac)**2 and is needed in the denominator of phi
         fq = np.zeros(x.size)
         for j in range(len(fracs)):
-            # Finding f for each element
-            f = np.zeros(x.size)
-            for i in range(5):
-                f = f + params[j][i][0]*np.exp(-params[j][i][1]*(x**2))
+            # Finding f for each element, from its tabulated values
+            f = get_scattering_factors(self.elements[j], s2)
             gq += (f**2)*fracs[j]
             fq += f*fracs[j]
         # TODO: This is a bit weird, where is this used?
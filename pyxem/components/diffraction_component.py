@@ -48,6 +48,9 @@ class ElectronDiffractionForwardModel(Component):
     dij : float
         Components of the transformation matrix used to deform the structure.
         Defaults to the identity matrix.
+    reciprocal_radius : float
+        The maximum radius of the sphere of reciprocal space to sample, in
+        reciprocal angstroms.
 
     """
     # TODO: examples in the docstring
@@ -57,13 +60,15 @@ class ElectronDiffractionForwardModel(Component):
                  calibration,
                  d11=1., d12=0., d13=0.,
                  d21=0., d22=1., d23=0.,
-                 d31=0., d32=0., d33=1.):
+                 d31=0., d32=0., d33=1.,
+                 reciprocal_radius=1.):
         Component.__init__(self, ['d11', 'd12', 'd13',
                                   'd21', 'd22', 'd23',
                                   'd31', 'd32', 'd33',])
         self.electron_diffraction_calculator = electron_diffraction_calculator
         self.structure = structure
         self.calibration = calibration
+        self.reciprocal_radius = reciprocal_radius
         self.d11.value = d11
         self.d12.value = d12
         self.d13.value = d13
@@ -80,6 +85,10 @@ class ElectronDiffractionForwardModel(Component):
     def simulate(self):
         """Deforms the structure and simulates the resultant diffraction pattern
 
+        Structure factors are cached by the diffraction calculator, so that
+        repeated simulations with the same deformation only compute the
+        excitation errors.
+
         Returns
         -------
         simulation : DiffractionSimulation
@@ -103,6 +112,7 @@ class ElectronDiffractionForwardModel(Component):
                                                      [d21, d22, d23],
                                                      [d31, d32, d33]])
         deformed_structure = deformation.apply_transformation(structure)
-        simulation = diffractor.calculate_ed_data(deformed_structure)
+        simulation = diffractor.calculate_ed_data(deformed_structure,
+                                                  self.reciprocal_radius)
         simulation.calibration = calibration
         return simulation
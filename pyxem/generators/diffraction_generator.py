@@ -20,6 +20,8 @@
 
 """
 
+from collections import OrderedDict
+
 import numpy as np
 from pyxem.signals.diffraction_simulation import DiffractionSimulation
 
@@ -50,6 +52,9 @@ class DiffractionGenerator(object):
         equal to 1/{specimen thickness}.
     debye_waller_factors : dict of str : float
         Maps element names to their temperature-dependent Debye-Waller factors.
+    cache_size : int
+        The number of sets of structure factors kept in the cache, see
+        :meth:`get_structure_factors`.
 
     """
     # TODO: Include camera length, when implemented.
@@ -58,11 +63,92 @@ class DiffractionGenerator(object):
     def __init__(self,
                  accelerating_voltage,
                  max_excitation_error,
-                 debye_waller_factors=None):
+                 debye_waller_factors=None,
+                 cache_size=32):
+        self.accelerating_voltage = accelerating_voltage
         self.wavelength = get_electron_wavelength(accelerating_voltage)
         self.max_excitation_error = max_excitation_error
+        self.cache_size = cache_size
+        self._structure_factors = OrderedDict()
         self.debye_waller_factors = debye_waller_factors or {}
 
+    @property
+    def debye_waller_factors(self):
+        """dict of str : float : Maps element names to their
+        temperature-dependent Debye-Waller factors. Setting them clears the
+        structure factor cache."""
+        return self._debye_waller_factors
+
+    @debye_waller_factors.setter
+    def debye_waller_factors(self, debye_waller_factors):
+        self._debye_waller_factors = debye_waller_factors
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Empties the structure factor cache."""
+        self._structure_factors.clear()
+
+    def get_structure_factors(self, structure, reciprocal_radius):
+        """The reciprocal lattice points of a structure within a sphere, with
+        the modulus squared of their structure factors.
+
+        These depend on the structure only through its lattice metric, its
+        sites in fractional coordinates and the Debye-Waller factors, all of
+        which are unchanged by rotations of the structure. They are cached
+        under this key, so that simulations of the same structure in any
+        orientation only compute excitation errors. The least recently used
+        entry is evicted when the cache holds `cache_size` entries.
+
+        Parameters
+        ----------
+        structure : Structure
+            The structure, in any orientation.
+        reciprocal_radius : float
+            The maximum radius of the sphere of reciprocal space to sample, in
+            reciprocal angstroms.
+
+        Returns
+        -------
+        recip_pts : np.array()
+            The Miller indices of the reciprocal lattice points.
+        g_hkls : np.array()
+            The magnitudes of the reciprocal lattice vectors.
+        structure_factors : np.array()
+            The modulus squared of the structure factor of each point.
+
+        """
+        lattice = structure.lattice
+        metric = np.round(np.dot(lattice.matrix, lattice.matrix.T), 8) + 0.
+        # Fractional coordinates are compared modulo one, as rotating a
+        # structure may wrap sites on a cell boundary.
+        sites = tuple(
+            (tuple(sorted((sp.symbol, occu)
+                          for sp, occu in site.species_and_occu.items())),
+             tuple(np.mod(np.round(site.frac_coords, 8), 1) + 0.))
+            for site in structure)
+        key = (tuple(metric.ravel()), sites,
+               tuple(sorted(self.debye_waller_factors.items())),
+               reciprocal_radius)
+        if key in self._structure_factors:
+            self._structure_factors.move_to_end(key)
+            return self._structure_factors[key]
+
+        recip_latt = lattice.reciprocal_lattice_crystallographic
+        recip_pts, g_hkls = \
+            recip_latt.get_points_in_sphere([[0, 0, 0]], [0, 0, 0],
+                                            reciprocal_radius,
+                                            zip_results=False)[:2]
+        # With no excitation error the shape factor is one, leaving the
+        # modulus squared of the structure factors.
+        structure_factors = get_kinematical_intensities(
+            structure, recip_pts, g_hkls, np.zeros(len(g_hkls)),
+            self.max_excitation_error, self.debye_waller_factors)
+        structure_factors = recip_pts, g_hkls, structure_factors
+        self._structure_factors[key] = structure_factors
+        while len(self._structure_factors) > self.cache_size:
+            self._structure_factors.popitem(last=False)
+        return structure_factors
+
     def calculate_ed_data(self, structure, reciprocal_radius, with_direct_beam=True):
         """Calculates the Electron Diffraction data for a structure.
 
@@ -85,16 +171,13 @@ class DiffractionGenerator(object):
         # Specify variables used in calculation
         wavelength = self.wavelength
         max_excitation_error = self.max_excitation_error
-        debye_waller_factors = self.debye_waller_factors
         latt = structure.lattice
 
-        # Obtain crystallographic reciprocal lattice points within `max_r` and
-        # g-vector magnitudes for intensity calculations.
+        # Obtain crystallographic reciprocal lattice points within `max_r`,
+        # with the modulus squared of their structure factors.
         recip_latt = latt.reciprocal_lattice_crystallographic
-        recip_pts, g_hkls = \
-            recip_latt.get_points_in_sphere([[0, 0, 0]], [0, 0, 0],
-                                            reciprocal_radius,
-                                            zip_results=False)[:2]
+        recip_pts, g_hkls, structure_factors = \
+            self.get_structure_factors(structure, reciprocal_radius)
         cartesian_coordinates = recip_latt.get_cartesian_coords(recip_pts)
 
         # Identify points intersecting the Ewald sphere within maximum
@@ -109,15 +192,11 @@ class DiffractionGenerator(object):
         intersection_coordinates = cartesian_coordinates[intersection]
         intersection_indices = recip_pts[intersection]
         proximity = proximity[intersection]
-        g_hkls = g_hkls[intersection]
 
-        # Calculate diffracted intensities based on a kinematical model.
-        intensities = get_kinematical_intensities(structure,
-                                                  intersection_indices,
-                                                  g_hkls,
-                                                  proximity,
-                                                  max_excitation_error,
-                                                  debye_waller_factors)
+        # Calculate diffracted intensities based on a kinematical model, in
+        # which the intensity scales linearly with proximity.
+        intensities = structure_factors[intersection] * \
+            (1 - proximity / max_excitation_error)
 
         # Threshold peaks included in simulation based on minimum intensity.
         peak_mask = intensities > 1e-20
@@ -130,4 +209,65 @@ class DiffractionGenerator(object):
                                      intensities=intensities,
                                      with_direct_beam=with_direct_beam)
 
+    def calculate_ed_data_batch(self, structure, rotation_matrices,
+                                reciprocal_radius, with_direct_beam=True):
+        """Calculates the Electron Diffraction data for a structure at many
+        orientations at once.
+
+        Rotating a structure rotates its reciprocal lattice without changing
+        which points lie within `reciprocal_radius` or their structure
+        factors. The reciprocal lattice points and the modulus squared of
+        their structure factors are therefore looked up once, see
+        :meth:`get_structure_factors`, and only the
+        excitation errors and intensities are computed for each orientation,
+        by array operations over all orientations. The results are those of
+        :meth:`calculate_ed_data` for the structure rotated by each matrix.
+
+        Parameters
+        ----------
+        structure : Structure
+            The structure for which to derive the diffraction patterns, in
+            its unrotated orientation.
+        rotation_matrices : array-like
+            Stack of 3x3 rotation matrices with shape (n_orientations, 3, 3),
+            applied to the Cartesian coordinates of the structure, e.g. from
+            :func:`pyxem.utils.sim_utils.get_orientation_matrix`.
+        reciprocal_radius : float
+            The maximum radius of the sphere of reciprocal space to sample, in
+            reciprocal angstroms.
+
+        Returns
+        -------
+        list of pyxem.DiffractionSimulation
+            The data associated with the structure at each orientation.
+
+        """
+        wavelength = self.wavelength
+        max_excitation_error = self.max_excitation_error
+        rotation_matrices = np.asarray(rotation_matrices)
+
+        recip_latt = structure.lattice.reciprocal_lattice_crystallographic
+        recip_pts, g_hkls, structure_factors = \
+            self.get_structure_factors(structure, reciprocal_radius)
+        cartesian_coordinates = recip_latt.get_cartesian_coords(recip_pts)
+
+        # Rotated coordinates, with shape (n_orientations, n_points, 3).
+        rotated_coordinates = np.dot(rotation_matrices,
+                                     cartesian_coordinates.T)
+        rotated_coordinates = rotated_coordinates.transpose(0, 2, 1)
+        radius = 1 / wavelength
+        r = np.sqrt(np.sum(np.square(rotated_coordinates[:, :, :2]), axis=2))
+        theta = np.arcsin(r / radius)
+        z_sphere = radius * (1 - np.cos(theta))
+        proximity = np.absolute(z_sphere - rotated_coordinates[:, :, 2])
+        intensities = structure_factors * \
+            (1 - proximity / max_excitation_error)
+        peak_mask = np.logical_and(proximity < max_excitation_error,
+                                   intensities > 1e-20)
 
+        return [DiffractionSimulation(coordinates=coordinates[mask],
+                                      indices=recip_pts[mask],
+                                      intensities=peak_intensities[mask],
+                                      with_direct_beam=with_direct_beam)
+                for coordinates, peak_intensities, mask in
+                zip(rotated_coordinates, intensities, peak_mask)]
@@ -20,42 +20,219 @@
 
 """
 
-from heapq import nlargest
-from operator import itemgetter
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from math import radians
 
+import dask.array as da
+import h5py
 import numpy as np
-from pyxem.signals.indexation_results import IndexationResults
+from hyperspy.signal import BaseSignal
+from scipy.ndimage import map_coordinates
+from scipy.optimize import minimize
+from scipy.spatial import cKDTree
+from pyxem.signals.diffraction_library import DiffractionLibrary
+from pyxem.signals.indexation_results import IndexationResults, \
+    LazyIndexationResults
+from pyxem.signals.template_bank import TemplateBank, load_template_bank
 
-from pyxem.utils import correlate
+from pyxem.utils.expt_utils import reproject_polar
+from pyxem.utils.sim_utils import get_orientation_matrix, local_euler_grid
+from pyxem.utils.indexation_utils import correlate_template_bank, \
+    correlate_template_bank_batch, get_top_correlations, \
+    get_top_correlations_pruned, get_polar_templates, \
+    correlate_polar_templates, normalize_correlations, match_vectors, \
+    bin_frames, get_frame_fingerprints
 
 
-def correlate_library(image, library,n_largest,keys=[]):
+def correlate_library(image, library, n_largest, keys=[], normalize=False,
+                      mask=False):
     """Correlates all simulated diffraction templates in a DiffractionLibrary
     with a particular experimental diffraction pattern (image) stored as a
     numpy array. See the correlate method of IndexationGenerator for details.
+
+    The library may be passed precompiled as a
+    :class:`pyxem.signals.template_bank.TemplateBank`, in which case every
+    template is scored in a single vectorized call. If `mask` is True, the
+    pattern is not scored and the results are filled with NaN.
     """
+    if isinstance(library, TemplateBank):
+        template_bank = library
+    else:
+        template_bank = library.get_template_bank(keys)
+    if mask:
+        if not n_largest:
+            n_largest = np.diff(template_bank.phase_offsets).max()
+        return np.full((n_largest * len(template_bank.keys), 5), np.nan)
+    correlations = correlate_template_bank(image, template_bank)[np.newaxis]
+    if normalize:
+        correlations = normalize_correlations(correlations, image[np.newaxis],
+                                              template_bank)
+    return get_top_correlations(correlations, template_bank, n_largest)[0]
 
-    i=0
-    out_arr = np.zeros((n_largest * len(library),5))
-    for key in library.keys():
-        if n_largest:
-            pass
-        else:
-            n_largest=len(library[key])
-        correlations = dict()
-        for orientation, diffraction_pattern in library[key].items():
-            #diffraction_pattern here is in fact a library of diffraction_pattern_properties
-            correlation = correlate(image, diffraction_pattern)
-            correlations[orientation] = correlation
-        res = nlargest(n_largest, correlations.items(), key=itemgetter(1))
-        for j in np.arange(n_largest):
-            out_arr[j + i*n_largest][0] = i
-            out_arr[j + i*n_largest][1] = res[j][0][0]
-            out_arr[j + i*n_largest][2] = res[j][0][1]
-            out_arr[j + i*n_largest][3] = res[j][0][2]
-            out_arr[j + i*n_largest][4] = res[j][1]
-        i = i + 1
-    return out_arr
+
+def correlate_library_in_plane(image, template_bank, polar_templates,
+                               n_largest, dr=1, dt=None):
+    """Correlates every template of a template bank, at every in-plane
+    rotation, with a diffraction pattern. See the correlate_in_plane method of
+    IndexationGenerator for details.
+    """
+    polar_image = reproject_polar(image, dr=dr, dt=dt, periodic=True)
+    correlations = correlate_polar_templates(polar_image, template_bank,
+                                             polar_templates)
+    rotations = np.argmax(correlations, axis=1) * polar_templates['theta_step']
+    orientations = np.array(template_bank.orientations[:, :3])
+    orientations[:, 0] = np.mod(orientations[:, 0] + rotations, 2 * np.pi)
+    return get_top_correlations(correlations.max(axis=1)[np.newaxis],
+                                template_bank, n_largest,
+                                orientations[np.newaxis])[0]
+
+
+def _correlate_block(block, mask, template_bank, n_largest, normalize):
+    """Scores the unmasked patterns of a block of diffraction patterns, with
+    any navigation shape, against a template bank. Masked patterns are filled
+    with NaN.
+    """
+    frames = block.reshape((-1,) + block.shape[-2:])
+    unmasked = np.flatnonzero(~mask.ravel())
+    n_rows = n_largest * len(template_bank.keys)
+    matching_results = np.full((len(frames), n_rows, 5), np.nan)
+    if len(unmasked):
+        frames = frames[unmasked]
+        correlations = correlate_template_bank_batch(frames, template_bank)
+        if normalize:
+            correlations = normalize_correlations(correlations, frames,
+                                                  template_bank)
+        matching_results[unmasked] = get_top_correlations(
+            correlations, template_bank, n_largest)
+    return matching_results.reshape(block.shape[:-2] + (n_rows, 5))
+
+
+# Template banks attached to by each worker process, keyed by directory.
+_worker_template_banks = {}
+
+
+def _correlate_frames(frames, template_bank_directory, n_largest, batch_size,
+                      normalize):
+    """Scores a chunk of diffraction patterns in a worker process against a
+    template bank memory-mapped from disk.
+    """
+    if template_bank_directory not in _worker_template_banks:
+        _worker_template_banks[template_bank_directory] = \
+            load_template_bank(template_bank_directory, mmap_mode='r')
+    template_bank = _worker_template_banks[template_bank_directory]
+    batch_size = batch_size or len(frames)
+    matching_results = []
+    for start in range(0, len(frames), batch_size):
+        block = frames[start:start + batch_size]
+        correlations = correlate_template_bank_batch(block, template_bank)
+        if normalize:
+            correlations = normalize_correlations(correlations, block,
+                                                  template_bank)
+        matching_results.append(
+            get_top_correlations(correlations, template_bank, n_largest))
+    return np.concatenate(matching_results)
+
+
+def correlate_orientation(image, euler, structure, diffraction_generator,
+                          calibration, reciprocal_radius, half_shape,
+                          with_direct_beam=True):
+    """Correlates a diffraction pattern with the pattern simulated for a
+    structure at an arbitrary orientation.
+
+    Unlike the templates of a DiffractionLibrary, the simulated spots are not
+    rounded to pixel positions: the pattern is sampled at the calibrated spot
+    positions by bilinear interpolation, so that the correlation varies
+    continuously with the orientation.
+
+    Parameters
+    ----------
+    image : np.array()
+        The experimental diffraction pattern of interest.
+    euler : array-like
+        The (alpha, beta, gamma) Euler angles of the orientation, in radians,
+        in the convention of the DiffractionLibraryGenerator.
+    structure : Structure
+        The structure to simulate.
+    diffraction_generator : DiffractionGenerator
+        The calculator used for the simulation.
+    calibration : float
+        The calibration of the pattern, in reciprocal Angstroms per pixel.
+    reciprocal_radius : float
+        The maximum g-vector magnitude to be included in the simulation.
+    half_shape : tuple
+        The half shape of the pattern.
+    with_direct_beam : bool
+        Whether the direct beam is included in the simulation.
+
+    Returns
+    -------
+    correlation : float
+        The correlation of the pattern with the simulation, normalised by the
+        norm of the simulated intensities as in the correlate method.
+
+    """
+    simulation = diffraction_generator.calculate_ed_data_batch(
+        structure, [get_orientation_matrix(euler)], reciprocal_radius,
+        with_direct_beam)[0]
+    intensities = simulation.intensities
+    if len(intensities) == 0:
+        return 0.
+    simulation.calibration = calibration
+    coordinates = simulation.calibrated_coordinates[:, :2] + half_shape
+    values = map_coordinates(image, coordinates.T, order=1, mode='constant',
+                             cval=0.)
+    return np.dot(values, intensities) / \
+        np.sqrt(np.dot(intensities, intensities))
+
+
+def _negative_correlation(euler, *args):
+    return -correlate_orientation(args[0], euler, *args[1:])
+
+
+def refine_orientations(image, matches, structures, diffraction_generator,
+                        calibration, reciprocal_radius, half_shape,
+                        resolution, tolerance, with_direct_beam=True):
+    """Locally optimises the orientations of matches with a diffraction
+    pattern. See the refine_orientations method of IndexationGenerator for
+    details.
+
+    Returns
+    -------
+    refined_matches : np.array()
+        The matches with refined Euler angles and correlations, sorted by
+        decreasing correlation. Matches that are NaN are left as NaN.
+
+    """
+    refined_matches = np.full(np.shape(matches), np.nan)
+    step = radians(resolution)
+    for i, match in enumerate(matches):
+        if np.isnan(match[4]):
+            continue
+        args = (image, structures[int(match[0])], diffraction_generator,
+                calibration, reciprocal_radius, half_shape, with_direct_beam)
+        # The initial simplex spans one grid step in each Euler angle, so that
+        # the search starts within the cell of the grid containing the match.
+        start = np.asarray(match[1:4], dtype=float)
+        simplex = start + np.vstack((np.zeros(3), np.eye(3) * step))
+        result = minimize(_negative_correlation, start, args=args,
+                          method='Nelder-Mead',
+                          options={'initial_simplex': simplex,
+                                   'xatol': radians(tolerance),
+                                   'fatol': 1e-8})
+        refined_matches[i, 0] = match[0]
+        refined_matches[i, 1:4] = result.x
+        refined_matches[i, 4] = -result.fun
+    return refined_matches[np.argsort(-refined_matches[:, 4])]
+
+
+def _refine_frames(frames, matches, **kwargs):
+    """Refines the matches of a chunk of diffraction patterns in a worker
+    process.
+    """
+    return np.array([refine_orientations(np.asarray(frame), frame_matches,
+                                         **kwargs)
+                     for frame, frame_matches in zip(frames, matches)])
 
 
 class IndexationGenerator():
@@ -76,6 +253,16 @@ class IndexationGenerator():
     def correlate(self,
                   n_largest=5,
                   keys=[],
+                  batch_size=None,
+                  workers=None,
+                  prune=False,
+                  normalize=False,
+                  filename=None,
+                  mask=None,
+                  cache=False,
+                  cache_binning=4,
+                  cache_levels=16,
+                  intensity_dtype=None,
                   **kwargs):
         """Correlates the library of simulated diffraction patterns with the
         electron diffraction signal.
@@ -89,6 +276,67 @@ class IndexationGenerator():
             these are submitted. This allows a mapping from the number to the
             phase.  For example, keys = ['si','ga'] will have an output with 0
             for 'si' and 1 for 'ga'.
+        batch_size : int, optional
+            If specified, diffraction patterns are scored in blocks of this
+            many patterns, each block against all templates in a single sparse
+            matrix product, instead of one pattern at a time through the
+            HyperSpy map() function. Larger blocks are faster but require
+            (batch_size x n_templates) scores to be held in memory.
+        workers : int, optional
+            If specified, the navigation space is split into chunks that are
+            scored by this many worker processes. The template bank is written
+            to a temporary directory and memory-mapped by every worker, rather
+            than being copied into each of them. Within a chunk, patterns are
+            scored in blocks of `batch_size`, or all at once if it is None.
+        prune : bool
+            If True, the exact n_largest templates of each phase are found
+            without scoring templates whose upper bound on the correlation
+            cannot beat them. The total number of templates skipped is stored
+            in the metadata of the results under `Indexation.pruned_templates`
+            and, as a fraction of all templates, `Indexation.pruned_fraction`.
+            Cannot be combined with `batch_size`, `workers` or `normalize`.
+        normalize : bool
+            If True, the zero-mean normalised cross-correlation between each
+            pattern and template is returned instead of the unnormalised
+            correlation. It lies between -1 and 1, so that scores and
+            reliabilities may be compared between datasets. See
+            :func:`pyxem.utils.indexation_utils.normalize_correlations`.
+        filename : str, optional
+            Only used for lazy signals, which are indexed chunk by chunk with
+            dask, keeping the navigation chunks of the signal; `batch_size` and
+            `workers` are then ignored. If given, the results of each chunk are
+            written to the HDF5 file `filename` as soon as the chunk is scored,
+            so that the results never need to fit in memory, and the returned
+            results read lazily from this file. Otherwise, the returned results
+            are lazy and computed on demand.
+        mask : array-like or BaseSignal, optional
+            A boolean navigation mask, such as returned by
+            :meth:`ElectronDiffraction.get_vacuum_mask`. Patterns at navigation
+            positions where it is True are not scored and their results are
+            filled with NaN. The mask is stored in the metadata of the results
+            under `Indexation.navigation_mask`.
+        cache : bool
+            If True, patterns with the same fingerprint as an earlier pattern
+            (see :func:`pyxem.utils.indexation_utils.get_frame_fingerprints`)
+            are not scored, and reuse the results of that pattern instead.
+            This is an approximation, intended for scans with many
+            near-identical patterns such as vacuum or saturated regions. The
+            number of patterns that reused results is stored in the metadata
+            of the results under `Indexation.cache_hits` and, as a fraction of
+            the unmasked patterns, `Indexation.cache_hit_rate`. Not available
+            for lazy signals.
+        cache_binning : int
+            The side of the square bins in which patterns are summed for their
+            fingerprint, in pixels.
+        cache_levels : int
+            The number of intensity levels, up to the largest binned intensity
+            of the signal, to which binned patterns are quantised for their
+            fingerprint. Fewer levels give more cache hits and a coarser
+            approximation.
+        intensity_dtype : numpy.float16 or numpy.float32, optional
+            If given, patterns are scored in single precision against a
+            compact template bank with intensities of this type, see
+            :meth:`pyxem.signals.template_bank.TemplateBank.compact`.
         **kwargs
             Keyword arguments passed to the HyperSpy map() function.
 
@@ -102,13 +350,619 @@ class IndexationGenerator():
 
         """
         signal = self.signal
-        library = self.library
+        template_bank = self.library.get_template_bank(keys)
+        if intensity_dtype is not None:
+            template_bank = template_bank.compact(intensity_dtype)
+        if not n_largest:
+            n_largest = np.diff(template_bank.phase_offsets).max()
+        mask = self._get_navigation_mask(mask)
+        if not cache:
+            return self._correlate_template_bank(template_bank, n_largest,
+                                                 keys, batch_size, workers,
+                                                 prune, normalize, filename,
+                                                 mask, **kwargs)
+        if signal._lazy:
+            raise ValueError("The cache is not available for lazy signals.")
+        sources = self._get_cache_sources(mask, cache_binning, cache_levels)
+        hits = sources != np.arange(len(sources))
+        scoring_mask = hits.reshape(signal.data.shape[:-2])
+        if mask is not None:
+            scoring_mask = scoring_mask | mask
+        matching_results = self._correlate_template_bank(
+            template_bank, n_largest, keys, batch_size, workers, prune,
+            normalize, filename, scoring_mask, **kwargs)
+        data = matching_results.data
+        flat_data = data.reshape((-1,) + data.shape[-2:])
+        flat_data[hits] = flat_data[sources[hits]]
+        if mask is None:
+            del matching_results.metadata.Indexation.navigation_mask
+        else:
+            matching_results.metadata.set_item('Indexation.navigation_mask',
+                                               mask)
+        n_unmasked = len(sources) if mask is None else np.sum(~mask)
+        matching_results.metadata.set_item('Indexation.cache_hits',
+                                           int(np.sum(hits)))
+        matching_results.metadata.set_item(
+            'Indexation.cache_hit_rate', np.sum(hits) / max(n_unmasked, 1))
+        return matching_results
+
+    def _correlate_template_bank(self, template_bank, n_largest, keys,
+                                 batch_size, workers, prune, normalize,
+                                 filename, mask, **kwargs):
+        """Scores the signal against a template bank with the method selected
+        by the arguments. See the correlate method for details.
+        """
+        signal = self.signal
+        if prune:
+            if batch_size or workers or normalize:
+                raise ValueError("Pruning cannot be combined with "
+                                 "`batch_size`, `workers` or `normalize`.")
+            return self._correlate_pruned(template_bank, n_largest, mask)
+        if signal._lazy:
+            return self._correlate_lazy(template_bank, n_largest, normalize,
+                                        filename, mask)
+        if workers:
+            return self._correlate_parallel(template_bank, n_largest,
+                                            batch_size, workers, normalize,
+                                            mask)
+        if batch_size:
+            return self._correlate_batches(template_bank, n_largest,
+                                           batch_size, normalize, mask)
+        if mask is not None:
+            kwargs['mask'] = BaseSignal(mask).T
         matching_results = signal.map(correlate_library,
-                                      library=library,
+                                      library=template_bank,
                                       n_largest=n_largest,
                                       keys=keys,
+                                      normalize=normalize,
+                                      inplace=False,
+                                      **kwargs)
+        matching_results = IndexationResults(matching_results)
+        if mask is not None:
+            matching_results.metadata.set_item('Indexation.navigation_mask',
+                                               mask)
+        return matching_results
+
+    def correlate_in_plane(self,
+                           n_largest=5,
+                           keys=[],
+                           dr=1,
+                           dt=None,
+                           **kwargs):
+        """Correlates the library with the electron diffraction signal at all
+        in-plane rotations at once.
+
+        Diffraction patterns that differ only by a rotation about the beam
+        direction are rotated copies of one another, so the library need only
+        contain one template per out-of-plane orientation, i.e. Euler angles
+        with a first angle of zero. Templates and patterns are reprojected in
+        polar coordinates, and the templates are correlated with the patterns
+        at every in-plane rotation by FFT along the angular axis. The angular
+        resolution of the search is that of the polar grid.
+
+        Parameters
+        ----------
+        n_largest : int
+            The n orientations with the highest correlation values are returned.
+        keys : list
+            The phases to index, as in the correlate method.
+        dr : float
+            Radial coordinate spacing of the polar reprojection, in pixels.
+        dt : float
+            Angular coordinate spacing of the polar reprojection, in radians.
+            Defaults to giving as many angles as the pattern's largest side.
+        **kwargs
+            Keyword arguments passed to the HyperSpy map() function.
+
+        Returns
+        -------
+        matching_results : pyxem.signals.indexation_results.IndexationResults
+            Matching results with the layout of the correlate method. The
+            in-plane rotation of the best match is added to the first Euler
+            angle of each template.
+
+        """
+        signal = self.signal
+        template_bank = self.library.get_template_bank(keys)
+        polar_templates = get_polar_templates(
+            template_bank, signal.axes_manager.signal_shape[::-1], dr, dt)
+        matching_results = signal.map(correlate_library_in_plane,
+                                      template_bank=template_bank,
+                                      polar_templates=polar_templates,
+                                      n_largest=n_largest,
+                                      dr=dr, dt=dt,
                                       inplace=False,
                                       **kwargs)
         return IndexationResults(matching_results)
 
+    def correlate_hierarchical(self,
+                               library_generator,
+                               structure_library,
+                               calibration,
+                               reciprocal_radius,
+                               half_shape,
+                               coarse_resolution,
+                               fine_resolution,
+                               n_coarse=3,
+                               n_largest=5,
+                               keys=[],
+                               fine_library=None,
+                               with_direct_beam=True):
+        """Correlates the electron diffraction signal with the library in a
+        coarse-to-fine orientation search.
+
+        Each diffraction pattern is first correlated with the (coarse) library
+        of the generator. The `n_coarse` best orientations of each phase are
+        then refined by correlating the pattern with the templates of a finer
+        Euler angle grid in their neighbourhood only. Fine templates are looked
+        up in `fine_library`, and those not yet present for any pattern are
+        simulated with a single call of `library_generator`.
+
+        Parameters
+        ----------
+        library_generator : DiffractionLibraryGenerator
+            The generator used to simulate fine templates on demand.
+        structure_library : dict
+            Dictionary of structures, as passed to
+            :meth:`DiffractionLibraryGenerator.get_diffraction_library`. Only
+            the structures are used; orientations are ignored.
+        calibration : float
+            The calibration of the experimental data, in reciprocal Angstroms
+            per pixel.
+        reciprocal_radius : float
+            The maximum g-vector magnitude to be included in the simulations.
+        half_shape : tuple
+            The half shape of the diffraction patterns.
+        coarse_resolution : float
+            The angular resolution of the coarse library in degrees. The fine
+            search covers half of it on either side of each coarse match.
+        fine_resolution : float
+            The angular resolution of the fine search in degrees.
+        n_coarse : int
+            The number of coarse matches of each phase that are refined.
+        n_largest : int
+            The n orientations with the highest correlation values are
+            returned.
+        keys : list
+            The phases to index, as in the correlate method.
+        fine_library : DiffractionLibrary, optional
+            A library of fine templates, simulated on the grid of
+            :func:`pyxem.utils.sim_utils.local_euler_grid`, in which templates
+            are looked up before simulating them. It is extended in place with
+            any template simulated during the search.
+        with_direct_beam : bool
+            Whether the direct beam is included in the fine templates.
+
+        Returns
+        -------
+        matching_results : pyxem.signals.indexation_results.IndexationResults
+            Matching results with the layout of the correlate method.
+
+        """
+        coarse_bank = self.library.get_template_bank(keys)
+        keys = coarse_bank.keys
+        if fine_library is None:
+            fine_library = DiffractionLibrary()
+        # Orientations already simulated.
+        simulated = {key: set(fine_library.get(key, {})) for key in keys}
+
+        def get_candidates(coarse_matches, i):
+            candidates = set()
+            for match in coarse_matches[coarse_matches[:, 0] == i]:
+                grid = local_euler_grid(match[1:4], coarse_resolution / 2,
+                                        fine_resolution)
+                candidates.update(tuple(o) for o in grid)
+            return candidates
+
+        data = self.signal.data
+        frames = data.reshape((-1,) + data.shape[-2:])
+        # Find the coarse matches of every frame first, so that the missing
+        # fine templates of the whole signal are simulated in a single call.
+        coarse_matches = np.array([get_top_correlations(
+            correlate_template_bank(np.asarray(frame),
+                                    coarse_bank)[np.newaxis],
+            coarse_bank, n_coarse)[0] for frame in frames])
+        missing = {key: set() for key in keys}
+        for frame_matches in coarse_matches:
+            for i, key in enumerate(keys):
+                missing[key].update(get_candidates(frame_matches, i) -
+                                    simulated[key])
+        missing_library = {key: (structure_library[key][0],
+                                 sorted(orientations))
+                           for key, orientations in missing.items()
+                           if orientations}
+        if missing_library:
+            new_templates = library_generator.get_diffraction_library(
+                missing_library, calibration, reciprocal_radius, half_shape,
+                'euler', with_direct_beam)
+            for key in missing_library:
+                fine_library.setdefault(key, {}).update(
+                    new_templates.get(key, {}))
+
+        matching_results = []
+        for frame, frame_matches in zip(frames, coarse_matches):
+            candidate_library = DiffractionLibrary()
+            for i, key in enumerate(keys):
+                phase_library = fine_library.get(key, {})
+                candidate_library[key] = {
+                    o: phase_library[o]
+                    for o in sorted(get_candidates(frame_matches, i))
+                    if o in phase_library}
+            candidate_bank = candidate_library.get_template_bank(keys)
+            matching_results.append(correlate_library(
+                np.asarray(frame), candidate_bank, n_largest))
+        matching_results = np.array(matching_results)
+        return self._get_indexation_results(
+            matching_results.reshape(data.shape[:-2] +
+                                     matching_results.shape[1:]))
+
+    def refine_orientations(self,
+                            matching_results,
+                            structure_library,
+                            diffraction_generator,
+                            calibration,
+                            reciprocal_radius,
+                            half_shape,
+                            resolution,
+                            n_refine=1,
+                            keys=[],
+                            tolerance=0.01,
+                            workers=None,
+                            with_direct_beam=True):
+        """Refines the orientations found by template matching beyond the
+        resolution of the library.
+
+        The `n_refine` best matches of each diffraction pattern are used as
+        starting points of a local optimisation of the Euler angles, which
+        maximises the correlation between the pattern and the simulation of
+        the matched structure at a continuous orientation (see
+        :func:`correlate_orientation`). The structure factors of each
+        structure are cached by `diffraction_generator`, so that each
+        evaluation only computes the excitation errors of the rotated
+        reciprocal lattice.
+
+        Parameters
+        ----------
+        matching_results : IndexationResults
+            The results of template matching of this signal, e.g. returned by
+            the correlate method.
+        structure_library : dict
+            Dictionary of structures, as passed to
+            :meth:`DiffractionLibraryGenerator.get_diffraction_library`. Only
+            the structures are used; orientations are ignored.
+        diffraction_generator : DiffractionGenerator
+            The calculator used to simulate the diffraction patterns.
+        calibration : float
+            The calibration of the experimental data, in reciprocal Angstroms
+            per pixel.
+        reciprocal_radius : float
+            The maximum g-vector magnitude to be included in the simulations.
+        half_shape : tuple
+            The half shape of the diffraction patterns.
+        resolution : float
+            The angular resolution of the library in degrees, which sets the
+            initial step of the optimisation.
+        n_refine : int
+            The number of best matches of each pattern that are refined.
+        keys : list
+            The phases in the order of their phase index in
+            `matching_results`, as passed to the correlate method.
+        tolerance : float
+            The precision, in degrees, to which the Euler angles are optimised.
+        workers : int, optional
+            If specified, the navigation space is split into chunks that are
+            refined by this many worker processes.
+        with_direct_beam : bool
+            Whether the direct beam is included in the simulations.
+
+        Returns
+        -------
+        refined_results : pyxem.signals.indexation_results.IndexationResults
+            The `n_refine` refined matches of each pattern, sorted by
+            decreasing correlation, with the layout of the correlate method.
+
+        """
+        keys = keys or list(self.library.keys())
+        kwargs = {'structures': [structure_library[key][0] for key in keys],
+                  'diffraction_generator': diffraction_generator,
+                  'calibration': calibration,
+                  'reciprocal_radius': reciprocal_radius,
+                  'half_shape': half_shape,
+                  'resolution': resolution,
+                  'tolerance': tolerance,
+                  'with_direct_beam': with_direct_beam}
+        frames, indices = self._get_frames(None)
+        matches = np.asarray(matching_results.data)
+        matches = matches.reshape((-1,) + matches.shape[-2:])
+        # Keep the n_refine best matches of every pattern, over all phases.
+        order = np.argsort(-matches[:, :, 4], axis=1)[:, :n_refine]
+        matches = matches[np.arange(len(matches))[:, np.newaxis], order]
+        if workers:
+            n_chunks = min(len(indices), 4 * workers)
+            bounds = np.linspace(0, len(indices), n_chunks + 1).astype(int)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(
+                    _refine_frames, np.asarray(frames[start:stop]),
+                    matches[start:stop], **kwargs)
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+                refined_matches = [future.result() for future in futures]
+        else:
+            refined_matches = [_refine_frames(frames, matches, **kwargs)]
+        refined_results = self._get_indexation_results(
+            refined_matches, indices, n_rows=matches.shape[1])
+        if matching_results.metadata.has_item('Indexation.navigation_mask'):
+            refined_results.metadata.set_item(
+                'Indexation.navigation_mask',
+                matching_results.metadata.Indexation.navigation_mask)
+        return refined_results
+
+    def _get_navigation_mask(self, mask):
+        """Validates a navigation mask against the signal, returning it as a
+        boolean array with the navigation shape of the data, or None.
+        """
+        if mask is None:
+            return None
+        if isinstance(mask, BaseSignal):
+            mask = mask.data
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != self.signal.data.shape[:-2]:
+            raise ValueError("The navigation mask must have the navigation "
+                             "shape of the signal, {}, but has shape {}."
+                             .format(self.signal.data.shape[:-2], mask.shape))
+        return mask
+
+    def _get_cache_sources(self, mask, binning, n_levels, block_size=1024):
+        """The flattened index of the pattern whose results each pattern
+        reuses, which is the first unmasked pattern with the same fingerprint,
+        or the pattern itself.
+        """
+        frames, indices = self._get_frames(mask)
+        step = 0.
+        for start in range(0, len(indices), block_size):
+            block = frames[indices[start:start + block_size]]
+            step = max(step, bin_frames(block, binning).max())
+        # The step is zero if every pattern is zero.
+        step = step / n_levels or 1.
+        sources = np.arange(len(frames))
+        first_frames = {}
+        for start in range(0, len(indices), block_size):
+            block_indices = indices[start:start + block_size]
+            fingerprints = get_frame_fingerprints(
+                np.asarray(frames[block_indices]), binning, step)
+            for index, fingerprint in zip(block_indices, fingerprints):
+                sources[index] = first_frames.setdefault(fingerprint, index)
+        return sources
+
+    def _get_frames(self, mask):
+        """The signal data as a stack of diffraction patterns, with the
+        indices of the patterns to be scored.
+        """
+        data = self.signal.data
+        frames = data.reshape((-1,) + data.shape[-2:])
+        if mask is None:
+            return frames, np.arange(len(frames))
+        return frames, np.flatnonzero(~mask.ravel())
+
+    def _correlate_batches(self, template_bank, n_largest, batch_size,
+                           normalize, mask):
+        """Scores the signal against a template bank in blocks of patterns.
+        See the correlate method for details.
+        """
+        frames, indices = self._get_frames(mask)
+        matching_results = []
+        for start in range(0, len(indices), batch_size):
+            block = np.asarray(frames[indices[start:start + batch_size]])
+            correlations = correlate_template_bank_batch(block, template_bank)
+            if normalize:
+                correlations = normalize_correlations(correlations, block,
+                                                      template_bank)
+            matching_results.append(
+                get_top_correlations(correlations, template_bank, n_largest))
+        return self._get_indexation_results(matching_results, indices,
+                                            template_bank, n_largest, mask)
+
+    def _correlate_lazy(self, template_bank, n_largest, normalize, filename,
+                        mask):
+        """Scores a lazy signal against a template bank one dask chunk at a
+        time. See the correlate method for details.
+        """
+        data = self.signal.data
+        navigation_dimension = data.ndim - 2
+        # Every chunk must hold whole diffraction patterns.
+        data = data.rechunk({navigation_dimension: -1,
+                             navigation_dimension + 1: -1})
+        if mask is None:
+            mask = np.zeros(data.shape[:-2], dtype=bool)
+        mask = da.from_array(mask[..., np.newaxis, np.newaxis],
+                             chunks=data.chunks[:-2] + ((1,), (1,)))
+        n_rows = n_largest * len(template_bank.keys)
+        matching_results = da.map_blocks(
+            _correlate_block,
+            data, mask,
+            template_bank=template_bank,
+            n_largest=n_largest,
+            normalize=normalize,
+            chunks=data.chunks[:navigation_dimension] + ((n_rows,), (5,)),
+            dtype=float)
+        if filename is not None:
+            with h5py.File(filename, 'w') as results_file:
+                dataset = results_file.create_dataset(
+                    'matching_results', shape=matching_results.shape,
+                    dtype=matching_results.dtype,
+                    chunks=tuple(c[0] for c in matching_results.chunks))
+                da.store(matching_results, dataset)
+            matching_results = da.from_array(
+                _HDF5Dataset(filename, 'matching_results'),
+                chunks=matching_results.chunks)
+        matching_results = LazyIndexationResults(matching_results)
+        matching_results.axes_manager.update_axes_attributes_from(
+            self.signal.axes_manager.navigation_axes,
+            ['scale', 'offset', 'units', 'name'])
+        return matching_results
+
+    def _correlate_pruned(self, template_bank, n_largest, mask):
+        """Scores the signal against a template bank, skipping templates that
+        cannot be among the best matches. See the correlate method for details.
+        """
+        frames, indices = self._get_frames(mask)
+        matching_results = []
+        n_pruned = 0
+        for index in indices:
+            frame_results, frame_pruned = get_top_correlations_pruned(
+                np.asarray(frames[index]), template_bank, n_largest)
+            matching_results.append(frame_results[np.newaxis])
+            n_pruned += frame_pruned
+        matching_results = self._get_indexation_results(
+            matching_results, indices, template_bank, n_largest, mask)
+        matching_results.metadata.set_item('Indexation.pruned_templates',
+                                           n_pruned)
+        matching_results.metadata.set_item(
+            'Indexation.pruned_fraction',
+            n_pruned / max(len(indices) * template_bank.n_templates, 1))
+        return matching_results
+
+    def _correlate_parallel(self, template_bank, n_largest, batch_size,
+                            workers, normalize, mask):
+        """Scores the signal against a template bank in a pool of worker
+        processes. See the correlate method for details.
+        """
+        frames, indices = self._get_frames(mask)
+        # Several chunks per worker keep the pool busy when chunks take
+        # unequal times to score.
+        n_chunks = min(len(indices), 4 * workers)
+        bounds = np.linspace(0, len(indices), n_chunks + 1).astype(int)
+        with tempfile.TemporaryDirectory() as directory:
+            template_bank.save(directory)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(
+                    _correlate_frames, np.asarray(frames[indices[start:stop]]),
+                    directory, n_largest, batch_size, normalize)
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+                matching_results = [future.result() for future in futures]
+        return self._get_indexation_results(matching_results, indices,
+                                            template_bank, n_largest, mask)
+
+    def _get_indexation_results(self, matching_results, indices=None,
+                                template_bank=None, n_largest=None,
+                                mask=None, n_rows=None):
+        """Wraps matching results as IndexationResults with the navigation
+        shape of the signal, calibrated like the signal.
+
+        `matching_results` is either an array with the navigation shape of the
+        signal, or a list of blocks of results for the flattened navigation
+        positions `indices`, in which case the positions that were not scored
+        are filled with NaN.
+        """
+        if indices is not None:
+            navigation_shape = self.signal.data.shape[:-2]
+            if n_rows is None:
+                n_rows = n_largest * len(template_bank.keys)
+            results = np.full((int(np.prod(navigation_shape)), n_rows, 5),
+                              np.nan)
+            if len(indices):
+                results[indices] = np.concatenate(matching_results)
+            matching_results = results.reshape(navigation_shape +
+                                               (n_rows, 5))
+        matching_results = IndexationResults(matching_results)
+        matching_results.axes_manager.update_axes_attributes_from(
+            self.signal.axes_manager.navigation_axes,
+            ['scale', 'offset', 'units', 'name'])
+        if mask is not None:
+            matching_results.metadata.set_item('Indexation.navigation_mask',
+                                               mask)
+        return matching_results
+
+
+class _HDF5Dataset(object):
+    """Read-only access to a dataset of an HDF5 file, which is opened only for
+    the duration of each read, so that no handle on the file is kept."""
 
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        with h5py.File(filename, 'r') as f:
+            self.shape = f[name].shape
+            self.dtype = f[name].dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        with h5py.File(self.filename, 'r') as f:
+            return f[self.name][key]
+
+
+class VectorIndexationGenerator():
+    """Generates an indexer for diffraction vectors, e.g. found with
+    :meth:`ElectronDiffraction.find_peaks`, which matches them with the
+    simulated spots of a library.
+
+    The reciprocal coordinates of the spots of every simulation in the library
+    are gathered into a single KD-tree when the indexer is created, so that
+    each diffraction vector is matched by one query of the tree rather than
+    by comparison with every template.
+
+    Parameters
+    ----------
+    vectors : DiffractionVectors
+        The diffraction vectors of each pattern, in reciprocal Angstroms, with
+        the axis order of the simulation coordinates.
+    library : DiffractionLibrary
+        The library of simulated diffraction patterns for indexation.
+    keys : list
+        The phases to index, as in the correlate method of
+        IndexationGenerator.
+
+    """
+    def __init__(self, vectors, library, keys=[]):
+        self.vectors = vectors
+        self.library = library
+        self.template_bank = library.get_template_bank(keys)
+        coordinates = [pattern['Sim'].coordinates[:, :2]
+                       for key in self.template_bank.keys
+                       for pattern in library[key].values()]
+        # The simulations of a recalibrated library may hold more spots than
+        # its templates, so spots are mapped to templates by their own counts.
+        self.spot_templates = np.repeat(np.arange(len(coordinates)),
+                                        [len(c) for c in coordinates])
+        if coordinates:
+            coordinates = np.concatenate(coordinates)
+        else:
+            coordinates = np.zeros((0, 2))
+        self.spot_tree = cKDTree(coordinates)
+
+    def index_vectors(self, distance_threshold, n_largest=5):
+        """Matches the diffraction vectors of each pattern with the library.
+
+        Parameters
+        ----------
+        distance_threshold : float
+            The maximum distance between a diffraction vector and a simulated
+            spot for them to match, in reciprocal Angstroms.
+        n_largest : int
+            The n orientations with the highest scores are returned for each
+            phase.
+
+        Returns
+        -------
+        matching_results : pyxem.signals.indexation_results.IndexationResults
+            Matching results with the layout of the correlate method of
+            IndexationGenerator. The score of each orientation is the number
+            of matched vectors, less their mean distance to the matched spots
+            as a fraction of `distance_threshold`; see
+            :func:`pyxem.utils.indexation_utils.match_vectors`.
+
+        """
+        vectors = self.vectors.data
+        n_rows = n_largest * len(self.template_bank.keys)
+        matching_results = np.zeros(vectors.shape + (n_rows, 5))
+        for index in np.ndindex(vectors.shape):
+            matching_results[index] = match_vectors(vectors[index],
+                                                    self.spot_tree,
+                                                    self.template_bank,
+                                                    distance_threshold,
+                                                    n_largest,
+                                                    self.spot_templates)
+        matching_results = IndexationResults(matching_results)
+        matching_results.axes_manager.update_axes_attributes_from(
+            self.vectors.axes_manager.navigation_axes,
+            ['scale', 'offset', 'units', 'name'])
+        return matching_results
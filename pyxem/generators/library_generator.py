@@ -20,15 +20,305 @@
 
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
 import numpy as np
-from pymatgen.transformations.standard_transformations \
-    import RotationTransformation
-from pyxem.signals.diffraction_library import DiffractionLibrary
-from scipy.constants import pi
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from pyxem.signals.diffraction_library import DiffractionLibrary, \
+    extend_saved_library, load_diffraction_library, _in_patterns, \
+    _parameters_match, _to_json_types
+from pyxem.utils.sim_utils import get_orientation_matrix, \
+    get_symmetry_classes
 from tqdm import tqdm
-from transforms3d.euler import euler2axangle
 
 
+def get_library_hash(structure_library, parameters):
+    """A content hash of the inputs of a library simulation.
+
+    Parameters
+    ----------
+    structure_library : dict
+        Dictionary of structures and associated orientations, as passed to
+        :meth:`DiffractionLibraryGenerator.get_diffraction_library`.
+    parameters : dict
+        The simulation parameters, such as those recorded in
+        :attr:`DiffractionLibrary.parameters`. Values must be serializable
+        as JSON, numpy scalars and arrays being hashed as the built-in
+        values they equal.
+
+    Returns
+    -------
+    library_hash : str
+        The hexadecimal SHA-256 digest of the lattice, sites and orientations
+        of every phase, in order, and of the parameters.
+
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(_to_json_types(parameters),
+                             sort_keys=True).encode())
+    for key, (structure, orientations) in structure_library.items():
+        digest.update(json.dumps(str(key)).encode())
+        digest.update(np.ascontiguousarray(structure.lattice.matrix,
+                                           dtype=np.float64).tobytes())
+        for site in structure:
+            digest.update(json.dumps(sorted(
+                (str(sp), occu)
+                for sp, occu in site.species_and_occu.items())).encode())
+            digest.update(np.ascontiguousarray(site.frac_coords,
+                                               dtype=np.float64).tobytes())
+        orientations = np.ascontiguousarray(orientations, dtype=np.float64)
+        digest.update(str(orientations.shape).encode())
+        digest.update(orientations.tobytes())
+    return digest.hexdigest()
+
+
+def _get_directory_size(directory):
+    """The total size in bytes of the files in a directory."""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names)
+
+
+class LibraryCache(object):
+    """A directory of saved diffraction libraries, looked up by the content
+    hash of their simulation inputs (see :func:`get_library_hash`).
+
+    Every library is stored in a subdirectory named after its hash, in the
+    format of :meth:`DiffractionLibrary.save`. When the libraries exceed the
+    maximum size, those least recently used are evicted.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups that found a library in the cache.
+    misses : int
+        The number of lookups that did not.
+    """
+
+    def __init__(self, directory, max_size=None, mmap_mode='r'):
+        """Opens a library cache, creating its directory if needed.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the cache.
+        max_size : int, optional
+            The maximum total size of the cached libraries in bytes. Defaults
+            to no limit.
+        mmap_mode : {None, 'r', 'r+', 'c'}
+            The mode in which libraries are loaded from the cache, see
+            :func:`load_diffraction_library`.
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _entries(self):
+        """The hashes of the cached libraries, least recently used first."""
+        entries = [name for name in os.listdir(self.directory)
+                   if os.path.isfile(os.path.join(self.directory, name,
+                                                  'library.json'))]
+        return sorted(entries, key=lambda name: os.path.getmtime(
+            os.path.join(self.directory, name)))
+
+    def __contains__(self, library_hash):
+        return os.path.isfile(os.path.join(self.directory, library_hash,
+                                           'library.json'))
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def size(self):
+        """The total size of the cached libraries in bytes."""
+        return _get_directory_size(self.directory)
+
+    @property
+    def statistics(self):
+        """A dictionary of the hits, misses, hit rate, number of libraries and
+        size of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'entries': len(self),
+                'size': self.size}
+
+    def get(self, library_hash):
+        """Loads a cached library, marking it as the most recently used.
+
+        Parameters
+        ----------
+        library_hash : str
+            The content hash of the library.
+
+        Returns
+        -------
+        diffraction_library : :class:`DiffractionLibrary` or None
+            The cached library, or None if it is not in the cache.
+
+        """
+        if library_hash not in self:
+            self.misses += 1
+            return None
+        self.hits += 1
+        directory = os.path.join(self.directory, library_hash)
+        os.utime(directory)
+        return load_diffraction_library(directory, mmap_mode=self.mmap_mode)
+
+    def put(self, library_hash, diffraction_library):
+        """Saves a library in the cache and evicts the least recently used
+        libraries until the cache fits its maximum size.
+
+        Parameters
+        ----------
+        library_hash : str
+            The content hash of the library.
+        diffraction_library : :class:`DiffractionLibrary`
+            The library to cache.
+
+        """
+        directory = os.path.join(self.directory, library_hash)
+        # Save to a temporary directory first, so that a library is never
+        # seen half-written by another process using the same cache.
+        temporary = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            diffraction_library.save(temporary)
+            if library_hash in self:
+                shutil.rmtree(directory)
+            os.rename(temporary, directory)
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+        self.evict(keep=library_hash)
+
+    def evict(self, keep=None):
+        """Deletes the least recently used libraries until the cache fits its
+        maximum size.
+
+        Parameters
+        ----------
+        keep : str, optional
+            The hash of a library never to evict, such as the one just added.
+
+        """
+        if self.max_size is None:
+            return
+        sizes = [(name, _get_directory_size(os.path.join(self.directory,
+                                                         name)))
+                 for name in self._entries()]
+        total = sum(size for _, size in sizes)
+        for name, size in sizes:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Deletes every cached library and resets the statistics."""
+        for name in self._entries():
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+        self.hits = 0
+        self.misses = 0
+
+
+def _get_proper_rotations(structure):
+    """The proper rotations of the point group of a structure as Cartesian
+    matrices."""
+    return [op.rotation_matrix for op in
+            SpacegroupAnalyzer(structure).get_point_group_operations(
+                cartesian=True)
+            if np.linalg.det(op.rotation_matrix) > 0]
+
+
+def _simulate_orientations(diffractor, structure, orientations, calibration,
+                           reciprocal_radius, half_shape, representation,
+                           with_direct_beam):
+    """Simulates the library entries of a structure at a list of orientations.
+
+    Returns a list of (orientation, entry) pairs, where the entry is None for
+    patterns without peaks. Spots outside the (2 * half_shape) patterns are
+    left out of the templates, as by :meth:`DiffractionLibrary.recalibrate`.
+    """
+    rotation_matrices = [get_orientation_matrix(orientation, representation)
+                         for orientation in orientations]
+    simulations = []
+    if not rotation_matrices:
+        return simulations
+    # Calculate electron diffraction for all rotations of the structure
+    patterns = diffractor.calculate_ed_data_batch(structure,
+                                                  rotation_matrices,
+                                                  reciprocal_radius,
+                                                  with_direct_beam)
+    for orientation, data in zip(orientations, patterns):
+        # Calibrate simulation
+        data.calibration = calibration
+        pixel_coordinates = np.rint(
+            data.calibrated_coordinates[:, :2] + half_shape).astype(int)
+        inside = _in_patterns(pixel_coordinates, half_shape)
+        pattern_intensities = data.intensities[inside]
+        simulation = None
+        if len(data.intensities) > 0:
+            # Templates left without spots score zero.
+            pattern_norm = np.sqrt(np.dot(pattern_intensities,
+                                          pattern_intensities)) or 1.
+            simulation = {
+                'Sim': data, 'intensities': pattern_intensities,
+                'pixel_coords': pixel_coordinates[inside],
+                'pattern_norm': pattern_norm}
+        simulations.append((tuple(orientation), simulation))
+    return simulations
+
+
+def _simulate_chunks(diffractor, structure_library, phase_orientations,
+                     workers, chunk_size, *args):
+    """Simulates the orientations of every phase in chunks, in a pool of
+    worker processes if `workers` is given, returning the simulations of each
+    phase in order.
+    """
+    chunks = [(key, orientations[start:start + chunk_size])
+              for key, orientations in phase_orientations
+              for start in range(0, len(orientations), chunk_size)]
+    total = sum(len(orientations) for _, orientations in chunks)
+    with tqdm(total=total, leave=False) as progress:
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_simulate_orientations, diffractor,
+                                           structure_library[key][0],
+                                           orientations, *args)
+                           for key, orientations in chunks]
+                sizes = {future: len(chunk[1])
+                         for future, chunk in zip(futures, chunks)}
+                # Report progress as chunks finish, in whatever order they do.
+                for future in as_completed(futures):
+                    progress.update(sizes[future])
+                results = [future.result() for future in futures]
+        else:
+            results = []
+            for key, orientations in chunks:
+                results.append(_simulate_orientations(
+                    diffractor, structure_library[key][0], orientations,
+                    *args))
+                progress.update(len(orientations))
+    return [(key, [simulation
+                   for (chunk_key, _), chunk_results in zip(chunks, results)
+                   if chunk_key == key
+                   for simulation in chunk_results])
+            for key, _ in phase_orientations]
+
 
 class DiffractionLibraryGenerator(object):
     """
@@ -36,16 +326,32 @@ class DiffractionLibraryGenerator(object):
     structures and orientations.
     """
 
-    def __init__(self, electron_diffraction_calculator):
+    def __init__(self, electron_diffraction_calculator, cache=None):
         """Initialises the library with a diffraction calculator.
 
         Parameters
         ----------
         electron_diffraction_calculator : :class:`DiffractionGenerator`
             The calculator used for the diffraction patterns.
+        cache : :class:`LibraryCache` or str, optional
+            A cache, or the directory of a cache, in which libraries are
+            looked up by the content hash of their inputs before being
+            simulated, and saved after.
 
         """
         self.electron_diffraction_calculator = electron_diffraction_calculator
+        if isinstance(cache, str):
+            cache = LibraryCache(cache)
+        self.cache = cache
+
+    def _get_parameters(self):
+        """The settings of the diffraction calculator to record in a
+        library."""
+        diffractor = self.electron_diffraction_calculator
+        return {'accelerating_voltage': diffractor.accelerating_voltage,
+                'max_excitation_error': diffractor.max_excitation_error,
+                'debye_waller_factors': dict(
+                    diffractor.debye_waller_factors)}
 
     def get_diffraction_library(self,
                                 structure_library,
@@ -53,7 +359,10 @@ class DiffractionLibraryGenerator(object):
                                 reciprocal_radius,
                                 half_shape,
                                 representation='euler',
-				with_direct_beam=True
+				with_direct_beam=True,
+                                reduce_symmetry=False,
+                                workers=None,
+                                chunk_size=100
                                 ):
         """Calculates a dictionary of diffraction data for a library of crystal
         structures and orientations.
@@ -82,7 +391,32 @@ class DiffractionLibraryGenerator(object):
 
         half_shape: tuple
             The half shape of the target patterns, for 144x144 use (72,72) etc
-        
+
+        reduce_symmetry : bool
+            If True, orientations that are equivalent under the proper
+            rotations of a structure's point group, found with pymatgen's
+            SpacegroupAnalyzer, are simulated only once, for the first of them
+            in the list of orientations. The equivalent orientations of each
+            simulated orientation are stored in the `symmetry_map` of the
+            library, see
+            :meth:`DiffractionLibrary.get_equivalent_orientations`.
+
+        workers : int, optional
+            If specified, the chunks of orientations are simulated by this
+            many worker processes. The library is the same as when simulating
+            in a single process, with orientations in the order they were
+            given.
+
+        chunk_size : int
+            The number of orientations simulated at a time. The reciprocal
+            lattice and structure factors of a structure are computed once per
+            chunk, and all orientations of the chunk are then simulated at
+            once, see :meth:`DiffractionGenerator.calculate_ed_data_batch`.
+
+        If the generator has a cache, a library simulated before from the same
+        structures, orientations and parameters is loaded from it rather than
+        simulated again.
+
         Returns
         -------
         diffraction_library : dict of :class:`DiffractionSimulation`
@@ -94,38 +428,172 @@ class DiffractionLibraryGenerator(object):
         diffraction_library = DiffractionLibrary()
         # The electron diffraction calculator to do simulations
         diffractor = self.electron_diffraction_calculator
+        # Record the parameters of the simulations, so that the library can
+        # be checked against the data it is used with. Numpy scalars, as in
+        # a half shape computed from the shape of the data, are recorded as
+        # the built-in types they save as.
+        diffraction_library.parameters = _to_json_types(dict(
+            self._get_parameters(),
+            calibration=calibration,
+            reciprocal_radius=reciprocal_radius,
+            half_shape=half_shape,
+            representation=representation,
+            with_direct_beam=with_direct_beam))
+        if self.cache is not None:
+            library_hash = get_library_hash(
+                structure_library,
+                dict(diffraction_library.parameters,
+                     reduce_symmetry=reduce_symmetry))
+            cached_library = self.cache.get(library_hash)
+            if cached_library is not None:
+                return cached_library
         # Iterate through phases in library.
+        phase_orientations = []
         for key in structure_library.keys():
-            phase_diffraction_library = dict()
             structure = structure_library[key][0]
             orientations = structure_library[key][1]
-            # Iterate through orientations of each phase.
-            for orientation in tqdm(orientations, leave=False):
-                if representation == 'axis-angle':
-                    axis = [orientation[0], orientation[1], orientation[2]]
-                    angle = orientation[3] / 180 * pi
-                if representation == 'euler':
-                    axis, angle = euler2axangle(orientation[0], orientation[1],
-                                                orientation[2], 'rzxz')
-                # Apply rotation to the structure
-                rotation = RotationTransformation(axis, angle,
-                                                  angle_in_radians=True)
-                rotated_structure = rotation.apply_transformation(structure)
-                # Calculate electron diffraction for rotated structure
-                data = diffractor.calculate_ed_data(rotated_structure,
-                                                    reciprocal_radius,
-						    with_direct_beam)
-                # Calibrate simulation
-                data.calibration = calibration
-                pattern_intensities = data.intensities
-                pixel_coordinates = np.rint(data.calibrated_coordinates[:,:2]+half_shape).astype(int)
-                # Construct diffraction simulation library, removing those that contain no peaks
-                if len(pattern_intensities) > 0:
-                    phase_diffraction_library[tuple(orientation)] = \
-                    {'Sim':data,'intensities':pattern_intensities, \
-                     'pixel_coords':pixel_coordinates, \
-                     'pattern_norm': np.sqrt(np.dot(pattern_intensities,pattern_intensities))}
-                    diffraction_library[key] = phase_diffraction_library
+            if reduce_symmetry:
+                symmetry_classes = get_symmetry_classes(
+                    orientations, _get_proper_rotations(structure),
+                    representation)
+                diffraction_library.symmetry_map[key] = symmetry_classes
+                orientations = list(symmetry_classes)
+            phase_orientations.append((key, orientations))
+        simulations = _simulate_chunks(diffractor, structure_library,
+                                       phase_orientations, workers,
+                                       chunk_size, calibration,
+                                       reciprocal_radius, half_shape,
+                                       representation, with_direct_beam)
+        for key, phase_simulations in simulations:
+            # Construct diffraction simulation library, removing those that
+            # contain no peaks
+            phase_diffraction_library = {
+                orientation: simulation
+                for orientation, simulation in phase_simulations
+                if simulation is not None}
+            if phase_diffraction_library:
+                diffraction_library[key] = phase_diffraction_library
+        if self.cache is not None:
+            self.cache.put(library_hash, diffraction_library)
         return diffraction_library
 
+    def extend_diffraction_library(self,
+                                   diffraction_library,
+                                   structure_library,
+                                   reduce_symmetry=False,
+                                   workers=None,
+                                   chunk_size=100):
+        """Adds the phases and orientations of a structure library that are
+        not yet in a diffraction library, simulating only those.
 
+        The simulations use the calibration, reciprocal radius, half shape,
+        representation and direct beam setting recorded in the library, and
+        the offset of a library that was recalibrated, see
+        :meth:`DiffractionLibrary.recalibrate`.
+
+        Parameters
+        ----------
+        diffraction_library : :class:`DiffractionLibrary` or str
+            The library to extend in place, or the directory of a library
+            saved with :meth:`DiffractionLibrary.save`, whose files are
+            extended in place, see
+            :func:`pyxem.signals.diffraction_library.extend_saved_library`.
+
+        structure_library : dict
+            Dictionary of structures and associated orientations, as for
+            :meth:`get_diffraction_library`. Phases of the library are
+            identified by their key, and their structure is assumed to be
+            the one the library was simulated with.
+
+        reduce_symmetry : bool
+            Whether the orientations of new phases are reduced by symmetry,
+            see :meth:`get_diffraction_library`. New orientations of a phase
+            already in the library are reduced if the phase was.
+
+        workers : int, optional
+            The number of worker processes, see :meth:`get_diffraction_library`.
+
+        chunk_size : int
+            The number of orientations simulated at a time.
+
+        Returns
+        -------
+        diffraction_library : :class:`DiffractionLibrary`
+            The extended library. A library on disk is loaded again,
+            memory-mapped, from its extended files.
+
+        Raises
+        ------
+        ValueError
+            If the library was simulated with different settings of the
+            diffraction calculator.
+
+        """
+        directory = None
+        if isinstance(diffraction_library, str):
+            directory = diffraction_library
+            diffraction_library = load_diffraction_library(directory)
+        parameters = diffraction_library.parameters
+        for name, value in self._get_parameters().items():
+            if not _parameters_match(parameters.get(name), value):
+                raise ValueError("The library was simulated with {} = {}, not "
+                                 "{}.".format(name, parameters.get(name),
+                                              value))
+        representation = parameters['representation']
+        symmetry_map = diffraction_library.symmetry_map
+        phase_orientations = []
+        for key, (structure, orientations) in structure_library.items():
+            orientations = [tuple(o) for o in orientations]
+            if key in symmetry_map or \
+                    (reduce_symmetry and key not in diffraction_library):
+                symmetry_classes = symmetry_map.get(key, {})
+                known = {o for members in symmetry_classes.values()
+                         for o in members}
+                new_orientations = [o for o in orientations if o not in known]
+                # Existing representatives come first, so that they remain
+                # the representatives of their classes.
+                new_classes = get_symmetry_classes(
+                    list(symmetry_classes) + new_orientations,
+                    _get_proper_rotations(structure), representation)
+                new_orientations = []
+                for representative, members in new_classes.items():
+                    if representative in symmetry_classes:
+                        symmetry_classes[representative] += members[1:]
+                    else:
+                        symmetry_classes[representative] = members
+                        new_orientations.append(representative)
+                symmetry_map[key] = symmetry_classes
+            else:
+                known = set(diffraction_library.get(key, {}))
+                new_orientations = []
+                for orientation in orientations:
+                    if orientation not in known:
+                        known.add(orientation)
+                        new_orientations.append(orientation)
+            phase_orientations.append((key, new_orientations))
+        simulations = _simulate_chunks(
+            self.electron_diffraction_calculator, structure_library,
+            phase_orientations, workers, chunk_size,
+            parameters['calibration'], parameters['reciprocal_radius'],
+            np.asarray(parameters['half_shape']), representation,
+            parameters['with_direct_beam'])
+        new_library = DiffractionLibrary()
+        for key, phase_simulations in simulations:
+            phase_diffraction_library = {
+                orientation: simulation
+                for orientation, simulation in phase_simulations
+                if simulation is not None}
+            if phase_diffraction_library:
+                new_library[key] = phase_diffraction_library
+        if 'offset' in parameters:
+            # Project the new templates as the recalibrated library was.
+            new_library.parameters = dict(parameters)
+            new_library.recalibrate()
+        if directory is None:
+            for key, phase_diffraction_library in new_library.items():
+                diffraction_library.setdefault(key, {}).update(
+                    phase_diffraction_library)
+            return diffraction_library
+        new_library.symmetry_map = symmetry_map
+        extend_saved_library(directory, new_library)
+        return load_diffraction_library(directory)
@@ -1,42 +1,167 @@
+from collections.abc import MutableMapping
+import io
+import json
+import os
+
+import numpy as np
+
+from pyxem.signals.diffraction_simulation import DiffractionSimulation
+from pyxem.signals.template_bank import TemplateBank, load_template_bank
+
+
 class DiffractionLibrary(dict):
     """Maps crystal structure (phase) and orientation (Euler angles or
     axis-angle pair) to simulated diffraction data.
+
+    Attributes
+    ----------
+    symmetry_map : dict
+        Maps each phase of a symmetry-reduced library to a dictionary from
+        every simulated orientation to the list of orientations equivalent to
+        it, see :meth:`DiffractionLibraryGenerator.get_diffraction_library`.
+    parameters : dict
+        The parameters of the simulation of the library, such as the
+        accelerating voltage and calibration, recorded by
+        :meth:`DiffractionLibraryGenerator.get_diffraction_library`.
     """
 
-    ## Possibly obsolete after the changes to DiffractionLibrary 
-    def set_calibration(self, calibration):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.symmetry_map = {}
+        self.parameters = {}
+        self._template_bank = None
+
+    # Replacing a phase discards the template bank kept by a loaded library.
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._template_bank = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._template_bank = None
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._template_bank = None
+
+    def set_calibration(self, calibration, half_shape=None):
         """Sets the scale of every diffraction pattern simulation in the
-        library.
+        library, and projects the templates to pixels again.
 
         Parameters
         ----------
-        calibration : {:obj:`float`, :obj:`tuple` of :obj:`float`}, optional
+        calibration : {:obj:`float`, :obj:`tuple` of :obj:`float`}
             The x- and y-scales of the patterns, with respect to the original
             reciprocal angstrom coordinates.
+        half_shape : tuple, optional
+            The half shape of the target patterns. Defaults to the half shape
+            the library was simulated with.
+
+        See also
+        --------
+        recalibrate
 
         """
-        for key in self.keys():
-            diff_lib = self[key]
-            for diffraction_pattern in diff_lib.values():
-                diffraction_pattern.calibration = calibration
+        self.recalibrate(calibration=calibration, half_shape=half_shape)
 
-    ## Again, may well be obsolete
     def set_offset(self, offset):
         """Sets the offset of every diffraction pattern simulation in the
-        library.
+        library, and projects the templates to pixels again.
 
         Parameters
         ----------
-        offset : :obj:`tuple` of :obj:`float`, optional
-            The x-y offset of the patterns in reciprocal angstroms. Defaults to
-            zero in each direction.
+        offset : :obj:`tuple` of :obj:`float`
+            The x-y offset of the patterns in reciprocal angstroms.
+
+        See also
+        --------
+        recalibrate
 
         """
         assert len(offset) == 2
-        for key in self.keys():
-            diff_lib = self[key]
-            for diffraction_pattern in diff_lib.values():
-                diffraction_pattern.offset = offset
+        self.recalibrate(offset=offset)
+
+    def recalibrate(self, calibration=None, half_shape=None, offset=None):
+        """Projects the reciprocal coordinates of every simulated spot to
+        pixels for a new calibration, half shape or offset, without
+        simulating the library again.
+
+        The pixel coordinates, intensities and pattern norms of every entry
+        are recomputed at once, dropping spots that fall outside the
+        (2 * half_shape) patterns, and the template bank used for matching is
+        rebuilt from them. Templates left without spots are kept with a
+        pattern norm of one, so that they score zero.
+
+        Parameters
+        ----------
+        calibration : {:obj:`float`, :obj:`tuple` of :obj:`float`}, optional
+            The x- and y-scales of the patterns in reciprocal angstroms per
+            pixel. Defaults to the current calibration.
+        half_shape : tuple, optional
+            The half shape of the target patterns. Defaults to the current
+            half shape.
+        offset : :obj:`tuple` of :obj:`float`, optional
+            The x-y offset of the patterns in reciprocal angstroms. Defaults
+            to the current offset.
+
+        Raises
+        ------
+        ValueError
+            If the library holds templates without simulations, or the
+            half shape is neither given nor recorded in its parameters.
+
+        """
+        parameters = self.parameters
+        if calibration is None:
+            calibration = parameters.get('calibration', 1.)
+        if half_shape is None:
+            if 'half_shape' not in parameters:
+                raise ValueError("The library does not record its half "
+                                 "shape, which must therefore be given.")
+            half_shape = parameters['half_shape']
+        if offset is None:
+            offset = parameters.get('offset', (0., 0.))
+        keys = list(self.keys())
+        patterns = [pattern for key in keys for pattern in self[key].values()]
+        if any(pattern['Sim'] is None for pattern in patterns):
+            raise ValueError("Only libraries of simulations can be "
+                             "recalibrated.")
+        for pattern in patterns:
+            pattern['Sim'].calibration = calibration
+            pattern['Sim'].offset = offset
+        parameters['calibration'] = _to_json_types(calibration)
+        parameters['half_shape'] = _to_json_types(half_shape)
+        parameters['offset'] = _to_json_types(offset)
+
+        coordinates = [np.zeros((0, 2))]
+        intensities = [np.zeros(0)]
+        for pattern in patterns:
+            coordinates.append(pattern['Sim'].coordinates[:, :2])
+            intensities.append(pattern['Sim'].intensities)
+        sizes = [len(i) for i in intensities[1:]]
+        coordinates = np.concatenate(coordinates)
+        intensities = np.concatenate(intensities)
+        half_shape = np.asarray(half_shape)
+        pixel_coords = np.rint((coordinates + offset) /
+                               np.broadcast_to(calibration, 2) +
+                               half_shape).astype(int)
+        inside = _in_patterns(pixel_coords, half_shape)
+        spot_templates = np.repeat(np.arange(len(patterns)), sizes)[inside]
+        pixel_coords = pixel_coords[inside]
+        intensities = intensities[inside]
+        offsets = np.cumsum(np.append(0, np.bincount(
+            spot_templates, minlength=len(patterns))))
+        pattern_norms = np.sqrt(np.bincount(spot_templates, intensities ** 2,
+                                            minlength=len(patterns)))
+        pattern_norms[pattern_norms == 0] = 1.
+        for i, pattern in enumerate(patterns):
+            spots = slice(offsets[i], offsets[i + 1])
+            pattern['pixel_coords'] = pixel_coords[spots]
+            pattern['intensities'] = intensities[spots]
+            pattern['pattern_norm'] = pattern_norms[i]
+        # The entries can be written to without notice from now on, so the
+        # bank is compiled from them again when needed.
+        self._template_bank = None
 
     def plot(self):
         """Plots the library interactively.
@@ -48,4 +173,466 @@ class DiffractionLibrary(dict):
                 dpi = self[key][ori]['Sim'].as_signal(128, 0.03, 1)
                 sim_diff_dat.append(dpi.data)
         ppt_test = ElectronDiffraction(sim_diff_dat)
-        ppt_test.plot()
\ No newline at end of file
+        ppt_test.plot()
+
+    def get_equivalent_orientations(self, key, orientation):
+        """The orientations of a phase equivalent by symmetry to a simulated
+        orientation.
+
+        Parameters
+        ----------
+        key : str
+            The phase.
+        orientation : tuple
+            An orientation of the library.
+
+        Returns
+        -------
+        orientations : list of tuple
+            The orientations equivalent to `orientation`, including itself. If
+            the phase was not symmetry-reduced, this is just `orientation`.
+
+        """
+        orientation = tuple(orientation)
+        return self.symmetry_map.get(key, {}).get(orientation, [orientation])
+
+    def get_template_bank(self, keys=None):
+        """Compiles the library into an array-backed template bank.
+
+        Parameters
+        ----------
+        keys : list, optional
+            The phases to include, in the order of their phase index. Defaults
+            to all phases in the order they appear in the library.
+
+        Returns
+        -------
+        template_bank : :class:`TemplateBank`
+            The templates of the library as flat arrays.
+
+        """
+        if not keys:
+            keys = list(self.keys())
+        # A library loaded from disk keeps the bank it was loaded from until
+        # any of its phases or entries is written to.
+        template_bank = self._template_bank
+        if template_bank is not None and template_bank.keys == list(keys) \
+                and np.array_equal(np.diff(template_bank.phase_offsets),
+                                   [len(self[key]) for key in keys]):
+            return template_bank
+        phase_offsets = [0]
+        orientations = []
+        pixel_coords = []
+        intensities = []
+        pattern_norms = []
+        for key in keys:
+            for orientation, pattern in self[key].items():
+                orientations.append(orientation)
+                pixel_coords.append(pattern['pixel_coords'])
+                intensities.append(pattern['intensities'])
+                pattern_norms.append(pattern['pattern_norm'])
+            phase_offsets.append(len(orientations))
+        offsets = np.cumsum([0] + [len(i) for i in intensities])
+        if orientations:
+            pixel_coords = np.concatenate(pixel_coords)
+            intensities = np.concatenate(intensities)
+        else:
+            pixel_coords = np.zeros((0, 2), dtype=int)
+            intensities = np.zeros(0)
+        return TemplateBank(keys=keys,
+                            phase_offsets=phase_offsets,
+                            orientations=np.array(orientations, dtype=float),
+                            offsets=offsets,
+                            pixel_coords=pixel_coords,
+                            intensities=intensities,
+                            pattern_norms=np.array(pattern_norms))
+
+    def save(self, directory):
+        """Saves the library as a directory of .npy files, which can be
+        loaded memory-mapped with :func:`load_diffraction_library`.
+
+        The templates are saved as a template bank (see
+        :meth:`TemplateBank.save`) together with the reciprocal coordinates,
+        Miller indices and intensities of the spots of every simulation, and
+        the symmetry map and simulation parameters of the library.
+
+        Parameters
+        ----------
+        directory : str
+            The directory in which to save the library. It is created if it
+            does not exist.
+
+        """
+        template_bank = self.get_template_bank()
+        simulations = [pattern['Sim'] for key in template_bank.keys
+                       for pattern in self[key].values()]
+        # Libraries of bare templates have no simulations to save.
+        has_simulations = all(s is not None for s in simulations)
+        with_direct_beam = True
+        if has_simulations:
+            arrays, simulation_offsets, with_direct_beam = \
+                _get_simulation_arrays(simulations)
+        # Serialized before any array is written, so that parameters which
+        # cannot be saved leave no half-written library behind.
+        contents = json.dumps({'parameters': _to_json_types(self.parameters),
+                               'symmetry_map': _serialize_symmetry_map(
+                                   self.symmetry_map),
+                               'has_simulations': has_simulations,
+                               'with_direct_beam': with_direct_beam})
+        template_bank.save(directory)
+        if has_simulations:
+            for name, array in arrays.items():
+                np.save(os.path.join(directory, name + '.npy'), array)
+            np.save(os.path.join(directory, 'simulation_offsets.npy'),
+                    simulation_offsets)
+        with open(os.path.join(directory, 'library.json'), 'w') as f:
+            f.write(contents)
+
+
+def _to_json_types(value):
+    """A simulation parameter with numpy scalars and arrays, and tuples,
+    converted to the built-in types they serialize as in JSON."""
+    if isinstance(value, dict):
+        return {key: _to_json_types(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json_types(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _in_patterns(pixel_coords, half_shape):
+    """Whether each of a list of pixel coordinates falls inside patterns of
+    (2 * half_shape) pixels."""
+    return np.all((pixel_coords >= 0) &
+                  (pixel_coords < 2 * np.asarray(half_shape)), axis=1)
+
+
+def _get_simulation_arrays(simulations):
+    """The concatenated reciprocal coordinates, Miller indices and
+    intensities of the spots of a list of simulations, the offsets of the
+    simulations into them, and whether they include the direct beam.
+    """
+    coordinates = [np.zeros((0, 3))]
+    indices = [np.zeros((0, 3))]
+    intensities = [np.zeros(0)]
+    with_direct_beam = True
+    for simulation in simulations:
+        coordinates.append(simulation.coordinates)
+        indices.append(np.asarray(
+            simulation.indices)[simulation.direct_beam_mask])
+        intensities.append(simulation.intensities)
+        with_direct_beam = simulation.with_direct_beam
+    arrays = {'coordinates': np.concatenate(coordinates),
+              'indices': np.concatenate(indices),
+              'simulation_intensities': np.concatenate(intensities)}
+    offsets = np.cumsum([0] + [len(i) for i in intensities[1:]])
+    return arrays, offsets, with_direct_beam
+
+
+def _serialize_symmetry_map(symmetry_map):
+    """The symmetry map of a library as JSON-serializable lists."""
+    return {key: [[list(representative), [list(o) for o in orientations]]
+                  for representative, orientations in classes.items()]
+            for key, classes in symmetry_map.items()}
+
+
+def _write_array_tail(filename, start, segments):
+    """Replaces the rows of a saved .npy array from `start` onwards with the
+    concatenation of `segments`.
+
+    The rows before `start` are left in place, unless the header of the file
+    grows with the new shape, in which case the whole file is rewritten.
+    """
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        header_length = f.tell()
+    tail = np.concatenate([np.asarray(segment, dtype=dtype).reshape(
+        (-1,) + tuple(shape[1:])) for segment in segments])
+    new_shape = (int(start) + len(tail),) + tuple(shape[1:])
+    header = io.BytesIO()
+    header_fields = {'descr': np.lib.format.dtype_to_descr(dtype),
+                     'fortran_order': False, 'shape': new_shape}
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(header, header_fields)
+    else:
+        np.lib.format.write_array_header_2_0(header, header_fields)
+    if fortran_order or len(header.getvalue()) != header_length:
+        head = np.array(np.load(filename, mmap_mode='r')[:start])
+        np.save(filename, np.concatenate([head, tail]))
+        return
+    row_bytes = dtype.itemsize * int(np.prod(shape[1:], dtype=int))
+    with open(filename, 'r+b') as f:
+        f.write(header.getvalue())
+        f.seek(header_length + start * row_bytes)
+        f.write(np.ascontiguousarray(tail).tobytes())
+        f.truncate()
+
+
+def extend_saved_library(directory, diffraction_library):
+    """Adds the entries of a library to a library saved with
+    :meth:`DiffractionLibrary.save`, in place.
+
+    The spots of new templates are written into the saved arrays after the
+    spots of their phase, so that only the spots of the phases after the
+    first extended phase are moved, and adding orientations to the last phase
+    or adding new phases only appends to the files. The arrays of a library
+    loaded from the directory before it was extended must not be used after.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the library was saved in.
+    diffraction_library : :class:`DiffractionLibrary`
+        The new entries, none of which may already be in the saved library,
+        with the symmetry map of the extended library.
+
+    """
+    with open(os.path.join(directory, 'library.json')) as f:
+        contents = json.load(f)
+    old_bank = load_template_bank(directory, mmap_mode='r')
+    new_keys = [key for key in diffraction_library if diffraction_library[key]]
+    keys = old_bank.keys + [key for key in new_keys
+                            if key not in old_bank.keys]
+    if not new_keys:
+        return
+    new_bank = diffraction_library.get_template_bank(new_keys)
+    # Groups of spot arrays, with the offsets of the templates into them in
+    # the saved and the new library.
+    groups = [('offsets', old_bank.offsets, new_bank.offsets,
+               {'pixel_coords': (old_bank.pixel_coords,
+                                 new_bank.pixel_coords),
+                'intensities': (old_bank.intensities,
+                                new_bank.intensities)})]
+    if contents['has_simulations']:
+        new_arrays, simulation_offsets, _ = \
+            _get_simulation_arrays([pattern['Sim'] for key in new_keys
+                                    for pattern in
+                                    diffraction_library[key].values()])
+        groups.append(('simulation_offsets',
+                       np.load(os.path.join(directory,
+                                            'simulation_offsets.npy')),
+                       simulation_offsets,
+                       {name: (np.load(os.path.join(directory, name + '.npy'),
+                                       mmap_mode='r'), new_array)
+                        for name, new_array in new_arrays.items()}))
+
+    # The ranges of templates of every phase, saved and new.
+    template_ranges = []
+    for key in keys:
+        for is_new, bank in ((False, old_bank), (True, new_bank)):
+            phase = bank.phase_slice(bank.keys.index(key)) \
+                if key in bank.keys else slice(0, 0)
+            template_ranges.append((is_new, phase.start, phase.stop))
+    # Spots before those of the first new template stay where they are.
+    first = next(i for i, (is_new, start, stop) in enumerate(template_ranges)
+                 if is_new and stop > start)
+    template_arrays = {}
+    for offsets_name, old_offsets, group_offsets, arrays in groups:
+        spot_ranges = [(is_new, (group_offsets if is_new else old_offsets)
+                        [start:stop + 1])
+                       for is_new, start, stop in template_ranges]
+        start_spot = sum(offsets[-1] - offsets[0]
+                         for is_new, offsets in spot_ranges[:first]
+                         if not is_new)
+        for name, (old_array, new_array) in arrays.items():
+            # Copy the moved spots out of the file before it is overwritten.
+            segments = [np.array((new_array if is_new else old_array)
+                                 [offsets[0]:offsets[-1]])
+                        for is_new, offsets in spot_ranges[first:]]
+            _write_array_tail(os.path.join(directory, name + '.npy'),
+                              start_spot, segments)
+        template_arrays[offsets_name] = np.cumsum(np.concatenate(
+            [[0]] + [np.diff(offsets) for _, offsets in spot_ranges]))
+
+    phase_offsets = np.cumsum([0] + [
+        sum(stop - start for _, start, stop in template_ranges[2 * i:2 * i + 2])
+        for i in range(len(keys))])
+    orientations = np.concatenate([
+        (new_bank if is_new else old_bank).orientations[start:stop]
+        for is_new, start, stop in template_ranges if stop > start])
+    pattern_norms = np.concatenate([
+        (new_bank if is_new else old_bank).pattern_norms[start:stop]
+        for is_new, start, stop in template_ranges])
+    template_arrays.update(phase_offsets=phase_offsets, orientations=orientations,
+                       pattern_norms=pattern_norms)
+    for name, array in template_arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+    with open(os.path.join(directory, 'keys.json'), 'w') as f:
+        json.dump(keys, f)
+    contents['symmetry_map'] = _serialize_symmetry_map(
+        diffraction_library.symmetry_map)
+    with open(os.path.join(directory, 'library.json'), 'w') as f:
+        json.dump(contents, f)
+
+
+def _parameters_match(value, expected):
+    """Whether a recorded simulation parameter equals an expected value."""
+    if isinstance(expected, dict):
+        return isinstance(value, dict) and set(value) == set(expected) and \
+            all(_parameters_match(value[k], expected[k]) for k in expected)
+    try:
+        return np.shape(value) == np.shape(expected) and \
+            np.allclose(value, expected)
+    except TypeError:
+        return value == expected
+
+
+class _SavedEntry(dict):
+    """An entry of a library loaded with :func:`load_diffraction_library`,
+    writing to which discards the template bank kept by the library."""
+
+    def __init__(self, library, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._library = library
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self._library._template_bank = None
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._library._template_bank = None
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._library._template_bank = None
+
+
+class _SavedPhaseLibrary(MutableMapping):
+    """The entries of a phase of a library loaded with
+    :func:`load_diffraction_library`, which are built from the saved arrays
+    when first accessed and kept after."""
+
+    def __init__(self, library, template_bank, templates, simulations,
+                 calibration, offset, with_direct_beam):
+        self._library = library
+        self._template_bank = template_bank
+        self._simulations = simulations
+        self._calibration = calibration
+        self._offset = offset
+        self._with_direct_beam = with_direct_beam
+        orientations = template_bank.orientations[templates].tolist()
+        self._templates = dict(zip(map(tuple, orientations),
+                                   range(templates.start, templates.stop)))
+        self._entries = {}
+
+    def _build_entry(self, template):
+        """The library entry of a template of the saved bank."""
+        template_bank = self._template_bank
+        spots = slice(template_bank.offsets[template],
+                      template_bank.offsets[template + 1])
+        simulation = None
+        if self._simulations is not None:
+            # The spots of a recalibrated library may be a subset of those of
+            # its simulations.
+            simulation_offsets = self._simulations['offsets']
+            simulation_spots = slice(simulation_offsets[template],
+                                     simulation_offsets[template + 1])
+            simulation = DiffractionSimulation(
+                coordinates=self._simulations['coordinates'][simulation_spots],
+                indices=self._simulations['indices'][simulation_spots],
+                intensities=self._simulations['simulation_intensities'][
+                    simulation_spots],
+                calibration=self._calibration, offset=self._offset,
+                with_direct_beam=self._with_direct_beam)
+        return _SavedEntry(
+            self._library, Sim=simulation,
+            intensities=template_bank.intensities[spots],
+            pixel_coords=template_bank.pixel_coords[spots],
+            pattern_norm=template_bank.pattern_norms[template])
+
+    def __getitem__(self, orientation):
+        if orientation not in self._entries:
+            self._entries[orientation] = self._build_entry(
+                self._templates[orientation])
+        return self._entries[orientation]
+
+    def __setitem__(self, orientation, entry):
+        self._templates.setdefault(orientation, None)
+        self._entries[orientation] = entry
+        self._library._template_bank = None
+
+    def __delitem__(self, orientation):
+        del self._templates[orientation]
+        self._entries.pop(orientation, None)
+        self._library._template_bank = None
+
+    def __iter__(self):
+        return iter(self._templates)
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __contains__(self, orientation):
+        return orientation in self._templates
+
+
+def load_diffraction_library(directory, mmap_mode='r', **parameters):
+    """Loads a library saved with :meth:`DiffractionLibrary.save`.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the library was saved in.
+    mmap_mode : {None, 'r', 'r+', 'c'}
+        If not None, the arrays are memory-mapped rather than read into
+        memory, so that the library opens without reading its templates and
+        processes opening the same library share its pages. The entries of
+        the library are only built when first accessed, with arrays that are
+        views into the memory-mapped arrays, so that matching with the
+        template bank of the library does not build them at all.
+    **parameters
+        Simulation parameters the library must have been simulated with,
+        e.g. `accelerating_voltage=300.` or `half_shape=(72, 72)`.
+
+    Returns
+    -------
+    diffraction_library : :class:`DiffractionLibrary`
+
+    Raises
+    ------
+    ValueError
+        If the library does not record one of `parameters`, or was simulated
+        with a different value.
+
+    """
+    with open(os.path.join(directory, 'library.json')) as f:
+        contents = json.load(f)
+    recorded = contents['parameters']
+    for name, expected in parameters.items():
+        if name not in recorded:
+            raise ValueError("The library does not record the parameter "
+                             "`{}`.".format(name))
+        if not _parameters_match(recorded[name], expected):
+            raise ValueError("The library was simulated with {} = {}, not "
+                             "{}.".format(name, recorded[name], expected))
+
+    template_bank = load_template_bank(directory, mmap_mode=mmap_mode)
+    simulations = None
+    if contents['has_simulations']:
+        simulations = {name: np.load(os.path.join(directory, name + '.npy'),
+                                     mmap_mode=mmap_mode)
+                       for name in ('coordinates', 'indices',
+                                    'simulation_intensities')}
+        simulations['offsets'] = np.load(
+            os.path.join(directory, 'simulation_offsets.npy'))
+    diffraction_library = DiffractionLibrary()
+    for i, key in enumerate(template_bank.keys):
+        diffraction_library[key] = _SavedPhaseLibrary(
+            diffraction_library, template_bank, template_bank.phase_slice(i), simulations,
+            recorded.get('calibration', 1.), recorded.get('offset', (0., 0.)),
+            contents['with_direct_beam'])
+    diffraction_library.symmetry_map = {
+        key: {tuple(representative): [tuple(o) for o in orientations]
+              for representative, orientations in classes}
+        for key, classes in contents['symmetry_map'].items()}
+    diffraction_library.parameters = recorded
+    diffraction_library._template_bank = template_bank
+    return diffraction_library
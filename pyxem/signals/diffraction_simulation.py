@@ -57,7 +57,7 @@ class DiffractionSimulation:
     def calibration(self, calibration):
         if np.all(np.equal(calibration, 0)):
             raise ValueError("`calibration` cannot be zero.")
-        if isinstance(calibration, float) or isinstance(calibration, int):
+        if isinstance(calibration, (float, int, np.number)):
             self._calibration = (calibration, calibration)
         elif len(calibration) == 2:
             self._calibration = calibration
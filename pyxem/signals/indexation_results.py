@@ -1,4 +1,5 @@
 import numpy as np
+from hyperspy._signals.lazy import LazySignal
 from hyperspy.signal import BaseSignal
 from pyxem import CrystallographicMap
 
@@ -6,8 +7,11 @@ from pyxem import CrystallographicMap
 def crystal_from_matching_results(matching_results):
     """Takes matching results for a single navigation position and returns the
     best matching phase and orientation with correlation and reliability to
-    define a crystallographic map.
+    define a crystallographic map. Navigation positions that were not indexed,
+    whose matching results are NaN, give NaN.
     """
+    if np.all(np.isnan(matching_results.T[-1])):
+        return np.full(6, np.nan)
     res_arr = np.zeros(6)
     top_index = np.where(matching_results.T[-1]==matching_results.T[-1].max())
     res_arr[:5] = matching_results[top_index][0]
@@ -22,6 +26,24 @@ def phase_specific_results(matching_results, phaseid):
     return matching_results.T[:,:len(np.where(matching_results.T[0]==phaseid)[0])].T
 
 
+def expand_symmetry_results(matching_results, library, keys, n_equivalents):
+    """Takes matching results for a single navigation position and replaces
+    each match with all of the orientations of the library equivalent to it,
+    padded with NaN to `n_equivalents` rows per match.
+    """
+    expanded = np.full((len(matching_results) * n_equivalents, 5), np.nan)
+    for i, match in enumerate(matching_results):
+        if np.isnan(match[4]):
+            continue
+        orientations = library.get_equivalent_orientations(
+            keys[int(match[0])], match[1:4])
+        rows = slice(i * n_equivalents, i * n_equivalents + len(orientations))
+        expanded[rows, 0] = match[0]
+        expanded[rows, 1:4] = orientations
+        expanded[rows, 4] = match[4]
+    return expanded
+
+
 class IndexationResults(BaseSignal):
     _signal_type = "matching_results"
     _signal_dimension = 2
@@ -34,7 +56,9 @@ class IndexationResults(BaseSignal):
                                  *args, **kwargs):
         """Obtain a crystallographic map specifying the best matching
         phase and orientation at each probe position with corresponding
-        correlation and reliabilty scores.
+        correlation and reliabilty scores. Navigation positions masked out
+        during indexation are NaN in the map, and the navigation mask is copied
+        to its metadata.
 
         """
         #TODO: Add alternative methods beyond highest correlation score at each
@@ -42,7 +66,47 @@ class IndexationResults(BaseSignal):
         cryst_map = self.map(crystal_from_matching_results,
                              inplace=False,
                              *args, **kwargs)
-        return CrystallographicMap(cryst_map)
+        cryst_map = CrystallographicMap(cryst_map)
+        if self.metadata.has_item('Indexation.navigation_mask'):
+            cryst_map.metadata.set_item(
+                'Indexation.navigation_mask',
+                self.metadata.Indexation.navigation_mask)
+        return cryst_map
+
+    def expand_symmetry(self, library, keys=[], *args, **kwargs):
+        """Obtain matching results in which every match with a
+        symmetry-reduced library is replaced by all of the orientations
+        equivalent to it.
+
+        Parameters
+        ----------
+        library : DiffractionLibrary
+            The library the results were obtained with, generated with
+            `reduce_symmetry=True`.
+        keys : list
+            The phases in the order of their phase index, as passed to the
+            correlate method. Defaults to the order of the library.
+
+        Returns
+        -------
+        expanded_results : IndexationResults
+            Matching results with, for every match, as many rows as the
+            largest set of equivalent orientations in the library. Each
+            equivalent orientation has the score of the match; unused rows
+            are NaN.
+
+        """
+        keys = keys or list(library.keys())
+        n_equivalents = max([len(orientations)
+                             for classes in library.symmetry_map.values()
+                             for orientations in classes.values()] + [1])
+        expanded_results = self.map(expand_symmetry_results,
+                                    library=library,
+                                    keys=keys,
+                                    n_equivalents=n_equivalents,
+                                    inplace=False,
+                                    *args, **kwargs)
+        return IndexationResults(expanded_results)
 
     def get_phase_results(self,
                           phaseid,
@@ -63,4 +127,12 @@ class IndexationResults(BaseSignal):
         return self.map(phase_specific_results,
                         phaseid=phaseid,
                         inplace=False,
-                        *args, **kwargs)
\ No newline at end of file
+                        *args, **kwargs)
+
+
+class LazyIndexationResults(LazySignal, IndexationResults):
+
+    _lazy = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017-2018 The pyXem developers
+#
+# This file is part of pyXem.
+#
+# pyXem is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyXem is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Array-backed template bank compiled from a DiffractionLibrary.
+
+"""
+
+import json
+import os
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+
+_ARRAY_NAMES = ('phase_offsets', 'orientations', 'offsets', 'pixel_coords',
+                'intensities', 'pattern_norms')
+
+
+class TemplateBank:
+    """Flat array representation of the templates in a DiffractionLibrary.
+
+    The spots of every template are concatenated into single arrays and the
+    template boundaries are stored as offsets, in the style of a compressed
+    sparse row matrix. The spots of template ``i`` are therefore
+    ``pixel_coords[offsets[i]:offsets[i + 1]]``. Templates are grouped by
+    phase, with the templates of phase ``j`` running from
+    ``phase_offsets[j]`` to ``phase_offsets[j + 1]``.
+
+    Parameters
+    ----------
+    keys : list
+        The phase names, in the order of their phase index.
+    phase_offsets : array-like, shape [n_phases + 1, ]
+        Index of the first template of each phase.
+    orientations : array-like, shape [n_templates, n_angles]
+        The orientation associated with each template.
+    offsets : array-like, shape [n_templates + 1, ]
+        Index of the first spot of each template.
+    pixel_coords : array-like, shape [n_spots, 2]
+        The calibrated pixel coordinates of every spot.
+    intensities : array-like, shape [n_spots, ]
+        The simulated intensity of every spot.
+    pattern_norms : array-like, shape [n_templates, ]
+        The Euclidean norm of the intensities of each template.
+
+    """
+
+    def __init__(self, keys, phase_offsets, orientations, offsets,
+                 pixel_coords, intensities, pattern_norms):
+        self.keys = list(keys)
+        self.phase_offsets = np.asarray(phase_offsets)
+        self.orientations = np.asarray(orientations)
+        self.offsets = np.asarray(offsets)
+        self.pixel_coords = np.asarray(pixel_coords)
+        self.intensities = np.asarray(intensities)
+        self.pattern_norms = np.asarray(pattern_norms)
+        self._flat_indices = {}
+        self._sparse_matrices = {}
+        self._tile_matrices = {}
+        self._pixel_statistics = None
+        self._template_phases = None
+        self._spot_templates = None
+
+    @property
+    def n_templates(self):
+        """int : The total number of templates in the bank."""
+        return len(self.offsets) - 1
+
+    @property
+    def dtype(self):
+        """numpy.dtype : The floating point type in which scores are
+        accumulated, which is at least single precision."""
+        return np.result_type(self.intensities.dtype,
+                              self.pattern_norms.dtype, np.float32)
+
+    @property
+    def template_phases(self):
+        """ndarray : The phase index of every template."""
+        if self._template_phases is None:
+            self._template_phases = np.repeat(np.arange(len(self.keys)),
+                                              np.diff(self.phase_offsets))
+        return self._template_phases
+
+    @property
+    def spot_templates(self):
+        """ndarray : The template index of every spot."""
+        if self._spot_templates is None:
+            self._spot_templates = np.repeat(np.arange(self.n_templates),
+                                             np.diff(self.offsets))
+        return self._spot_templates
+
+    def phase_slice(self, phase_index):
+        """The range of template indices belonging to a phase.
+
+        Parameters
+        ----------
+        phase_index : int
+            Identifying integer of the phase.
+
+        Returns
+        -------
+        slice
+            Slice into the template axis of the bank.
+
+        """
+        return slice(self.phase_offsets[phase_index],
+                     self.phase_offsets[phase_index + 1])
+
+    def flat_pixel_indices(self, shape):
+        """Indices of every spot into a flattened image of a given shape.
+
+        The indices are computed once for each image shape and cached.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            The shape of the diffraction patterns to be scored.
+
+        Returns
+        -------
+        ndarray
+            The raveled pixel index of every spot.
+
+        Raises
+        ------
+        ValueError
+            If a spot falls outside the images, naming the phase and
+            orientation of its template.
+
+        """
+        shape = tuple(shape)
+        if shape not in self._flat_indices:
+            outside = np.flatnonzero(np.any(
+                (self.pixel_coords < 0) | (self.pixel_coords >= shape),
+                axis=1))
+            if len(outside):
+                template = self.spot_templates[outside[0]]
+                raise ValueError(
+                    "A spot of the template of phase {} at orientation {} "
+                    "falls at pixel {}, outside the {} patterns.".format(
+                        self.keys[self.template_phases[template]],
+                        tuple(self.orientations[template].tolist()),
+                        tuple(self.pixel_coords[outside[0]].tolist()),
+                        shape))
+            self._flat_indices[shape] = np.ravel_multi_index(
+                (self.pixel_coords[:, 0], self.pixel_coords[:, 1]), shape)
+        return self._flat_indices[shape]
+
+    def get_sparse_matrix(self, shape):
+        """The templates as a sparse (pixels x templates) matrix.
+
+        Each column holds the normalised intensities of one template at its
+        raveled pixel positions, such that the product of a stack of raveled
+        diffraction patterns with this matrix gives the correlation of every
+        pattern with every template. The matrix is built once for each image
+        shape and cached.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            The shape of the diffraction patterns to be scored.
+
+        Returns
+        -------
+        :class:`scipy.sparse.csc_matrix`
+            Matrix of shape (n_pixels, n_templates).
+
+        """
+        shape = tuple(shape)
+        if shape not in self._sparse_matrices:
+            values = self.intensities / \
+                np.repeat(self.pattern_norms, np.diff(self.offsets))
+            self._sparse_matrices[shape] = csc_matrix(
+                (values, self.flat_pixel_indices(shape), self.offsets),
+                shape=(int(np.prod(shape)), self.n_templates))
+        return self._sparse_matrices[shape]
+
+    def get_tile_matrix(self, shape, tile_size):
+        """The templates summed over square tiles of the image, as a sparse
+        (tiles x templates) matrix.
+
+        Each column holds the sums of the normalised intensities of one
+        template over the tiles of `tile_size` x `tile_size` pixels, in
+        row-major order, that its spots fall on. The product of the maxima of
+        the tiles of a pattern with this matrix bounds the correlation of the
+        pattern with every template. The matrix is built once for each image
+        shape and tile size and cached.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            The shape of the diffraction patterns to be scored.
+        tile_size : int
+            The side of the tiles in pixels.
+
+        Returns
+        -------
+        :class:`scipy.sparse.csc_matrix`
+            Matrix of shape (n_tiles, n_templates).
+
+        """
+        shape = tuple(shape)
+        if (shape, tile_size) not in self._tile_matrices:
+            # Spots outside the patterns raise as they would when scored.
+            self.flat_pixel_indices(shape)
+            tiles_shape = tuple(-(-np.array(shape) // tile_size))
+            tile_indices = np.ravel_multi_index(
+                (self.pixel_coords[:, 0] // tile_size,
+                 self.pixel_coords[:, 1] // tile_size), tiles_shape)
+            values = self.intensities / \
+                np.repeat(self.pattern_norms, np.diff(self.offsets))
+            tile_matrix = csc_matrix(
+                (values, tile_indices, self.offsets),
+                shape=(int(np.prod(tiles_shape)), self.n_templates))
+            tile_matrix.sum_duplicates()
+            self._tile_matrices[shape, tile_size] = tile_matrix
+        return self._tile_matrices[shape, tile_size]
+
+    def get_pixel_statistics(self):
+        """Statistics of the templates as images, in which spots falling on
+        the same pixel are summed.
+
+        Returns
+        -------
+        pixel_counts : ndarray
+            The number of distinct pixels covered by each template.
+        pixel_sums : ndarray
+            The sum of the intensities of each template image.
+        pixel_norms : ndarray
+            The Euclidean norm of each template image.
+
+        """
+        if self._pixel_statistics is None:
+            spot_templates = self.spot_templates
+            order = np.lexsort((self.pixel_coords[:, 1],
+                                self.pixel_coords[:, 0],
+                                spot_templates))
+            keys = np.column_stack((spot_templates[order],
+                                    self.pixel_coords[order]))
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+            starts = np.flatnonzero(first)
+            pixel_templates = keys[starts, 0]
+            pixel_intensities = np.add.reduceat(
+                self.intensities[order].astype(self.dtype), starts) \
+                if len(starts) else np.zeros(0)
+            pixel_counts = np.bincount(pixel_templates,
+                                       minlength=self.n_templates)
+            pixel_sums = np.bincount(pixel_templates, pixel_intensities,
+                                     minlength=self.n_templates)
+            pixel_norms = np.sqrt(np.bincount(pixel_templates,
+                                              pixel_intensities ** 2,
+                                              minlength=self.n_templates))
+            self._pixel_statistics = pixel_counts, pixel_sums, pixel_norms
+        return self._pixel_statistics
+
+    def compact(self, intensity_dtype=np.float32):
+        """A reduced-precision copy of the template bank.
+
+        Pixel coordinates are stored as int16, intensities with
+        `intensity_dtype` and pattern norms as float32, so that the bank takes
+        a fraction of the memory and templates are scored in single
+        precision. See :func:`pyxem.utils.indexation_utils.get_score_agreement`
+        to compare the scores with those of the full-precision bank.
+
+        Parameters
+        ----------
+        intensity_dtype : numpy.float16 or numpy.float32
+            The type of the intensities.
+
+        Returns
+        -------
+        template_bank : :class:`TemplateBank`
+
+        """
+        intensity_dtype = np.dtype(intensity_dtype)
+        if len(self.pixel_coords) and (
+                self.pixel_coords.min() < np.iinfo(np.int16).min or
+                self.pixel_coords.max() > np.iinfo(np.int16).max):
+            raise ValueError("The pixel coordinates of the bank do not fit "
+                             "in int16.")
+        if len(self.intensities) and \
+                self.intensities.max() > np.finfo(intensity_dtype).max:
+            raise ValueError("The intensities of the bank do not fit in "
+                             "{}.".format(intensity_dtype))
+        return TemplateBank(keys=self.keys,
+                            phase_offsets=self.phase_offsets,
+                            orientations=self.orientations,
+                            offsets=self.offsets,
+                            pixel_coords=self.pixel_coords.astype(np.int16),
+                            intensities=self.intensities.astype(
+                                intensity_dtype),
+                            pattern_norms=self.pattern_norms.astype(
+                                np.float32))
+
+    def save(self, directory):
+        """Saves the template bank as a directory of .npy files.
+
+        Parameters
+        ----------
+        directory : str
+            The directory in which to save the bank. It is created if it does
+            not exist.
+
+        See also
+        --------
+        load_template_bank
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in _ARRAY_NAMES:
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+        with open(os.path.join(directory, 'keys.json'), 'w') as f:
+            json.dump(self.keys, f)
+
+
+def load_template_bank(directory, mmap_mode=None):
+    """Loads a template bank saved with :meth:`TemplateBank.save`.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the bank was saved in.
+    mmap_mode : {None, 'r', 'r+', 'c'}
+        If not None, the arrays are memory-mapped rather than read into memory,
+        so that processes opening the same bank share its pages.
+
+    Returns
+    -------
+    template_bank : :class:`TemplateBank`
+
+    """
+    with open(os.path.join(directory, 'keys.json')) as f:
+        keys = json.load(f)
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode=mmap_mode)
+              for name in _ARRAY_NAMES}
+    return TemplateBank(keys=keys, **arrays)
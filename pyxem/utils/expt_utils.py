@@ -133,7 +133,64 @@ def radial_average(z, center,cython=True):
 
     return averaged
 
-def reproject_polar(z, origin=None, jacobian=False, dr=1, dt=None):
+def get_polar_grid(shape, origin=None, dr=1, dt=None, periodic=False):
+    """
+    The radial and angular coordinates sampled when reprojecting a 2D
+    diffraction pattern into polar coordinates with :func:`reproject_polar`.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the diffraction pattern.
+    origin : tuple
+        The coordinate (x0, y0) of the image center, relative to bottom-left.
+        If 'None' defaults to the center of the pattern.
+    dr : float
+        Radial coordinate spacing.
+    dt : float
+        Angular coordinate spacing (in radians). If ``dt=None``, the number of
+        theta values is equal to the maximum value between the height or the
+        width of the image.
+    periodic : bool
+        If True, the angles are ``2 * pi * j / nt`` for ``j`` in
+        ``range(nt)``, sampling the full circle at exactly periodic steps, as
+        a Fourier transform along the angular axis assumes. Otherwise they run
+        from the smallest to the largest angle of the pixels of the pattern.
+
+    Returns
+    -------
+    r_i, theta_i : 1D np.array
+        The radii and angles of the rows and columns of the polar image.
+
+    """
+    ny, nx = shape[:2]
+    if origin is None:
+        origin = (nx//2, ny//2)
+
+    # Determine that the min and max r and theta coords will be...
+    x, y = _index_coords(np.empty((ny, nx)), origin=origin)
+    r, theta = _cart2polar(x, y)  # convert (x,y) -> (r,θ), note θ=0 is vertical
+
+    nr = int(np.ceil((r.max()-r.min())/dr))
+
+    if dt is None:
+        nt = max(nx, ny)
+    elif periodic:
+        nt = int(np.ceil(2 * np.pi / dt))
+    else:
+        # dt in radians
+        nt = int(np.ceil((theta.max()-theta.min())/dt))
+
+    # Make a regular (in polar space) grid based on the min and max r & theta
+    r_i = np.linspace(r.min(), r.max(), nr, endpoint=False)
+    if periodic:
+        theta_i = np.arange(nt) * 2 * np.pi / nt
+    else:
+        theta_i = np.linspace(theta.min(), theta.max(), nt, endpoint=False)
+    return r_i, theta_i
+
+def reproject_polar(z, origin=None, jacobian=False, dr=1, dt=None,
+                    periodic=False):
     """
     Reprojects a 2D diffraction pattern into a polar coordinate system.
 
@@ -154,6 +211,9 @@ def reproject_polar(z, origin=None, jacobian=False, dr=1, dt=None):
         if ``dt=None``, dt will be set such that the number of theta values
         is equal to the maximum value between the height or the width of
         the image.
+    periodic : bool
+        If True, the full circle is sampled at exactly periodic angles, see
+        :func:`get_polar_grid`.
 
     Returns
     -------
@@ -172,21 +232,9 @@ def reproject_polar(z, origin=None, jacobian=False, dr=1, dt=None):
     if origin is None:
         origin = (nx//2, ny//2)
 
-    # Determine that the min and max r and theta coords will be...
-    x, y = _index_coords(z, origin=origin)  # (x,y) coordinates of each pixel
-    r, theta = _cart2polar(x, y)  # convert (x,y) -> (r,θ), note θ=0 is vertical
-
-    nr = np.int(np.ceil((r.max()-r.min())/dr))
-
-    if dt is None:
-        nt = max(nx, ny)
-    else:
-        # dt in radians
-        nt = np.int(np.ceil((theta.max()-theta.min())/dt))
-
-    # Make a regular (in polar space) grid based on the min and max r & theta
-    r_i = np.linspace(r.min(), r.max(), nr, endpoint=False)
-    theta_i = np.linspace(theta.min(), theta.max(), nt, endpoint=False)
+    r_i, theta_i = get_polar_grid(z.shape, origin=origin, dr=dr, dt=dt,
+                                  periodic=periodic)
+    nr, nt = len(r_i), len(theta_i)
     theta_grid, r_grid = np.meshgrid(theta_i, r_i)
 
     # Project the r and theta grid back into pixel coordinates
@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017-2018 The pyXem developers
+#
+# This file is part of pyXem.
+#
+# pyXem is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyXem is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized template matching against a TemplateBank.
+
+"""
+
+import numpy as np
+
+from pyxem.utils.expt_utils import get_polar_grid
+
+
+def _segment_sums(values, offsets):
+    """The sums of the segments of `values` starting at each of `offsets`,
+    with the last ending at the end of `values`. Empty segments, such as
+    templates that lost all their spots on recalibration, sum to zero."""
+    sums = np.zeros(len(offsets), dtype=values.dtype)
+    filled = offsets < np.append(offsets[1:], len(values))
+    if np.any(filled):
+        sums[filled] = np.add.reduceat(values, offsets[filled])
+    return sums
+
+
+def correlate_template_bank(image, template_bank):
+    """The correlation between a diffraction pattern and every template in a
+    template bank.
+
+    Evaluates the same score as :func:`pyxem.utils.correlate` for all templates
+    at once, using a single gather of the image intensities followed by a
+    segmented sum over the spots of each template.
+
+    Parameters
+    ----------
+    image : :class:`numpy.ndarray`
+        A single electron diffraction signal. Should be appropriately scaled
+        and centered.
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The compiled templates to be scored.
+
+    Returns
+    -------
+    ndarray
+        The unnormalised correlation coefficient of every template.
+
+    """
+    flat_indices = template_bank.flat_pixel_indices(image.shape)
+    flat_image = np.ravel(image).astype(template_bank.dtype, copy=False)
+    products = flat_image[flat_indices] * template_bank.intensities
+    sums = _segment_sums(products, template_bank.offsets[:-1])
+    return sums / template_bank.pattern_norms
+
+
+def correlate_template_bank_batch(images, template_bank):
+    """The correlation between a stack of diffraction patterns and every
+    template in a template bank.
+
+    The patterns are raveled into an (n_images, n_pixels) array and multiplied
+    by the sparse (n_pixels, n_templates) matrix of the template bank, giving
+    every score in a single sparse matrix product.
+
+    Parameters
+    ----------
+    images : :class:`numpy.ndarray`
+        Stack of diffraction patterns with shape (n_images, height, width).
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The compiled templates to be scored.
+
+    Returns
+    -------
+    ndarray
+        The unnormalised correlation coefficients, with shape
+        (n_images, n_templates).
+
+    """
+    images = np.asarray(images)
+    template_matrix = template_bank.get_sparse_matrix(images.shape[1:])
+    # Sparse-dense products are only implemented with the sparse operand on
+    # the left, hence the transposes.
+    flat_images = images.reshape(len(images), -1).astype(template_bank.dtype,
+                                                         copy=False)
+    return np.asarray((template_matrix.T @ flat_images.T).T)
+
+
+def normalize_correlations(correlations, images, template_bank):
+    """Converts correlation coefficients into zero-mean normalised
+    cross-correlations.
+
+    The normalised cross-correlation of a pattern P and a template image T,
+    over all n pixels of the pattern, is
+
+    .. math::
+
+        \\frac{\\sum P T - \\frac{1}{n}\\sum P \\sum T}
+        {\\sqrt{\\sum P^2 - \\frac{1}{n}(\\sum P)^2}
+         \\sqrt{\\sum T^2 - \\frac{1}{n}(\\sum T)^2}}
+
+    The sums over the pattern are computed once per pattern and those over the
+    templates once per template bank, so the conversion costs a few array
+    operations on the (n_images, n_templates) scores. Scores lie between -1
+    and 1 and are comparable between datasets. Patterns or templates of
+    uniform intensity have a score of zero.
+
+    Parameters
+    ----------
+    correlations : :class:`numpy.ndarray`
+        The unnormalised correlation coefficients, with shape
+        (n_images, n_templates).
+    images : :class:`numpy.ndarray`
+        The scored diffraction patterns, with shape (n_images, height, width).
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The templates that were scored.
+
+    Returns
+    -------
+    ndarray
+        The normalised cross-correlations, with shape (n_images, n_templates).
+
+    """
+    # Integer detector data would overflow when squared.
+    flat_images = np.asarray(images, dtype=np.float64).reshape(len(images),
+                                                               -1)
+    n_pixels = flat_images.shape[1]
+    image_sums = flat_images.sum(axis=1)
+    image_variances = np.square(flat_images).sum(axis=1) - \
+        image_sums ** 2 / n_pixels
+    _, template_sums, template_norms = template_bank.get_pixel_statistics()
+    template_variances = template_norms ** 2 - template_sums ** 2 / n_pixels
+    covariances = correlations * template_bank.pattern_norms - \
+        np.outer(image_sums, template_sums) / n_pixels
+    deviations = np.sqrt(np.outer(np.clip(image_variances, 0, None),
+                                  np.clip(template_variances, 0, None)))
+    normalized = np.zeros_like(covariances)
+    np.divide(covariances, deviations, out=normalized, where=deviations > 0)
+    return normalized
+
+
+def get_score_agreement(images, template_bank, reference_bank, n_largest=1):
+    """Compares the scores of a stack of diffraction patterns with two
+    versions of the same templates, typically a compact template bank and the
+    full-precision bank it was made from.
+
+    Parameters
+    ----------
+    images : :class:`numpy.ndarray`
+        Stack of diffraction patterns with shape (n_images, height, width).
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The templates to be assessed, e.g. from :meth:`TemplateBank.compact`.
+    reference_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The same templates at the reference precision.
+    n_largest : int
+        The number of best templates of each phase compared.
+
+    Returns
+    -------
+    agreement : dict
+        With keys 'max_abs_error', the largest absolute difference between
+        scores, 'max_rel_error', the same relative to the largest reference
+        score of each pattern, and 'top_agreement', the fraction of the
+        n_largest best templates of each phase and pattern that are the same
+        with both banks.
+
+    """
+    images = np.asarray(images)
+    scores = correlate_template_bank_batch(images, template_bank)
+    reference_scores = correlate_template_bank_batch(images, reference_bank)
+    if reference_scores.size == 0:
+        return {'max_abs_error': 0., 'max_rel_error': 0.,
+                'top_agreement': 1.}
+    errors = np.abs(scores - reference_scores)
+    scales = np.abs(reference_scores).max(axis=1)[:, np.newaxis]
+    relative_errors = np.zeros_like(errors)
+    np.divide(errors, scales, out=relative_errors, where=scales > 0)
+    matches = 0
+    total = 0
+    for i in range(len(reference_bank.keys)):
+        phase_slice = reference_bank.phase_slice(i)
+        best = _top_indices(scores[:, phase_slice], n_largest)
+        reference_best = _top_indices(reference_scores[:, phase_slice],
+                                      n_largest)
+        matches += sum(len(np.intersect1d(b, r))
+                       for b, r in zip(best, reference_best))
+        total += reference_best.size
+    return {'max_abs_error': errors.max(),
+            'max_rel_error': relative_errors.max(),
+            'top_agreement': matches / total}
+
+
+def _top_indices(scores, n_largest):
+    """Indices of the `n_largest` highest scores in each row of a 2D array, in
+    decreasing order of score.
+
+    The best scores are found by partial sorting, so that only they are
+    sorted.
+    """
+    n_rows, n_scores = scores.shape
+    row_indices = np.arange(n_rows)[:, np.newaxis]
+    if n_largest < n_scores:
+        top = np.argpartition(-scores, n_largest - 1, axis=1)[:, :n_largest]
+    else:
+        top = np.tile(np.arange(n_scores), (n_rows, 1))
+    order = np.argsort(-scores[row_indices, top], axis=1, kind='mergesort')
+    return top[row_indices, order]
+
+
+def get_top_correlations(correlations, template_bank, n_largest,
+                         orientations=None):
+    """Selects the best scoring templates of each phase for a stack of
+    diffraction patterns.
+
+    Parameters
+    ----------
+    correlations : :class:`numpy.ndarray`
+        The score of every template for each pattern, with shape
+        (n_images, n_templates).
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The templates that were scored.
+    n_largest : int
+        The number of templates of each phase to keep. If 0 or None, all
+        templates of the largest phase are kept.
+    orientations : :class:`numpy.ndarray`, optional
+        The orientation of every template for each pattern, with shape
+        (n_images, n_templates, 3), for use instead of the orientations of the
+        template bank.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n_images, n_phases * n_largest, 5) where each row reads
+        (phase index, Z, X, Z, correlation score), in decreasing order of score
+        for each phase.
+
+    """
+    n_images = len(correlations)
+    n_phases = len(template_bank.keys)
+    if not n_largest:
+        n_largest = np.diff(template_bank.phase_offsets).max()
+    out_arr = np.zeros((n_images, n_largest * n_phases, 5))
+    for i in np.arange(n_phases):
+        phase_slice = template_bank.phase_slice(i)
+        phase_correlations = correlations[:, phase_slice]
+        best = _top_indices(phase_correlations, n_largest)
+        rows = slice(i * n_largest, i * n_largest + best.shape[1])
+        out_arr[:, rows, 0] = i
+        image_indices = np.arange(n_images)[:, np.newaxis]
+        if orientations is None:
+            out_arr[:, rows, 1:4] = \
+                template_bank.orientations[phase_slice][best, :3]
+        else:
+            out_arr[:, rows, 1:4] = \
+                orientations[:, phase_slice][image_indices, best]
+        out_arr[:, rows, 4] = phase_correlations[image_indices, best]
+    return out_arr
+
+
+def _correlate_templates(flat_image, flat_indices, template_bank, templates):
+    """The correlation between a raveled diffraction pattern and a subset of
+    the templates in a template bank."""
+    starts = template_bank.offsets[templates]
+    lengths = template_bank.offsets[templates + 1] - starts
+    segment_offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    spots = np.arange(lengths.sum()) + np.repeat(starts - segment_offsets,
+                                                 lengths)
+    products = flat_image[flat_indices[spots]] * \
+        template_bank.intensities[spots]
+    return _segment_sums(products, segment_offsets) / \
+        template_bank.pattern_norms[templates]
+
+
+def get_top_correlations_pruned(image, template_bank, n_largest,
+                                block_size=64, tile_size=8):
+    """Finds the exact best scoring templates of each phase for a diffraction
+    pattern, skipping templates that cannot be among them.
+
+    The correlation of a template is bounded by the sum, over the square tiles
+    of the pattern its spots fall on, of the brightest pixel of the tile
+    multiplied by the template intensity in the tile, so that templates with
+    spots where the pattern is dark have low bounds. By the Cauchy-Schwarz
+    inequality, it is also bounded by the norm of the m brightest pixels of
+    the pattern multiplied by the norm of the template image, for a template
+    covering m distinct pixels. Templates are scored in blocks, in decreasing
+    order of the lower of the two bounds, until the bound of the next
+    template cannot beat the n-th best score found so far.
+
+    Parameters
+    ----------
+    image : :class:`numpy.ndarray`
+        A single electron diffraction signal.
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The compiled templates to be scored.
+    n_largest : int
+        The number of templates of each phase to keep.
+    block_size : int
+        The number of templates scored between two checks of the bound.
+    tile_size : int
+        The side in pixels of the tiles of the bound. Smaller tiles give
+        tighter bounds, at the cost of a larger sparse matrix product.
+
+    Returns
+    -------
+    out_arr : ndarray
+        Array of shape (n_phases * n_largest, 5) laid out as the results of
+        :func:`get_top_correlations`.
+    n_pruned : int
+        The number of templates that were never scored.
+
+    """
+    flat_image = np.ravel(image).astype(template_bank.dtype, copy=False)
+    flat_indices = template_bank.flat_pixel_indices(image.shape)
+    pixel_counts, _, pixel_norms = template_bank.get_pixel_statistics()
+    max_count = max(min(pixel_counts.max(), flat_image.size), 1)
+    squares = np.square(flat_image)
+    brightest = -np.sort(-np.partition(squares, -max_count)[-max_count:])
+    bounds = np.sqrt(np.cumsum(brightest)[pixel_counts - 1]) * pixel_norms / \
+        template_bank.pattern_norms
+    # The maxima of the tiles, padding the pattern with pixels that are never
+    # the brightest of a tile.
+    n_tiles = -(-np.array(image.shape) // tile_size)
+    tiles = np.full(n_tiles * tile_size, -np.inf, dtype=flat_image.dtype)
+    tiles[:image.shape[0], :image.shape[1]] = image
+    tile_maxima = tiles.reshape(n_tiles[0], tile_size, n_tiles[1],
+                                tile_size).max(axis=(1, 3)).ravel()
+    tile_matrix = template_bank.get_tile_matrix(image.shape, tile_size)
+    bounds = np.minimum(bounds, tile_matrix.T.dot(tile_maxima))
+
+    n_phases = len(template_bank.keys)
+    out_arr = np.zeros((n_largest * n_phases, 5))
+    n_pruned = 0
+    for i in np.arange(n_phases):
+        phase_slice = template_bank.phase_slice(i)
+        phase_bounds = bounds[phase_slice]
+        order = np.argsort(phase_bounds)[::-1]
+        best_templates = np.zeros(0, dtype=int)
+        best_scores = np.zeros(0)
+        n_scored = 0
+        while n_scored < len(order):
+            block = order[n_scored:n_scored + block_size] + phase_slice.start
+            n_scored += len(block)
+            best_templates = np.concatenate((best_templates, block))
+            best_scores = np.concatenate((best_scores, _correlate_templates(
+                flat_image, flat_indices, template_bank, block)))
+            keep = _top_indices(best_scores[np.newaxis], n_largest)[0]
+            best_templates = best_templates[keep]
+            best_scores = best_scores[keep]
+            if len(best_scores) == n_largest and n_scored < len(order) and \
+                    best_scores[-1] >= phase_bounds[order[n_scored]]:
+                break
+        n_pruned += len(order) - n_scored
+        rows = slice(i * n_largest, i * n_largest + len(best_scores))
+        out_arr[rows, 0] = i
+        out_arr[rows, 1:4] = template_bank.orientations[best_templates, :3]
+        out_arr[rows, 4] = best_scores
+    return out_arr, n_pruned
+
+
+def get_polar_templates(template_bank, shape, dr=1, dt=None):
+    """Reprojects the templates of a template bank onto the periodic polar
+    grid of :func:`pyxem.utils.expt_utils.reproject_polar`, whose angles are
+    ``2 * pi * j / n_theta``.
+
+    The templates are assumed to be centred on the center of the pattern, the
+    default origin of the reprojection. Spots falling beyond the largest
+    radius of the polar grid are discarded. For each remaining spot, the phase
+    factors of its angular position are precomputed for all angular
+    frequencies, such that rotating the template in plane is a shift theorem
+    product in Fourier space.
+
+    Parameters
+    ----------
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The compiled templates.
+    shape : tuple of int
+        The shape of the diffraction patterns to be scored.
+    dr, dt : float
+        The radial and angular spacing of the polar grid, as passed to
+        :func:`pyxem.utils.expt_utils.reproject_polar`.
+
+    Returns
+    -------
+    polar_templates : dict
+        Containing:
+            'radial_indices' : the polar image row of every spot
+            'spot_phases' : the intensity of every spot multiplied by its
+            phase factor at every angular frequency
+            'offsets' : the index of the first spot of each template
+            'n_theta' : the number of angles of the polar grid
+            'theta_step' : the angular spacing of the polar grid
+
+    """
+    ny, nx = shape[:2]
+    r_i, theta_i = get_polar_grid(shape, dr=dr, dt=dt, periodic=True)
+    r_step = r_i[1] - r_i[0]
+    n_theta = len(theta_i)
+    theta_step = 2 * np.pi / n_theta
+    # Match the (x, y) convention of reproject_polar, where x runs along the
+    # columns and theta is referenced to the vertical.
+    y = template_bank.pixel_coords[:, 0] - ny // 2
+    x = template_bank.pixel_coords[:, 1] - nx // 2
+    radial_indices = np.rint((np.sqrt(x ** 2 + y ** 2) - r_i[0]) /
+                             r_step).astype(int)
+    angular_indices = np.rint(np.arctan2(x, y) /
+                              theta_step).astype(int) % n_theta
+    inside = radial_indices < len(r_i)
+    spot_templates = template_bank.spot_templates[inside]
+    offsets = np.searchsorted(spot_templates,
+                              np.arange(template_bank.n_templates + 1))
+    frequencies = np.arange(n_theta // 2 + 1)
+    spot_phases = template_bank.intensities[inside, np.newaxis] * np.exp(
+        2j * np.pi * np.outer(angular_indices[inside], frequencies) / n_theta)
+    return {'radial_indices': radial_indices[inside],
+            'spot_phases': spot_phases,
+            'offsets': offsets,
+            'n_theta': n_theta,
+            'theta_step': theta_step}
+
+
+def correlate_polar_templates(polar_image, template_bank, polar_templates):
+    """The correlation between a diffraction pattern in polar coordinates and
+    every template of a template bank, at every in-plane rotation.
+
+    The correlation with all rotations of a template is a circular
+    cross-correlation along the angular axis, evaluated by FFT.
+
+    Parameters
+    ----------
+    polar_image : :class:`numpy.ndarray`
+        A diffraction pattern reprojected with
+        :func:`pyxem.utils.expt_utils.reproject_polar` on the periodic grid
+        of the templates, i.e. with ``periodic=True``.
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The compiled templates.
+    polar_templates : dict
+        The templates on the polar grid, as returned by
+        :func:`get_polar_templates`.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n_templates, n_theta). Entry (i, j) is the
+        unnormalised correlation coefficient of template i rotated in plane by
+        j angular steps.
+
+    """
+    n_theta = polar_templates['n_theta']
+    image_spectrum = np.fft.rfft(polar_image, n=n_theta, axis=1)
+    products = image_spectrum[polar_templates['radial_indices']] * \
+        polar_templates['spot_phases']
+    offsets = polar_templates['offsets']
+    spectra = np.zeros((template_bank.n_templates, products.shape[1]),
+                       dtype=complex)
+    # Templates may have lost all of their spots beyond the polar grid.
+    filled = offsets[:-1] < offsets[1:]
+    if np.any(filled):
+        spectra[filled] = np.add.reduceat(products, offsets[:-1][filled])
+    correlations = np.fft.irfft(spectra, n=n_theta, axis=1)
+    return correlations / template_bank.pattern_norms[:, np.newaxis]
+
+
+def match_vectors(vectors, spot_tree, template_bank, distance_threshold,
+                  n_largest, spot_templates=None):
+    """Matches the diffraction vectors of a pattern with the simulated spots
+    of every template.
+
+    Each vector is matched with the nearest spot of each template lying
+    within `distance_threshold` of it, found by a query of a KD-tree of all
+    spots, so that only the templates with spots near the vectors are ever
+    considered.
+
+    Parameters
+    ----------
+    vectors : :class:`numpy.ndarray`
+        The diffraction vectors of the pattern, with shape (n_vectors, 2), in
+        reciprocal Angstroms.
+    spot_tree : :class:`scipy.spatial.cKDTree`
+        Tree of the reciprocal coordinates of every spot of the template bank,
+        in the order of the bank.
+    template_bank : :class:`pyxem.signals.template_bank.TemplateBank`
+        The templates to be matched.
+    distance_threshold : float
+        The maximum distance between a vector and a spot for them to match, in
+        reciprocal Angstroms.
+    n_largest : int
+        The number of templates of each phase to keep.
+    spot_templates : :class:`numpy.ndarray`, optional
+        The template index of every spot of the tree. Defaults to the
+        template index of every spot of the bank, for trees built from the
+        spots of the bank.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n_phases * n_largest, 5) where each row reads
+        (phase index, Z, X, Z, score), in decreasing order of score for each
+        phase. The score is the number of matched vectors minus their mean
+        distance to the matched spots as a fraction of `distance_threshold`,
+        so that templates matching the same number of vectors are ranked by
+        their residual. Rows without a matching template are zero.
+
+    """
+    n_phases = len(template_bank.keys)
+    out_arr = np.zeros((n_phases * n_largest, 5))
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 2)
+    neighbours = spot_tree.query_ball_point(vectors, distance_threshold)
+    vector_indices = np.repeat(np.arange(len(vectors)),
+                               [len(n) for n in neighbours])
+    if len(vector_indices) == 0:
+        return out_arr
+    spot_indices = np.concatenate(neighbours).astype(int)
+    distances = np.sqrt(np.sum((vectors[vector_indices] -
+                                spot_tree.data[spot_indices]) ** 2, axis=1))
+    if spot_templates is None:
+        spot_templates = template_bank.spot_templates
+    templates = spot_templates[spot_indices]
+    # Keep the nearest spot of each template to each vector.
+    order = np.lexsort((distances, templates, vector_indices))
+    pairs = np.column_stack((vector_indices[order], templates[order]))
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = np.any(pairs[1:] != pairs[:-1], axis=1)
+    templates = pairs[first, 1]
+    distances = distances[order][first]
+
+    candidates, inverse, n_matched = np.unique(templates, return_inverse=True,
+                                               return_counts=True)
+    residuals = np.bincount(inverse, distances) / n_matched
+    scores = n_matched - residuals / distance_threshold
+    phases = template_bank.template_phases[candidates]
+    order = np.lexsort((-scores, phases))
+    phases = phases[order]
+    for i in np.unique(phases):
+        best = order[phases == i][:n_largest]
+        rows = slice(i * n_largest, i * n_largest + len(best))
+        out_arr[rows, 0] = i
+        out_arr[rows, 1:4] = template_bank.orientations[candidates[best], :3]
+        out_arr[rows, 4] = scores[best]
+    return out_arr
+
+
+def bin_frames(frames, binning):
+    """Sums a stack of diffraction patterns in square bins.
+
+    Parameters
+    ----------
+    frames : :class:`numpy.ndarray`
+        Stack of diffraction patterns, with shape (n_frames, rows, columns).
+    binning : int
+        The side of the square bins, in pixels. Pixels beyond the last whole
+        bin are ignored.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The binned patterns, with shape
+        (n_frames, rows // binning, columns // binning).
+
+    """
+    frames = np.asarray(frames)
+    n_frames, rows, columns = frames.shape
+    rows, columns = rows // binning, columns // binning
+    return frames[:, :rows * binning, :columns * binning].reshape(
+        n_frames, rows, binning, columns, binning).sum(axis=(2, 4))
+
+
+def get_frame_fingerprints(frames, binning, step):
+    """Quantised fingerprints of a stack of diffraction patterns, which are
+    equal for patterns that are near-identical.
+
+    Each pattern is summed in square bins with :func:`bin_frames`, and the
+    binned intensities are divided by `step` and rounded down, saturating at
+    255.
+
+    Parameters
+    ----------
+    frames : :class:`numpy.ndarray`
+        Stack of diffraction patterns, with shape (n_frames, rows, columns).
+    binning : int
+        The side of the square bins, in pixels. Pixels beyond the last whole
+        bin are ignored.
+    step : float
+        The quantisation step of the binned intensities.
+
+    Returns
+    -------
+    list of bytes
+        The fingerprint of every pattern.
+
+    """
+    levels = np.floor(bin_frames(frames, binning) / step)
+    levels = np.clip(levels, 0, 255).astype(np.uint8)
+    return [level.tobytes() for level in levels]
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 import math
 from decimal import Decimal, ROUND_HALF_UP
@@ -23,10 +24,27 @@ from math import radians, sin
 
 import numpy as np
 from scipy.constants import h, m_e, e, c, pi
+from transforms3d.axangles import axangle2mat
+from transforms3d.euler import euler2mat
 import os
 
 from .atomic_scattering_params import ATOMIC_SCATTERING_PARAMS
 
+# The largest number of (peak, site) pairs for which atomic scattering factors
+# are computed at once.
+_MAX_CHUNK_ELEMENTS = 2 ** 20
+
+# The largest number of (k, atom) pairs for which phase factors are computed at
+# once in kinematic scattering simulations.
+_MAX_BLOCK_ELEMENTS = 2 ** 22
+
+# Atomic scattering factors are tabulated on a grid of s^2 values from zero to
+# _SCATTERING_TABLE_S2_MAX, in steps of _SCATTERING_TABLE_S2_STEP, in inverse
+# square Angstroms. The tables of each element are built when first needed.
+_SCATTERING_TABLE_S2_STEP = 1e-3
+_SCATTERING_TABLE_S2_MAX = 36.
+_SCATTERING_TABLES = {}
+
 
 def get_electron_wavelength(accelerating_voltage):
     """Calculates the (relativistic) electron wavelength in Angstroms
@@ -75,12 +93,110 @@ def get_interaction_constant(accelerating_voltage):
     return sigma
 
 
+def _get_scattering_coefficients(element):
+    """The Gaussian coefficients of the atomic scattering factor of an
+    element, as an array of (a, b) pairs."""
+    try:
+        return np.array(ATOMIC_SCATTERING_PARAMS[element])
+    except KeyError:
+        raise ValueError("There are no scattering coefficients for %s."
+                         % element)
+
+
+def _evaluate_scattering_factors(coefficients, s2):
+    """The sums of Gaussians giving the atomic scattering factor f(s^2) and
+    its derivative with respect to s^2."""
+    gaussians = coefficients[:, 0] * np.exp(-coefficients[:, 1] *
+                                            np.asarray(s2)[..., np.newaxis])
+    return np.sum(gaussians, axis=-1), \
+        -np.sum(gaussians * coefficients[:, 1], axis=-1)
+
+
+def get_scattering_factor_table(element):
+    """The tabulated atomic scattering factor of an element.
+
+    The table is computed when first requested and kept in memory for later
+    calls.
+
+    Parameters
+    ----------
+    element : str
+        Element symbol, e.g. "Si".
+
+    Returns
+    -------
+    values : np.array()
+        The atomic scattering factor on the grid of s^2 values.
+    derivatives : np.array()
+        Its derivative with respect to s^2 on the same grid.
+
+    """
+    table = _SCATTERING_TABLES.get(element)
+    if table is None:
+        s2 = np.arange(int(round(_SCATTERING_TABLE_S2_MAX /
+                                 _SCATTERING_TABLE_S2_STEP)) + 1) * \
+            _SCATTERING_TABLE_S2_STEP
+        table = _evaluate_scattering_factors(
+            _get_scattering_coefficients(element), s2)
+        _SCATTERING_TABLES[element] = table
+    return table
+
+
+def get_scattering_factors(element, s2, interpolation='cubic'):
+    """Atomic scattering factors of an element, interpolated from its
+    tabulated values.
+
+    Parameters
+    ----------
+    element : str
+        Element symbol, e.g. "Si".
+    s2 : array-like
+        The squared scattering vector magnitudes s^2, where s = g / 2, in
+        inverse square Angstroms.
+    interpolation : 'linear' or 'cubic'
+        Linear interpolation between the tabulated values, or cubic Hermite
+        interpolation using the tabulated derivatives as well. Values beyond
+        the table are computed from the Gaussian coefficients.
+
+    Returns
+    -------
+    scattering_factors : np.array()
+        The atomic scattering factor f(s^2) at every s^2.
+
+    """
+    values, derivatives = get_scattering_factor_table(element)
+    s2 = np.asarray(s2, dtype=float)
+    position = s2 / _SCATTERING_TABLE_S2_STEP
+    outside = ~(position < len(values) - 1)
+    index = np.where(outside, 0, position).astype(int)
+    t = np.where(outside, 0., position - index)
+    if interpolation == 'linear':
+        scattering_factors = values[index] + \
+            t * (values[index + 1] - values[index])
+    elif interpolation == 'cubic':
+        t2 = t * t
+        t3 = t2 * t
+        scattering_factors = \
+            (2 * t3 - 3 * t2 + 1) * values[index] + \
+            (-2 * t3 + 3 * t2) * values[index + 1] + \
+            _SCATTERING_TABLE_S2_STEP * (
+                (t3 - 2 * t2 + t) * derivatives[index] +
+                (t3 - t2) * derivatives[index + 1])
+    else:
+        raise ValueError("`interpolation` must be 'linear' or 'cubic'.")
+    if np.any(outside):
+        scattering_factors[outside] = _evaluate_scattering_factors(
+            _get_scattering_coefficients(element), s2[outside])[0]
+    return scattering_factors
+
+
 def get_kinematical_intensities(structure,
                                 g_indices,
                                 g_hkls,
                                 excitation_error,
                                 maximum_excitation_error,
-                                debye_waller_factors):
+                                debye_waller_factors,
+                                chunk_size=None):
     """Calculates peak intensities.
 
     The peak intensity is a combination of the structure factor for a given
@@ -96,6 +212,10 @@ def get_kinematical_intensities(structure,
         structure factor.
     proximities : array-like
         The distances between the Ewald sphere and the peak centres.
+    chunk_size : int, optional
+        The number of peaks whose structure factors are computed at once.
+        Defaults to as many as keep the arrays of atomic scattering factors
+        below a million elements.
 
     Returns
     -------
@@ -103,54 +223,51 @@ def get_kinematical_intensities(structure,
         The intensities of the peaks.
 
     """
-    # Create a flattened array of zs, coeffs, fcoords and occus for vectorized
+    # Create a flattened array of symbols, fcoords and occus for vectorized
     # computation of atomic scattering factors later. Note that these are not
     # necessarily the same size as the structure as each partially occupied
     # specie occupies its own position in the flattened array.
-    zs = []
-    coeffs = []
+    symbols = []
     fcoords = []
     occus = []
-    dwfactors = []
     for site in structure:
         for sp, occu in site.species_and_occu.items():
-            zs.append(sp.Z)
-            try:
-                c = ATOMIC_SCATTERING_PARAMS[sp.symbol]
-            except KeyError:
+            if sp.symbol not in ATOMIC_SCATTERING_PARAMS:
                 raise ValueError("Unable to calculate ED pattern as "
                                  "there is no scattering coefficients for"
                                  " %s." % sp.symbol)
-            coeffs.append(c)
-            dwfactors.append(debye_waller_factors.get(sp.symbol, 0))
+            symbols.append(sp.symbol)
             fcoords.append(site.frac_coords)
             occus.append(occu)
-    zs = np.array(zs)
-    coeffs = np.array(coeffs)
     fcoords = np.array(fcoords)
     occus = np.array(occus)
-    dwfactors = np.array(dwfactors)
+    # Scattering factors only depend on the element, so they are looked up
+    # once for each element.
+    elements, site_elements = np.unique(symbols, return_inverse=True)
+    site_elements = site_elements.ravel()
+    dwfactors = np.array([debye_waller_factors.get(element, 0)
+                          for element in elements])
 
     # Store array of s^2 values since used multiple times.
-    s2s = (g_hkls / 2) ** 2
-
-    # Create array containing atomic scattering factors.
-    fss = []
-    for s2 in s2s:
-        fs = np.sum(coeffs[:, :, 0] * np.exp(-coeffs[:, :, 1] * s2), axis=1)
-        fss.append(fs)
-    fss = np.array(fss)
-
-    # Calculate structure factors for all excited g-vectors.
-    f_hkls = []
-    for n in np.arange(len(g_indices)):
-        g = g_indices[n]
-        fs = fss[n]
-        dw_correction = np.exp(-dwfactors * s2s[n])
-        f_hkl = np.sum(fs * occus * np.exp(2j * np.pi * np.dot(fcoords, g))
-                       * dw_correction)
-        f_hkls.append(f_hkl)
-    f_hkls = np.array(f_hkls)
+    s2s = (np.asarray(g_hkls) / 2) ** 2
+    g_indices = np.asarray(g_indices, dtype=float).reshape(-1, 3)
+
+    # Calculate structure factors for all excited g-vectors, in chunks of
+    # g-vectors so that the (n_g, n_sites) arrays stay bounded in size.
+    if chunk_size is None:
+        chunk_size = max(1, _MAX_CHUNK_ELEMENTS // max(len(symbols), 1))
+    f_hkls = np.zeros(len(g_indices), dtype=complex)
+    for start in range(0, len(g_indices), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        s2 = s2s[chunk, np.newaxis]
+        # Atomic scattering factors and Debye-Waller corrections of every
+        # element at every g-vector, spread over the sites.
+        fs = np.column_stack([get_scattering_factors(element, s2s[chunk])
+                              for element in elements])
+        fs *= np.exp(-dwfactors * s2)
+        weights = fs[:, site_elements] * occus
+        phases = 2 * np.pi * np.dot(g_indices[chunk], fcoords.T)
+        f_hkls[chunk] = np.sum(weights * np.exp(1j * phases), axis=1)
 
     # Define an intensity scaling that is linear with distance from Ewald sphere
     # along the beam direction.
@@ -162,15 +279,38 @@ def get_kinematical_intensities(structure,
     return peak_intensities
 
 
+def _sum_atom_block(k, wavelength, atomic_coordinates, weights):
+    """The sum over a block of atoms of their weights times the phase factors
+    exp(2 pi i k.r), on the grid of k-vectors (k[i], k[j]) on the Ewald
+    sphere.
+
+    On the sphere, the phase factor of an atom factorizes into a term in k[i]
+    and a term in k[j], so that the sum is a single matrix product.
+    """
+    x, y, z = atomic_coordinates.T
+    curvature = (wavelength / 2) * np.outer(k ** 2, z)
+    phases_x = np.exp(2j * np.pi * (np.outer(k, x) + curvature))
+    phases_y = np.exp(2j * np.pi * (np.outer(k, y) + curvature))
+    return np.dot(phases_x * weights, phases_y.T)
+
+
 def simulate_kinematic_scattering(atomic_coordinates,
                                   element,
                                   accelerating_voltage,
                                   simulation_size=256,
                                   max_k = 1.5,
                                   illumination = 'plane_wave',
-                                  sigma = 20):
+                                  sigma = 20,
+                                  block_size=None,
+                                  workers=None):
     """Simulate electron scattering from an arrangement of atoms
 
+    The scattered amplitude is summed over blocks of atoms, each with a single
+    (simulation_size x atoms) by (atoms x simulation_size) complex matrix
+    product of phase factors. Besides the simulation_size**2 pattern, the
+    memory used is about 48 * simulation_size * block_size bytes per worker,
+    and the time is proportional to the number of atoms times
+    simulation_size**2.
 
     Parameters
     ----------
@@ -187,48 +327,78 @@ def simulate_kinematic_scattering(atomic_coordinates,
         Maximum scattering vector magnitude in reciprocal angstroms.
     illumination = string
         Either 'plane_wave' or 'gaussian_probe' illumination
+    sigma : float
+        Standard deviation of the Gaussian probe in Angstroms, for
+        'gaussian_probe' illumination. The probe is centred on the origin of
+        the atomic coordinates.
+    block_size : int, optional
+        The number of atoms summed at a time. Defaults to as many as keep the
+        phase factors of a block below 2**22 elements.
+    workers : int, optional
+        If specified, blocks of atoms are summed by this many threads.
 
     Returns
     -------
     simulation : ElectronDiffraction
         ElectronDiffraction simulation.
     """
-    #Get atomic scattering parameters for specified element.
-    c = np.array(ATOMIC_SCATTERING_PARAMS[element])
+    from pyxem.signals.electron_diffraction import ElectronDiffraction
+
+    atomic_coordinates = np.asarray(atomic_coordinates,
+                                    dtype=float).reshape(-1, 3)
     #Calculate electron wavelength for given keV.
     wavelength = get_electron_wavelength(accelerating_voltage)
 
     #Define a 2D array of k-vectors at which to evaluate scattering.
     l = np.linspace(-max_k, max_k, simulation_size)
-    kx, ky = np.meshgrid(l, l)
-
-    #Convert 2D k-vectors into 3D k-vectors accounting for Ewald sphere.
-    k = np.array((kx, ky, (wavelength / 2) * (kx ** 2 + ky **2)))
+    kx, ky = np.meshgrid(l, l, indexing='ij')
 
-    #Calculate scatering angle squared for each k-vector.
-    s2s = (np.linalg.norm(k, axis=0) / 2) ** 2
+    #Calculate scatering angle squared for each k-vector, accounting for the
+    #Ewald sphere.
+    s2s = (kx ** 2 + ky ** 2 +
+           ((wavelength / 2) * (kx ** 2 + ky ** 2)) ** 2) / 4
 
     #Evaluate atomic scattering factor.
-    fs = np.zeros_like(s2s)
-    for i in np.arange(4):
-        fs = fs + (c[i][0] * np.exp(-c[i][1] * s2s))
+    fs = get_scattering_factors(element, s2s)
 
-    #Evaluate scattering from all atoms
-    scattering = np.zeros_like(s2s)
+    #Weight the scattering of each atom by the illumination.
     if illumination == 'plane_wave':
-        for r in atomic_coordinates:
-            scattering = scattering + (fs * np.exp(np.dot(k.T, r) * np.pi * 2j))
-    if illumination == 'gaussian_probe':
-        for r in atomic_coordinates:
-            probe = (1 / (np.sqrt(2*np.pi)*sigma))*np.exp((-np.abs(((r[0]**2) - (r[1]**2))))/(4*sigma**2))
-            scattering = scattering + (probe * fs * np.exp(np.dot(k.T, r) * np.pi * 2j))
+        weights = np.ones(len(atomic_coordinates))
+    elif illumination == 'gaussian_probe':
+        r2 = atomic_coordinates[:, 0] ** 2 + atomic_coordinates[:, 1] ** 2
+        weights = (1 / (np.sqrt(2 * np.pi) * sigma)) * \
+            np.exp(-r2 / (4 * sigma ** 2))
     else:
         raise ValueError("User specified illumination not defined.")
 
+    #Evaluate scattering from all atoms, a block of atoms at a time.
+    if block_size is None:
+        block_size = max(1, _MAX_BLOCK_ELEMENTS // simulation_size)
+    blocks = [slice(start, start + block_size)
+              for start in range(0, len(atomic_coordinates), block_size)]
+
+    def sum_blocks(blocks):
+        scattering = np.zeros(kx.shape, dtype=complex)
+        for block in blocks:
+            scattering += _sum_atom_block(l, wavelength,
+                                          atomic_coordinates[block],
+                                          weights[block])
+        return scattering
+
+    if workers:
+        # Each thread sums every workers-th block, so that only one pattern
+        # per thread is held in memory.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scattering = sum(executor.map(
+                sum_blocks, [blocks[i::workers] for i in range(workers)]))
+    else:
+        scattering = sum_blocks(blocks)
+    scattering *= fs
+
     #Calculate intensity
-    intensity  = (scattering * scattering.conjugate()).real
+    intensity = (scattering * scattering.conjugate()).real
 
-    return pxm.ElectronDiffraction(intensity)
+    return ElectronDiffraction(intensity)
 
 
 def equispaced_s2_grid(theta_range, phi_range, resolution=2.5, no_center=False):
@@ -343,6 +513,107 @@ def astar_style_orientations(
     orientations = np.array([(a, b, c) for a, (b, c) in itertools.product(gamma, grid)])
     return orientations
 
+def local_euler_grid(euler, max_deviation, resolution):
+    """Creates the orientations of a regular Euler angle grid lying within a
+    neighbourhood of a given orientation.
+
+    The grid points are multiples of `resolution` in each angle, so the
+    neighbourhoods of nearby orientations share grid points exactly.
+
+    Parameters
+    ----------
+    euler : tuple of float
+        The (alpha, beta, gamma) Euler angles about which to create the grid,
+        in radians.
+    max_deviation : float
+        The maximum deviation of each Euler angle from `euler`, in degrees.
+    resolution : float
+        The spacing of the grid in degrees.
+
+    Returns
+    -------
+    local_grid : array-like
+        Each row contains `(alpha, beta, gamma)`, the three Euler angles of a
+        grid point in radians.
+
+    """
+    resolution = radians(resolution)
+    steps = [np.arange(np.ceil((angle - radians(max_deviation)) / resolution),
+                       np.floor((angle + radians(max_deviation)) / resolution)
+                       + 1)
+             for angle in euler[:3]]
+    local_grid = np.array(list(itertools.product(*steps))) * resolution
+    return local_grid
+
+
+def get_orientation_matrix(orientation, representation='euler'):
+    """The rotation matrix of an orientation, as applied to a structure by the
+    DiffractionLibraryGenerator.
+
+    Parameters
+    ----------
+    orientation : tuple of float
+        Euler angles (alpha, beta, gamma) in radians, in the zxz convention, or
+        an axis-angle pair (x, y, z, angle) with the angle in degrees.
+    representation : 'euler' or 'axis-angle'
+        The representation of the orientation.
+
+    Returns
+    -------
+    rotation_matrix : np.array()
+        The 3x3 rotation matrix.
+
+    """
+    if representation == 'axis-angle':
+        return axangle2mat(orientation[:3], radians(orientation[3]))
+    return euler2mat(orientation[0], orientation[1], orientation[2], 'rzxz')
+
+
+def get_symmetry_classes(orientations, rotations, representation='euler',
+                         decimals=6):
+    """Groups orientations that are equivalent under the rotations of a
+    crystal's point group.
+
+    A structure rotated by R and by R S, for S a rotation of its point group,
+    is the same structure, and therefore gives the same diffraction pattern.
+    Each orientation is labelled by the lexicographically smallest of the
+    matrices R S over the point group, which is the same for all equivalent
+    orientations.
+
+    Parameters
+    ----------
+    orientations : list of tuple
+        The orientations to group.
+    rotations : list of np.array()
+        The proper rotations of the point group as 3x3 Cartesian matrices,
+        including the identity.
+    representation : 'euler' or 'axis-angle'
+        The representation of the orientations.
+    decimals : int
+        The number of decimals to which matrices are compared.
+
+    Returns
+    -------
+    symmetry_classes : dict
+        Maps the first orientation of each class, in the order given, to the
+        list of all orientations of the class.
+
+    """
+    rotations = np.asarray(rotations)
+    symmetry_classes = {}
+    representatives = {}
+    for orientation in orientations:
+        orientation = tuple(orientation)
+        matrices = np.dot(get_orientation_matrix(orientation, representation),
+                          rotations).transpose(1, 0, 2)
+        # Add 0. to turn negative zeros into positive zeros.
+        matrices = np.round(matrices.reshape(len(rotations), 9), decimals) + 0.
+        label = min(tuple(m) for m in matrices)
+        representative = representatives.setdefault(label, orientation)
+        symmetry_classes.setdefault(representative, []).append(orientation)
+    return symmetry_classes
+
+
 def peaks_from_best_template(single_match_result,phase,library):
     """ Takes a match_result object and return the associated peaks, to be used with
     in combination with map.
@@ -19,10 +19,17 @@
 import numpy as np
 import pymatgen as pmg
 import pytest
+from pymatgen.transformations.standard_transformations import \
+    RotationTransformation
+from transforms3d.euler import euler2axangle
 from pyxem import DiffractionSimulation
 from pyxem.generators.diffraction_generator import (
     DiffractionGenerator
 )
+from pyxem.utils.atomic_scattering_params import ATOMIC_SCATTERING_PARAMS
+from pyxem.utils.sim_utils import get_electron_wavelength, \
+    get_kinematical_intensities, get_orientation_matrix, \
+    get_scattering_factors, simulate_kinematic_scattering
 
 
 @pytest.fixture(params=[
@@ -207,3 +214,113 @@ class TestDiffractionSimulation:
         diffraction_simulation.offset = offset
         assert np.allclose(diffraction_simulation.calibrated_coordinates, expected)
 
+    @pytest.mark.parametrize('with_direct_beam', [True, False])
+    def test_calculate_ed_data_batch(self, diffraction_calculator, structure,
+                                     with_direct_beam):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (1., 0.5, 2.)]
+        rotation_matrices = [get_orientation_matrix(o) for o in orientations]
+        batch = diffraction_calculator.calculate_ed_data_batch(
+            structure, rotation_matrices, 2., with_direct_beam)
+        assert len(batch) == len(orientations)
+        for orientation, diffraction in zip(orientations, batch):
+            axis, angle = euler2axangle(*orientation, axes='rzxz')
+            rotated_structure = RotationTransformation(
+                axis, angle, angle_in_radians=True).apply_transformation(
+                structure)
+            expected = diffraction_calculator.calculate_ed_data(
+                rotated_structure, 2., with_direct_beam)
+            spots, expected_spots = [
+                np.column_stack((d.indices[d.direct_beam_mask],
+                                 d.coordinates, d.intensities))
+                for d in (diffraction, expected)]
+            spots = spots[np.lexsort(spots[:, :3].T)]
+            expected_spots = expected_spots[np.lexsort(expected_spots[:, :3].T)]
+            assert np.allclose(spots, expected_spots)
+
+    def test_structure_factor_cache(self, structure):
+        diffraction_calculator = DiffractionGenerator(300., 0.02, cache_size=1)
+        structure_factors = diffraction_calculator.get_structure_factors(
+            structure, 2.)
+        axis, angle = euler2axangle(0.1, 0.2, 0.3, axes='rzxz')
+        rotated_structure = RotationTransformation(
+            axis, angle, angle_in_radians=True).apply_transformation(structure)
+        # Rotating the structure leaves its structure factors unchanged.
+        assert diffraction_calculator.get_structure_factors(
+            rotated_structure, 2.) is structure_factors
+        # The cache holds one entry, so a new radius evicts the first.
+        diffraction_calculator.get_structure_factors(structure, 1.)
+        assert diffraction_calculator.get_structure_factors(
+            structure, 2.) is not structure_factors
+        structure_factors = diffraction_calculator.get_structure_factors(
+            structure, 2.)
+        diffraction_calculator.debye_waller_factors = {'Si': 0.5}
+        dw_structure_factors = diffraction_calculator.get_structure_factors(
+            structure, 2.)
+        assert dw_structure_factors is not structure_factors
+        # Debye-Waller factors damp every reflection but the direct beam.
+        assert np.all(dw_structure_factors[2] <= structure_factors[2] + 1e-20)
+        assert np.any(dw_structure_factors[2] < structure_factors[2] - 1.)
+
+    def test_kinematical_intensities_chunks(self, structure):
+        g_indices = np.array([[0, 0, 0], [1, 1, 1], [2, 0, 0], [2, 2, 0],
+                              [3, 1, 1], [4, 0, 0], [1, 0, 0]])
+        g_hkls = np.linalg.norm(g_indices, axis=1) / 5.431
+        excitation_error = np.linspace(0., 0.01, len(g_indices))
+        intensities = get_kinematical_intensities(
+            structure, g_indices, g_hkls, excitation_error, 0.02, {'Si': 0.5})
+        for chunk_size in (1, 3):
+            assert np.allclose(get_kinematical_intensities(
+                structure, g_indices, g_hkls, excitation_error, 0.02,
+                {'Si': 0.5}, chunk_size=chunk_size), intensities)
+        # (200) and (100) are extinct in the diamond structure.
+        assert np.allclose(intensities[[2, 6]], 0.)
+        assert np.all(intensities[[0, 1, 3, 4, 5]] > 0.)
+
+
+@pytest.mark.parametrize('interpolation, tolerance', [
+    ('linear', 1e-3),
+    ('cubic', 1e-6),
+])
+def test_get_scattering_factors(interpolation, tolerance):
+    # Values beyond the table are computed from the coefficients.
+    s2 = np.array([0., 0.0123, 0.5, 2.345, 35.9999, 40.])
+    a, b = np.array(ATOMIC_SCATTERING_PARAMS['Si']).T
+    expected = np.sum(a * np.exp(-b * s2[:, np.newaxis]), axis=1)
+    scattering_factors = get_scattering_factors('Si', s2, interpolation)
+    assert np.allclose(scattering_factors, expected, rtol=tolerance,
+                       atol=1e-12)
+    with pytest.raises(ValueError):
+        get_scattering_factors('Xx', s2)
+
+
+@pytest.mark.parametrize('illumination', ['plane_wave', 'gaussian_probe'])
+def test_simulate_kinematic_scattering(illumination):
+    atomic_coordinates = np.random.RandomState(0).uniform(-10, 10, (50, 3))
+    simulation = simulate_kinematic_scattering(
+        atomic_coordinates, 'C', 300., simulation_size=16,
+        illumination=illumination, sigma=5.)
+    k = np.linspace(-1.5, 1.5, 16)
+    wavelength = get_electron_wavelength(300.)
+    weights = np.ones(len(atomic_coordinates))
+    if illumination == 'gaussian_probe':
+        weights = np.exp(-np.sum(atomic_coordinates[:, :2] ** 2, axis=1) /
+                         100.) / (np.sqrt(2 * np.pi) * 5.)
+    expected = np.zeros((16, 16))
+    for i, kx in enumerate(k):
+        for j, ky in enumerate(k):
+            k_vector = np.array([kx, ky, wavelength / 2 * (kx ** 2 + ky ** 2)])
+            f = get_scattering_factors('C', np.sum(k_vector ** 2) / 4)
+            amplitude = f * np.sum(weights * np.exp(
+                2j * np.pi * atomic_coordinates.dot(k_vector)))
+            expected[i, j] = np.abs(amplitude) ** 2
+    assert np.allclose(simulation.data, expected)
+    blocked = simulate_kinematic_scattering(
+        atomic_coordinates, 'C', 300., simulation_size=16,
+        illumination=illumination, sigma=5., block_size=7, workers=2)
+    assert np.allclose(blocked.data, expected)
+
+
+def test_simulate_kinematic_scattering_illumination():
+    with pytest.raises(ValueError):
+        simulate_kinematic_scattering(np.zeros((1, 3)), 'C', 300.,
+                                      illumination='cone')
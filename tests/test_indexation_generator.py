@@ -15,3 +15,587 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
+
+import dask.array as da
+import numpy as np
+import pymatgen as pmg
+import pytest
+from pymatgen.transformations.standard_transformations \
+    import RotationTransformation
+from transforms3d.euler import euler2axangle, euler2mat
+
+from pyxem.generators.diffraction_generator import DiffractionGenerator
+from pyxem.generators.indexation_generator import correlate_library, \
+    correlate_orientation, IndexationGenerator, VectorIndexationGenerator
+from pyxem.signals.diffraction_library import DiffractionLibrary
+from pyxem.signals.diffraction_simulation import DiffractionSimulation
+from pyxem.signals.diffraction_vectors import DiffractionVectors
+from pyxem.signals.electron_diffraction import ElectronDiffraction, \
+    LazyElectronDiffraction
+from pyxem.signals.indexation_results import IndexationResults, \
+    LazyIndexationResults
+from pyxem.signals.template_bank import TemplateBank, load_template_bank
+from pyxem.utils import correlate
+from pyxem.utils.indexation_utils import correlate_template_bank, \
+    correlate_template_bank_batch, get_top_correlations_pruned, \
+    get_polar_templates, correlate_polar_templates, normalize_correlations, \
+    get_top_correlations, get_frame_fingerprints, get_score_agreement
+from pyxem.utils.expt_utils import reproject_polar
+
+
+def _pattern(pixel_coords, intensities):
+    intensities = np.array(intensities, dtype=float)
+    return {'Sim': None,
+            'intensities': intensities,
+            'pixel_coords': np.array(pixel_coords),
+            'pattern_norm': np.sqrt(np.dot(intensities, intensities))}
+
+
+@pytest.fixture
+def library():
+    library = DiffractionLibrary()
+    library['A'] = {
+        (0., 0., 0.): _pattern([[1, 1], [2, 3]], [1., 2.]),
+        (0., 0., 1.): _pattern([[4, 4], [5, 5], [6, 1]], [3., 1., 1.]),
+        (0., 1., 0.): _pattern([[7, 7]], [1.]),
+    }
+    library['B'] = {
+        (1., 0., 0.): _pattern([[2, 3], [4, 4]], [1., 1.]),
+        (1., 1., 0.): _pattern([[0, 0], [6, 1]], [2., 5.]),
+    }
+    return library
+
+
+@pytest.fixture
+def image():
+    return np.random.RandomState(0).rand(8, 8)
+
+
+def test_get_template_bank(library):
+    bank = library.get_template_bank()
+    assert isinstance(bank, TemplateBank)
+    assert bank.n_templates == 5
+    assert bank.keys == ['A', 'B']
+    assert np.all(bank.phase_offsets == [0, 3, 5])
+    assert np.all(bank.offsets == [0, 2, 5, 6, 8, 10])
+    assert np.all(bank.template_phases == [0, 0, 0, 1, 1])
+
+
+def test_get_template_bank_keys(library):
+    bank = library.get_template_bank(['B', 'A'])
+    assert bank.keys == ['B', 'A']
+    assert np.allclose(bank.orientations[0], (1., 0., 0.))
+
+
+def test_correlate_template_bank(library, image):
+    bank = library.get_template_bank()
+    expected = [correlate(image, pattern)
+                for key in library for pattern in library[key].values()]
+    assert np.allclose(correlate_template_bank(image, bank), expected)
+
+
+def test_correlate_template_bank_outside(library, image):
+    library['B'][(1., 1., 0.)]['pixel_coords'] = np.array([[0, 0], [6, 8]])
+    with pytest.raises(ValueError, match=r"phase B at orientation "
+                                         r"\(1\.0, 1\.0, 0\.0\)"):
+        correlate_template_bank(image, library.get_template_bank())
+
+
+@pytest.mark.parametrize('n_largest', [1, 2])
+def test_correlate_library(library, image, n_largest):
+    result = correlate_library(image, library.get_template_bank(), n_largest)
+    assert result.shape == (2 * n_largest, 5)
+    for i, key in enumerate(library):
+        correlations = {o: correlate(image, p) for o, p in library[key].items()}
+        best = sorted(correlations.items(), key=lambda c: c[1],
+                      reverse=True)[:n_largest]
+        phase_result = result[i * n_largest:(i + 1) * n_largest]
+        assert np.all(phase_result[:, 0] == i)
+        assert np.allclose(phase_result[:, 1:4], [b[0] for b in best])
+        assert np.allclose(phase_result[:, 4], [b[1] for b in best])
+
+
+def test_correlate_template_bank_batch(library, image):
+    bank = library.get_template_bank()
+    images = np.stack([image, image.T, 2 * image])
+    correlations = correlate_template_bank_batch(images, bank)
+    assert correlations.shape == (3, bank.n_templates)
+    for frame, frame_correlations in zip(images, correlations):
+        assert np.allclose(frame_correlations,
+                           correlate_template_bank(frame, bank))
+
+
+@pytest.mark.parametrize('n_largest', [1, 2, 3, 5])
+def test_get_top_correlations(library, n_largest):
+    bank = library.get_template_bank()
+    correlations = np.random.RandomState(10).rand(4, bank.n_templates)
+    top = get_top_correlations(correlations, bank, n_largest)
+    assert top.shape == (4, 2 * n_largest, 5)
+    for i in range(2):
+        phase_slice = bank.phase_slice(i)
+        expected = -np.sort(-correlations[:, phase_slice], axis=1)
+        n_kept = min(n_largest, expected.shape[1])
+        rows = top[:, i * n_largest:i * n_largest + n_kept]
+        assert np.allclose(rows[..., 4], expected[:, :n_kept])
+        assert np.all(rows[..., 0] == i)
+        assert np.all(top[:, i * n_largest + n_kept:(i + 1) * n_largest] == 0)
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 100])
+def test_correlate_batch_size(library, batch_size):
+    data = np.random.RandomState(1).rand(3, 2, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    matching_results = indexer.correlate(n_largest=2, batch_size=batch_size)
+    assert isinstance(matching_results, IndexationResults)
+    assert matching_results.data.shape == (3, 2, 4, 5)
+    bank = library.get_template_bank()
+    for index in np.ndindex(3, 2):
+        assert np.allclose(matching_results.data[index],
+                           correlate_library(data[index], bank, 2))
+
+
+def test_template_bank_save_load(library, tmpdir):
+    bank = library.get_template_bank()
+    bank.save(str(tmpdir))
+    loaded = load_template_bank(str(tmpdir), mmap_mode='r')
+    assert loaded.keys == bank.keys
+    assert np.all(loaded.offsets == bank.offsets)
+    assert np.allclose(loaded.intensities, bank.intensities)
+
+
+@pytest.mark.parametrize('batch_size', [None, 2])
+def test_correlate_workers(library, batch_size):
+    data = np.random.RandomState(2).rand(3, 2, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    matching_results = indexer.correlate(n_largest=2, workers=2,
+                                         batch_size=batch_size)
+    expected = indexer.correlate(n_largest=2, batch_size=6)
+    assert np.allclose(matching_results.data, expected.data)
+
+
+class _GridLibraryGenerator:
+    """Stands in for DiffractionLibraryGenerator, simulating a single spot
+    whose position encodes the first two Euler angles."""
+
+    def __init__(self):
+        self.simulated = []
+        self.n_calls = 0
+
+    def get_diffraction_library(self, structure_library, calibration,
+                                reciprocal_radius, half_shape,
+                                representation, with_direct_beam):
+        self.n_calls += 1
+        library = DiffractionLibrary()
+        for key, (structure, orientations) in structure_library.items():
+            self.simulated.extend(orientations)
+            library[key] = {
+                tuple(o): _pattern([[int(round(np.degrees(o[0]))) % 8,
+                                     int(round(np.degrees(o[1]))) % 8]], [1.])
+                for o in orientations}
+        return library
+
+
+def test_correlate_hierarchical():
+    rows, columns = np.mgrid[:8, :8]
+    data = np.array([np.exp(-((rows - r) ** 2 + (columns - c) ** 2) / 8.)
+                     for r, c in [(3, 5), (1, 1)]])
+    coarse_library = DiffractionLibrary()
+    coarse_library['A'] = {
+        tuple(np.radians(o)): _pattern([[o[0], o[1]]], [1.])
+        for o in [(0, 0, 0), (4, 4, 0), (0, 4, 0), (4, 0, 0)]}
+    library_generator = _GridLibraryGenerator()
+    indexer = IndexationGenerator(ElectronDiffraction(data), coarse_library)
+    fine_library = DiffractionLibrary()
+    matching_results = indexer.correlate_hierarchical(
+        library_generator, {'A': (None, [])}, 1., 1., (4, 4),
+        coarse_resolution=4., fine_resolution=1., n_coarse=1, n_largest=1,
+        fine_library=fine_library)
+    assert matching_results.data.shape == (2, 1, 5)
+    assert np.allclose(np.degrees(matching_results.data[0, 0, 1:3]), (3, 5))
+    assert np.allclose(np.degrees(matching_results.data[1, 0, 1:3]), (1, 1))
+    # Fine templates are simulated at most once, in a single call.
+    assert library_generator.n_calls == 1
+    assert len(library_generator.simulated) == \
+        len(set(library_generator.simulated))
+    assert len(fine_library['A']) == len(library_generator.simulated)
+
+
+def test_get_pixel_statistics():
+    library = DiffractionLibrary()
+    library['A'] = {(0., 0., 0.): _pattern([[1, 1], [1, 1], [2, 2]],
+                                           [1., 2., 2.])}
+    pixel_counts, pixel_sums, pixel_norms = \
+        library.get_template_bank().get_pixel_statistics()
+    assert np.all(pixel_counts == [2])
+    assert np.allclose(pixel_sums, [5.])
+    assert np.allclose(pixel_norms, [np.sqrt(13.)])
+
+
+@pytest.mark.parametrize('n_largest, block_size', [(1, 1), (2, 1), (2, 64)])
+def test_get_top_correlations_pruned(n_largest, block_size):
+    random = np.random.RandomState(3)
+    library = DiffractionLibrary()
+    for key in ['A', 'B']:
+        library[key] = {(float(i), 0., 0.): _pattern(
+            random.randint(0, 16, (5, 2)), random.rand(5)) for i in range(50)}
+    bank = library.get_template_bank()
+    image = random.rand(16, 16) ** 8
+    result, n_pruned = get_top_correlations_pruned(image, bank, n_largest,
+                                                   block_size)
+    assert np.allclose(result, correlate_library(image, bank, n_largest))
+    assert 0 <= n_pruned < bank.n_templates
+
+
+def test_get_top_correlations_pruned_exact_match():
+    random = np.random.RandomState(5)
+    library = DiffractionLibrary()
+    library['A'] = {(float(i), 0., 0.): _pattern(
+        random.choice(256, 5, replace=False)[:, np.newaxis] // [16, 1] % 16,
+        random.rand(5)) for i in range(50)}
+    bank = library.get_template_bank()
+    # A pattern reproducing one template exactly reaches the bound of every
+    # template, so all templates scored after it are pruned.
+    image = np.zeros((16, 16))
+    pattern = library['A'][(10., 0., 0.)]
+    image[pattern['pixel_coords'][:, 0], pattern['pixel_coords'][:, 1]] = \
+        pattern['intensities']
+    result, n_pruned = get_top_correlations_pruned(image, bank, 1, 1)
+    assert np.allclose(result[0, 1:4], (10., 0., 0.))
+    assert n_pruned > 0
+
+
+def test_correlate_prune(library):
+    data = np.random.RandomState(4).rand(2, 2, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    matching_results = indexer.correlate(n_largest=1, prune=True)
+    expected = indexer.correlate(n_largest=1, batch_size=4)
+    assert np.allclose(matching_results.data, expected.data)
+    assert matching_results.metadata.Indexation.pruned_templates >= 0
+
+
+def _spot_pattern(angles, radius=20., size=64, sigma=1.5):
+    rows, columns = np.mgrid[:size, :size]
+    pattern = np.zeros((size, size))
+    for angle in angles:
+        row = size // 2 + radius * np.cos(angle)
+        column = size // 2 + radius * np.sin(angle)
+        pattern += np.exp(-((rows - row) ** 2 + (columns - column) ** 2) /
+                          (2 * sigma ** 2))
+    return pattern
+
+
+def test_correlate_polar_templates():
+    angles = np.array([0.3, 1.1, 2.5, 4.0])
+    library = DiffractionLibrary()
+    library['A'] = {(0., 0., 0.): _pattern(
+        np.rint([[32 + 20 * np.cos(a), 32 + 20 * np.sin(a)] for a in angles]),
+        [1., 1., 1., 1.])}
+    bank = library.get_template_bank()
+    polar_templates = get_polar_templates(bank, (64, 64))
+    image = _spot_pattern(angles)
+    correlations = correlate_polar_templates(
+        reproject_polar(image, periodic=True), bank, polar_templates)
+    assert correlations.shape == (1, polar_templates['n_theta'])
+    assert np.argmax(correlations[0]) in (0, 1, polar_templates['n_theta'] - 1)
+
+
+def test_correlate_in_plane():
+    angles = np.array([0.3, 1.1, 2.5, 4.0])
+    library = DiffractionLibrary()
+    library['A'] = {
+        (0., 0., 0.): _pattern(np.rint([[32 + 20 * np.cos(a),
+                                         32 + 20 * np.sin(a)]
+                                        for a in angles]), [1.] * 4),
+        (0., 1., 0.): _pattern([[32, 40], [32, 24]], [1., 1.])}
+    rotation = 0.7
+    data = np.array([_spot_pattern(angles + rotation)])
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    matching_results = indexer.correlate_in_plane(n_largest=1)
+    best = matching_results.data[0, 0]
+    assert np.allclose(best[2:4], (0., 0.))
+    theta_step = 2 * np.pi / 64
+    assert abs(best[1] - rotation) < 1.5 * theta_step
+
+
+@pytest.mark.parametrize('rotation', [np.pi - 0.05, np.pi, np.pi + 0.05,
+                                      -0.05])
+def test_correlate_in_plane_seam(rotation):
+    # Rotations across the start of the angular axis are recovered exactly
+    # up to the angular step.
+    angles = np.array([0.3, 1.1, 2.5, 4.0])
+    library = DiffractionLibrary()
+    library['A'] = {(0., 0., 0.): _pattern(
+        np.rint([[32 + 20 * np.cos(a), 32 + 20 * np.sin(a)] for a in angles]),
+        [1.] * 4)}
+    data = np.array([_spot_pattern(angles + rotation)])
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    best = indexer.correlate_in_plane(n_largest=1, dt=2 * np.pi / 360).data[0]
+    error = np.angle(np.exp(1j * (best[0, 1] - rotation)))
+    assert abs(error) <= 2 * np.pi / 360
+
+
+def test_normalize_correlations(library, image):
+    bank = library.get_template_bank()
+    images = np.stack([image, image ** 2])
+    correlations = correlate_template_bank_batch(images, bank)
+    normalized = normalize_correlations(correlations, images, bank)
+    for frame, frame_normalized in zip(images, normalized):
+        for key in library:
+            for orientation, pattern in library[key].items():
+                template = np.zeros(frame.shape)
+                np.add.at(template, tuple(pattern['pixel_coords'].T),
+                          pattern['intensities'])
+                expected = np.corrcoef(frame.ravel(), template.ravel())[0, 1]
+                index = list(bank.orientations.tolist()).index(
+                    list(orientation))
+                assert np.isclose(frame_normalized[index], expected)
+
+
+def test_normalize_correlations_uniform_pattern(library):
+    bank = library.get_template_bank()
+    images = np.ones((1, 8, 8))
+    correlations = correlate_template_bank_batch(images, bank)
+    assert np.all(normalize_correlations(correlations, images, bank) == 0)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_normalize_correlations_integer_data(library, dtype):
+    images = (np.random.RandomState(7).rand(2, 8, 8) *
+              np.iinfo(dtype).max).astype(dtype)
+    bank = library.get_template_bank()
+    correlations = correlate_template_bank_batch(images, bank)
+    assert np.allclose(
+        normalize_correlations(correlations, images, bank),
+        normalize_correlations(correlations, images.astype(float), bank))
+    data = images.reshape(2, 1, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    expected = IndexationGenerator(ElectronDiffraction(data.astype(float)),
+                                   library).correlate(n_largest=2,
+                                                      normalize=True)
+    for kwargs in ({}, {'batch_size': 2}, {'workers': 2}):
+        assert np.allclose(indexer.correlate(n_largest=2, normalize=True,
+                                             **kwargs).data, expected.data)
+
+
+@pytest.mark.parametrize('batch_size, workers', [(None, None), (2, None),
+                                                 (None, 2)])
+def test_correlate_normalize(library, batch_size, workers):
+    data = np.random.RandomState(6).rand(2, 2, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    matching_results = indexer.correlate(n_largest=2, normalize=True,
+                                         batch_size=batch_size,
+                                         workers=workers)
+    scores = matching_results.data[..., 4]
+    assert np.all(np.abs(scores) <= 1)
+    expected = correlate_library(data[0, 1], library.get_template_bank(), 2,
+                                 normalize=True)
+    assert np.allclose(matching_results.data[0, 1], expected)
+
+
+@pytest.mark.parametrize('n_largest', [1, 2])
+def test_correlate_lazy(library, tmpdir, n_largest):
+    data = np.random.RandomState(7).rand(4, 3, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    expected = indexer.correlate(n_largest=n_largest, batch_size=12)
+    lazy_signal = LazyElectronDiffraction(da.from_array(data,
+                                                        chunks=(2, 2, 4, 8)))
+    lazy_indexer = IndexationGenerator(lazy_signal, library)
+    matching_results = lazy_indexer.correlate(n_largest=n_largest)
+    assert isinstance(matching_results, LazyIndexationResults)
+    assert np.allclose(np.asarray(matching_results.data), expected.data)
+    filename = str(tmpdir.join('matching_results.hdf5'))
+    stored_results = lazy_indexer.correlate(n_largest=n_largest,
+                                            filename=filename)
+    assert np.allclose(np.asarray(stored_results.data), expected.data)
+    # The file is closed, so the same file can be written again.
+    stored_results = lazy_indexer.correlate(n_largest=n_largest,
+                                            filename=filename)
+    assert np.allclose(np.asarray(stored_results.data), expected.data)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'batch_size': 2},
+                                    {'workers': 2}, {'prune': True}])
+def test_correlate_mask(library, kwargs):
+    data = np.random.RandomState(8).rand(3, 2, 8, 8)
+    mask = np.zeros((3, 2), dtype=bool)
+    mask[0, 1] = mask[2, 0] = True
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    expected = indexer.correlate(n_largest=2, batch_size=6)
+    matching_results = indexer.correlate(n_largest=2, mask=mask, **kwargs)
+    assert np.all(np.isnan(matching_results.data[mask]))
+    assert np.allclose(matching_results.data[~mask], expected.data[~mask])
+    assert np.array_equal(
+        matching_results.metadata.Indexation.navigation_mask, mask)
+
+
+def test_correlate_mask_lazy(library):
+    data = np.random.RandomState(9).rand(4, 3, 8, 8)
+    mask = np.zeros((4, 3), dtype=bool)
+    mask[:2, 0] = True
+    expected = IndexationGenerator(ElectronDiffraction(data),
+                                   library).correlate(n_largest=2, mask=mask,
+                                                      batch_size=12)
+    lazy_signal = LazyElectronDiffraction(da.from_array(data,
+                                                        chunks=(2, 2, 4, 8)))
+    matching_results = IndexationGenerator(lazy_signal, library).correlate(
+        n_largest=2, mask=mask)
+    assert np.allclose(np.asarray(matching_results.data), expected.data,
+                       equal_nan=True)
+
+
+def test_correlate_mask_shape(library):
+    indexer = IndexationGenerator(ElectronDiffraction(np.zeros((3, 2, 8, 8))),
+                                  library)
+    with pytest.raises(ValueError):
+        indexer.correlate(mask=np.zeros((2, 3), dtype=bool))
+
+
+def _simulated_pattern(structure, diffraction_generator, euler, size=192,
+                       sigma=1.):
+    axis, angle = euler2axangle(euler[0], euler[1], euler[2], 'rzxz')
+    rotation = RotationTransformation(axis, angle, angle_in_radians=True)
+    simulation = diffraction_generator.calculate_ed_data(
+        rotation.apply_transformation(structure), 2., False)
+    simulation.calibration = 0.025
+    rows, cols = np.mgrid[:size, :size]
+    pattern = np.zeros((size, size))
+    for (row, col), intensity in zip(
+            simulation.calibrated_coordinates[:, :2] + size // 2,
+            simulation.intensities):
+        pattern += intensity * np.exp(-((rows - row) ** 2 + (cols - col) ** 2)
+                                      / (2 * sigma ** 2))
+    return pattern
+
+
+def _misorientation(euler_1, euler_2):
+    rotation = euler2mat(*euler_1, axes='rzxz').T.dot(
+        euler2mat(*euler_2, axes='rzxz'))
+    return np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1, 1)))
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_refine_orientations(workers):
+    structure = pmg.Structure.from_spacegroup(
+        'Fd-3m', pmg.Lattice.cubic(5.431), [pmg.Element('Si')], [[0, 0, 0]])
+    diffraction_generator = DiffractionGenerator(300., 0.02)
+    euler = np.radians([10., 30., 20.])
+    pattern = _simulated_pattern(structure, diffraction_generator, euler)
+    data = np.stack([pattern, np.zeros_like(pattern)])
+    library = DiffractionLibrary()
+    library['Si'] = {}
+    start = euler + np.radians([2., -2., 1.])
+    matching_results = IndexationResults(np.array([
+        [[0., *start, 1.], [0., 0., 0., 0., 0.]],
+        [[np.nan] * 5, [np.nan] * 5]]))
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    refined_results = indexer.refine_orientations(
+        matching_results, {'Si': (structure, [])}, diffraction_generator,
+        0.025, 2., (96, 96), resolution=2., workers=workers,
+        with_direct_beam=False)
+    assert refined_results.data.shape == (2, 1, 5)
+    refined = refined_results.data[0, 0]
+    assert _misorientation(refined[1:4], euler) < 0.2
+    assert refined[4] >= correlate_orientation(
+        pattern, start, structure, diffraction_generator, 0.025, 2.,
+        (96, 96), False)
+    assert np.all(np.isnan(refined_results.data[1]))
+
+
+def _vector_pattern(coordinates):
+    coordinates = np.column_stack((coordinates, np.zeros(len(coordinates))))
+    intensities = np.ones(len(coordinates))
+    simulation = DiffractionSimulation(coordinates=coordinates,
+                                       intensities=intensities,
+                                       with_direct_beam=True)
+    return {'Sim': simulation,
+            'intensities': intensities,
+            'pixel_coords': np.zeros((len(coordinates), 2), dtype=int),
+            'pattern_norm': np.sqrt(len(coordinates))}
+
+
+def test_index_vectors():
+    library = DiffractionLibrary()
+    library['A'] = {
+        (0., 0., 0.): _vector_pattern([[0.5, 0.], [0., 0.5], [-0.5, 0.]]),
+        (0., 0., 1.): _vector_pattern([[0.5, 0.02], [0., 0.5]]),
+        (0., 1., 0.): _vector_pattern([[1., 1.]]),
+    }
+    library['B'] = {
+        (1., 0., 0.): _vector_pattern([[0.7, 0.7], [-0.7, -0.7]]),
+    }
+    vectors = np.empty((2,), dtype=object)
+    vectors[0] = np.array([[0.5, 0.01], [0.01, 0.5], [-0.5, 0.]])
+    vectors[1] = np.array([[0.7, 0.71], [3., 3.]])
+    indexer = VectorIndexationGenerator(DiffractionVectors(vectors), library)
+    matching_results = indexer.index_vectors(0.05, n_largest=2)
+    assert matching_results.data.shape == (2, 4, 5)
+    first, second = matching_results.data
+    # Three matched vectors beat two, and equal counts rank by residual.
+    assert np.allclose(first[:2, :4], [[0, 0, 0, 0], [0, 0, 0, 1]])
+    assert np.isclose(first[0, 4], 3 - (0.01 + 0.01 + 0.) / 3 / 0.05)
+    assert np.isclose(first[1, 4], 2 - (0.01 + 0.01) / 2 / 0.05)
+    assert np.all(first[2:] == 0)
+    assert np.all(second[:2] == 0)
+    assert np.allclose(second[2], [1, 1, 0, 0, 1 - 0.01 / 0.05])
+
+
+def test_get_frame_fingerprints():
+    frames = np.zeros((3, 8, 8))
+    frames[0, 0, 0] = 1.
+    frames[1, 1, 1] = 1.2
+    frames[2, 4, 4] = 1.
+    fingerprints = get_frame_fingerprints(frames, 2, 0.5)
+    assert fingerprints[0] == fingerprints[1]
+    assert fingerprints[0] != fingerprints[2]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'batch_size': 2}])
+def test_correlate_cache(library, kwargs):
+    frames = np.random.RandomState(11).rand(3, 8, 8)
+    data = frames[[0, 1, 0, 2, 1, 0]].reshape(3, 2, 8, 8)
+    data[2, 1] = 0.
+    mask = np.zeros((3, 2), dtype=bool)
+    mask[1, 1] = True
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    expected = indexer.correlate(n_largest=2, batch_size=6, mask=mask)
+    matching_results = indexer.correlate(n_largest=2, mask=mask, cache=True,
+                                         cache_binning=1, **kwargs)
+    assert np.allclose(matching_results.data, expected.data, equal_nan=True)
+    metadata = matching_results.metadata.Indexation
+    # Frames 2 and 4 repeat frames 0 and 1, and frame 3 is masked.
+    assert metadata.cache_hits == 2
+    assert metadata.cache_hit_rate == 2 / 5
+    assert np.array_equal(metadata.navigation_mask, mask)
+
+
+@pytest.mark.parametrize('intensity_dtype', [np.float16, np.float32])
+def test_template_bank_compact(library, intensity_dtype):
+    bank = library.get_template_bank()
+    compact_bank = bank.compact(intensity_dtype)
+    assert compact_bank.pixel_coords.dtype == np.int16
+    assert compact_bank.intensities.dtype == intensity_dtype
+    assert compact_bank.pattern_norms.dtype == np.float32
+    images = np.random.RandomState(12).rand(5, 8, 8)
+    scores = correlate_template_bank_batch(images, compact_bank)
+    assert scores.dtype == np.float32
+    assert np.allclose(correlate_template_bank(images[0], compact_bank),
+                       scores[0], rtol=1e-5)
+    agreement = get_score_agreement(images, compact_bank, bank, n_largest=2)
+    assert agreement['max_rel_error'] < 1e-3
+    assert agreement['top_agreement'] == 1.
+
+
+def test_template_bank_compact_overflow(library):
+    library['A'][(0., 0., 0.)]['intensities'][0] = 1e6
+    with pytest.raises(ValueError):
+        library.get_template_bank().compact(np.float16)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'batch_size': 2}, {'prune': True}])
+def test_correlate_intensity_dtype(library, kwargs):
+    data = np.random.RandomState(13).rand(2, 2, 8, 8)
+    indexer = IndexationGenerator(ElectronDiffraction(data), library)
+    expected = indexer.correlate(n_largest=2, **kwargs)
+    matching_results = indexer.correlate(n_largest=2,
+                                         intensity_dtype=np.float32, **kwargs)
+    assert np.allclose(matching_results.data, expected.data, rtol=1e-5)
@@ -16,12 +16,23 @@
 # You should have received a copy of the GNU General Public License
 # along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
 
+import numpy as np
 import pytest
 import pymatgen as pmg
+from transforms3d.euler import euler2mat, mat2euler
 
 from pyxem.generators.diffraction_generator import DiffractionGenerator
-from pyxem.generators.library_generator import DiffractionLibraryGenerator
-from pyxem.signals.diffraction_library import DiffractionLibrary
+from pyxem.generators.indexation_generator import IndexationGenerator, \
+    VectorIndexationGenerator
+from pyxem.generators.library_generator import DiffractionLibraryGenerator, \
+    LibraryCache, get_library_hash
+from pyxem.signals.diffraction_library import DiffractionLibrary, \
+    load_diffraction_library
+from pyxem.signals.diffraction_vectors import DiffractionVectors
+from pyxem.signals.electron_diffraction import ElectronDiffraction
+from pyxem.signals.indexation_results import IndexationResults
+from pyxem.utils.indexation_utils import correlate_template_bank, \
+    correlate_template_bank_batch
 
 
 @pytest.fixture
@@ -70,4 +81,364 @@ class TestDiffractionLibraryGenerator:
     ):
         library = library_generator.get_diffraction_library(
             structure_library, calibration, reciprocal_radius,half_shape, representation)
-        assert isinstance(library, DiffractionLibrary)
\ No newline at end of file
+        assert isinstance(library, DiffractionLibrary)
+
+    def test_get_diffraction_library_reduce_symmetry(
+            self, library_generator, structure):
+        generic = (0.1, 0.2, 0.3)
+        # A generic orientation followed by a fourfold rotation of the cubic
+        # point group.
+        equivalent = mat2euler(euler2mat(*generic, axes='rzxz').dot(
+            euler2mat(np.pi / 2, 0, 0, axes='rzxz')), axes='rzxz')
+        orientations = [(0., 0., 0.), generic, (np.pi / 2, 0., 0.),
+                        (0., np.pi / 2, 0.), equivalent]
+        structure_library = {'Si': (structure, orientations)}
+        library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler',
+            reduce_symmetry=True)
+        assert set(library['Si']) == {(0., 0., 0.), generic}
+        assert library.get_equivalent_orientations('Si', (0., 0., 0.)) == \
+            [(0., 0., 0.), (np.pi / 2, 0., 0.), (0., np.pi / 2, 0.)]
+        assert library.get_equivalent_orientations('Si', generic) == \
+            [generic, tuple(equivalent)]
+        full_library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler')
+        # Equivalent orientations give the same pattern.
+        patterns = [full_library['Si'][o]['Sim'] for o in
+                    (generic, tuple(equivalent))]
+        spots = [np.round(np.column_stack((p.coordinates, p.intensities)), 6)
+                 for p in patterns]
+        spots = [s[np.lexsort(s.T)] for s in spots]
+        assert np.allclose(spots[0], spots[1])
+
+    def test_expand_symmetry(self, library_generator, structure):
+        orientations = [(0., 0., 0.), (np.pi / 2, 0., 0.), (0.1, 0.2, 0.3)]
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations)}, 0.017, 2.4, (72, 72), 'euler',
+            reduce_symmetry=True)
+        matching_results = IndexationResults(np.array([
+            [[0., 0., 0., 0., 2.], [0., 0.1, 0.2, 0.3, 1.]]]))
+        expanded = matching_results.expand_symmetry(library).data[0]
+        assert expanded.shape == (4, 5)
+        assert np.allclose(expanded[:3], [[0., 0., 0., 0., 2.],
+                                          [0., np.pi / 2, 0., 0., 2.],
+                                          [0., 0.1, 0.2, 0.3, 1.]])
+        assert np.all(np.isnan(expanded[3]))
+
+    def test_get_diffraction_library_workers(self, library_generator,
+                                             structure):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (0.3, 0.2, 0.1),
+                        (0.5, 0.5, 0.5), (1., 0.5, 0.)]
+        structure_library = {'Si': (structure, orientations),
+                             'Si2': (structure, orientations[::-1])}
+        library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler')
+        parallel_library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler', workers=2,
+            chunk_size=2)
+        assert list(parallel_library) == list(library)
+        for key in library:
+            assert list(parallel_library[key]) == list(library[key])
+            for orientation, pattern in library[key].items():
+                parallel_pattern = parallel_library[key][orientation]
+                assert np.allclose(parallel_pattern['intensities'],
+                                   pattern['intensities'])
+                assert np.array_equal(parallel_pattern['pixel_coords'],
+                                      pattern['pixel_coords'])
+
+    def test_save_load_diffraction_library(self, library_generator, structure,
+                                           tmpdir):
+        orientations = [(0., 0., 0.), (np.pi / 2, 0., 0.), (0.1, 0.2, 0.3)]
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations)}, 0.017, 2.4, (72, 72), 'euler',
+            with_direct_beam=False, reduce_symmetry=True)
+        directory = str(tmpdir.join('library'))
+        library.save(directory)
+        loaded = load_diffraction_library(directory, accelerating_voltage=300.,
+                                          half_shape=(72, 72),
+                                          calibration=0.017)
+        # Entries are built on access, as views into the loaded bank.
+        template_bank = loaded.get_template_bank()
+        assert template_bank is loaded.get_template_bank()
+        assert not loaded['Si']._entries
+        assert np.shares_memory(loaded['Si'][(0., 0., 0.)]['intensities'],
+                                template_bank.intensities)
+        assert loaded.symmetry_map == library.symmetry_map
+        assert list(loaded['Si']) == list(library['Si'])
+        for orientation, pattern in library['Si'].items():
+            loaded_pattern = loaded['Si'][orientation]
+            assert np.allclose(loaded_pattern['intensities'],
+                               pattern['intensities'])
+            assert np.array_equal(loaded_pattern['pixel_coords'],
+                                  pattern['pixel_coords'])
+            assert np.allclose(loaded_pattern['Sim'].calibrated_coordinates,
+                               pattern['Sim'].calibrated_coordinates)
+        with pytest.raises(ValueError):
+            load_diffraction_library(directory, accelerating_voltage=200.)
+        with pytest.raises(ValueError):
+            load_diffraction_library(directory, camera_length=1.)
+
+    def test_save_numpy_parameters(self, library_generator, structure,
+                                   tmpdir):
+        half_shape = tuple(np.array((144, 144)) // 2)
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, [(0., 0., 0.)])}, np.float32(0.017),
+            np.float64(2.4), half_shape, 'euler')
+        directory = str(tmpdir.join('library'))
+        library.save(directory)
+        loaded = load_diffraction_library(directory, half_shape=(72, 72),
+                                          calibration=0.017)
+        assert loaded.parameters == library.parameters
+        # Parameters that cannot be saved leave no files behind.
+        library.parameters['unsaveable'] = object()
+        with pytest.raises(TypeError):
+            library.save(str(tmpdir.join('unsaveable')))
+        assert not tmpdir.join('unsaveable').check()
+
+    def test_loaded_template_bank_written(self, library_generator, structure,
+                                          tmpdir):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3)]
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations)}, 0.017, 2.4, (72, 72), 'euler')
+        directory = str(tmpdir.join('library'))
+        library.save(directory)
+        loaded = load_diffraction_library(directory)
+        # Replacing an entry, or an array of one, discards the saved bank.
+        loaded['Si'][(0., 0., 0.)] = library['Si'][(0.1, 0.2, 0.3)]
+        template_bank = loaded.get_template_bank()
+        assert np.array_equal(template_bank.intensities[
+            template_bank.offsets[0]:template_bank.offsets[1]],
+            library['Si'][(0.1, 0.2, 0.3)]['intensities'])
+        loaded = load_diffraction_library(directory)
+        loaded.get_template_bank()
+        loaded['Si'][(0.1, 0.2, 0.3)]['intensities'] = np.zeros(
+            len(library['Si'][(0.1, 0.2, 0.3)]['intensities']))
+        template_bank = loaded.get_template_bank()
+        assert not np.any(template_bank.intensities[
+            template_bank.offsets[1]:template_bank.offsets[2]])
+
+    def test_library_cache(self, diffraction_calculator, structure, tmpdir):
+        cache = LibraryCache(str(tmpdir.join('cache')))
+        library_generator = DiffractionLibraryGenerator(diffraction_calculator,
+                                                        cache=cache)
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3)]
+        structure_library = {'Si': (structure, orientations)}
+        library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler')
+        cached = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler')
+        assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+        assert list(cached['Si']) == list(library['Si'])
+        for orientation, pattern in library['Si'].items():
+            assert np.allclose(cached['Si'][orientation]['intensities'],
+                               pattern['intensities'])
+        # Changing any input simulates a new library.
+        library_generator.get_diffraction_library(
+            structure_library, 0.02, 2.4, (72, 72), 'euler')
+        library_generator.get_diffraction_library(
+            {'Si': (structure, orientations[:1])}, 0.017, 2.4, (72, 72),
+            'euler')
+        assert (cache.hits, cache.misses, len(cache)) == (1, 3, 3)
+        assert cache.statistics['hit_rate'] == 0.25
+        # Libraries least recently used are evicted beyond the maximum size.
+        cache.get(get_library_hash(structure_library,
+                                   dict(library.parameters,
+                                        reduce_symmetry=False)))
+        cache.max_size = cache.size // 2
+        cache.evict()
+        assert 0 < len(cache) < 3 and cache.size <= cache.max_size
+        assert library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler') is not None
+        assert cache.hits == 3
+
+    def test_library_cache_numpy_parameters(self, diffraction_calculator,
+                                            structure, tmpdir):
+        structure_library = {'Si': (structure, [(0., 0., 0.)])}
+        assert get_library_hash(structure_library, {
+            'calibration': np.float64(0.017),
+            'half_shape': np.array((72, 72)), 'reciprocal_radius': 2.4}) == \
+            get_library_hash(structure_library, {
+                'calibration': 0.017, 'half_shape': (72, 72),
+                'reciprocal_radius': 2.4})
+        cache = LibraryCache(str(tmpdir.join('cache')))
+        library_generator = DiffractionLibraryGenerator(diffraction_calculator,
+                                                        cache=cache)
+        library_generator.get_diffraction_library(
+            structure_library, np.float32(0.015625), 2.4,
+            tuple(np.array((144, 144)) // 2), 'euler')
+        library_generator.get_diffraction_library(
+            structure_library, 0.015625, 2.4, (72, 72), 'euler')
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    @pytest.mark.parametrize('on_disk', [False, True])
+    def test_extend_diffraction_library(self, library_generator, structure,
+                                        tmpdir, on_disk):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (0.3, 0.2, 0.1),
+                        (np.pi / 2, 0., 0.), (1., 0.5, 0.)]
+        full_library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations),
+             'Si2': (structure, orientations[:3]),
+             'Si3': (structure, orientations[1:])},
+            0.017, 2.4, (72, 72), 'euler', reduce_symmetry=True)
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations[:2]),
+             'Si2': (structure, orientations[:2])},
+            0.017, 2.4, (72, 72), 'euler', reduce_symmetry=True)
+        if on_disk:
+            library.save(str(tmpdir))
+            library = str(tmpdir)
+        extended = library_generator.extend_diffraction_library(
+            library, {'Si': (structure, orientations),
+                      'Si2': (structure, orientations[:3]),
+                      'Si3': (structure, orientations[1:])},
+            reduce_symmetry=True)
+        assert list(extended) == list(full_library)
+        assert extended.symmetry_map == full_library.symmetry_map
+        for key in full_library:
+            assert list(extended[key]) == list(full_library[key])
+            for orientation, pattern in full_library[key].items():
+                extended_pattern = extended[key][orientation]
+                assert np.allclose(extended_pattern['intensities'],
+                                   pattern['intensities'])
+                assert np.array_equal(extended_pattern['pixel_coords'],
+                                      pattern['pixel_coords'])
+                assert np.allclose(extended_pattern['Sim'].coordinates,
+                                   pattern['Sim'].coordinates)
+        template_bank = extended.get_template_bank()
+        full_bank = full_library.get_template_bank()
+        assert np.array_equal(template_bank.offsets, full_bank.offsets)
+        assert np.array_equal(template_bank.phase_offsets,
+                              full_bank.phase_offsets)
+        with pytest.raises(ValueError):
+            DiffractionLibraryGenerator(DiffractionGenerator(
+                200., 0.02)).extend_diffraction_library(
+                    extended, {'Si': (structure, orientations)})
+
+    def test_recalibrate(self, library_generator, structure, tmpdir):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (np.pi / 4, 0.5, 0.)]
+        structure_library = {'Si': (structure, orientations)}
+        library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 1.2, (72, 72), 'euler')
+        library.set_calibration(0.02, half_shape=(64, 64))
+        expected = library_generator.get_diffraction_library(
+            structure_library, 0.02, 1.2, (64, 64), 'euler')
+        template_bank = library.get_template_bank()
+        expected_bank = expected.get_template_bank()
+        for name in ('offsets', 'pixel_coords', 'intensities',
+                     'pattern_norms'):
+            assert np.allclose(getattr(template_bank, name),
+                               getattr(expected_bank, name))
+        # Spots outside the patterns are dropped.
+        library.recalibrate(calibration=0.017, half_shape=(20, 30),
+                            offset=(0.1, 0.))
+        template_bank = library.get_template_bank()
+        assert np.all(template_bank.pixel_coords >= 0)
+        assert np.all(template_bank.pixel_coords < (40, 60))
+        for orientation, pattern in library['Si'].items():
+            simulation = pattern['Sim']
+            pixel_coords = np.rint(simulation.calibrated_coordinates[:, :2] +
+                                   (20, 30)).astype(int)
+            inside = np.all((pixel_coords >= 0) & (pixel_coords < (40, 60)),
+                            axis=1)
+            assert np.array_equal(pattern['pixel_coords'],
+                                  pixel_coords[inside])
+            assert np.isclose(pattern['pattern_norm'],
+                              np.linalg.norm(simulation.intensities[inside]))
+        library.save(str(tmpdir))
+        loaded = load_diffraction_library(str(tmpdir))
+        loaded.recalibrate(half_shape=(72, 72), offset=(0., 0.))
+        library.recalibrate(half_shape=(72, 72), offset=(0., 0.))
+        assert np.array_equal(loaded.get_template_bank().pixel_coords,
+                              library.get_template_bank().pixel_coords)
+
+    def test_get_diffraction_library_outside(self, library_generator,
+                                             structure):
+        # Spots beyond the patterns are left out of the templates, as when
+        # recalibrating.
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (np.pi / 4, 0.5, 0.)]
+        structure_library = {'Si': (structure, orientations)}
+        library = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (20, 30), 'euler')
+        template_bank = library.get_template_bank()
+        assert np.all(template_bank.pixel_coords >= 0)
+        assert np.all(template_bank.pixel_coords < (40, 60))
+        recalibrated = library_generator.get_diffraction_library(
+            structure_library, 0.017, 2.4, (72, 72), 'euler')
+        recalibrated.recalibrate(half_shape=(20, 30))
+        expected_bank = recalibrated.get_template_bank()
+        for name in ('offsets', 'pixel_coords', 'intensities',
+                     'pattern_norms'):
+            assert np.allclose(getattr(template_bank, name),
+                               getattr(expected_bank, name))
+        correlations = correlate_template_bank(np.ones((40, 60)),
+                                               template_bank)
+        assert np.all(np.isfinite(correlations))
+
+    @pytest.mark.parametrize('half_shape', [(16, 16), (24, 24)])
+    def test_recalibrate_correlate(self, library_generator, structure,
+                                   half_shape):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (np.pi / 4, 0.5, 0.),
+                        (0., np.pi / 4, 0.), (0.3, 0.7, 0.2)]
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations)}, 0.017, 2.4, (72, 72), 'euler',
+            with_direct_beam=False)
+        # Cropping the patterns leaves some templates without spots.
+        library.recalibrate(half_shape=half_shape)
+        template_bank = library.get_template_bank()
+        empty = np.diff(template_bank.offsets) == 0
+        assert np.any(empty) and not np.all(empty)
+        data = np.random.RandomState(0).rand(2, 1, 2 * half_shape[0],
+                                             2 * half_shape[1])
+        correlations = correlate_template_bank(data[0, 0], template_bank)
+        assert np.all(correlations[empty] == 0.)
+        assert np.allclose(correlations, correlate_template_bank_batch(
+            data[0], template_bank)[0])
+        indexer = IndexationGenerator(ElectronDiffraction(data), library)
+        # Empty templates tie at zero, so only the scores are compared.
+        scores = indexer.correlate(n_largest=5).data[..., 4]
+        assert np.allclose(indexer.correlate(
+            n_largest=5, prune=True).data[..., 4], scores)
+        assert np.allclose(indexer.correlate(
+            n_largest=5, batch_size=2).data[..., 4], scores)
+
+    def test_correlate_prune_simulated(self, library_generator, structure):
+        orientations = np.random.RandomState(0).rand(200, 3) * \
+            (2 * np.pi, np.pi / 2, 2 * np.pi)
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, [tuple(o) for o in orientations])}, 0.017, 1.6,
+            (72, 72), 'euler', with_direct_beam=False)
+        # A pattern of one of the templates, with blurred spots and noise.
+        pattern = library['Si'][tuple(orientations[37])]
+        data = np.zeros((1, 1, 144, 144))
+        rows, columns = pattern['pixel_coords'].T
+        for i, j in ((0, 0), (0, 1), (1, 0), (0, -1), (-1, 0)):
+            data[0, 0, np.clip(rows + i, 0, 143),
+                 np.clip(columns + j, 0, 143)] += \
+                pattern['intensities'] / (1 + abs(i) + abs(j))
+        data = data / data.max() + \
+            0.05 * np.random.RandomState(1).rand(*data.shape)
+        indexer = IndexationGenerator(ElectronDiffraction(data), library)
+        matching_results = indexer.correlate(n_largest=3, prune=True)
+        assert np.allclose(matching_results.data,
+                           indexer.correlate(n_largest=3).data)
+        assert np.allclose(matching_results.data[0, 0, 0, 1:4],
+                           orientations[37])
+        assert matching_results.metadata.Indexation.pruned_fraction > 0.5
+
+    def test_recalibrate_index_vectors(self, library_generator, structure):
+        orientations = [(0., 0., 0.), (0.1, 0.2, 0.3), (np.pi / 4, 0.5, 0.)]
+        library = library_generator.get_diffraction_library(
+            {'Si': (structure, orientations)}, 0.017, 2.4, (72, 72), 'euler')
+        library.recalibrate(half_shape=(20, 20))
+        simulation = library['Si'][(0.1, 0.2, 0.3)]['Sim']
+        assert len(simulation.coordinates) > \
+            len(library['Si'][(0.1, 0.2, 0.3)]['intensities'])
+        vectors = np.empty((1,), dtype=object)
+        vectors[0] = simulation.coordinates[:, :2]
+        indexer = VectorIndexationGenerator(DiffractionVectors(vectors),
+                                            library)
+        best = indexer.index_vectors(0.01, n_largest=1).data[0, 0]
+        # Vectors are matched with the spots of the simulations, including
+        # those cropped from the templates.
+        assert np.allclose(best, [0., 0.1, 0.2, 0.3,
+                                  len(simulation.coordinates)])